@@ -0,0 +1,181 @@
+import os
+import pickle
+import hashlib
+import tempfile
+import warnings
+import numpy as np
+import cvxpy as cp
+import cvxpylayers
+import torch
+
+
+class ProblemCache:
+
+    """
+    On-disk cache of compiled DeePC problems.
+
+    Entries are pickled to <directory>/<key>.pkl, where the key is a hash of the
+    problem structure (dimensions, flags, Hankel data, constraints and weights) and
+    of the cvxpy / cvxpylayers versions that compiled them. Loading an entry bumps
+    its modification time, and the least recently used entries are removed once
+    the directory holds more than max_bytes, so several processes can share the
+    cache. Writes go through a temporary file and are atomic.
+
+    Unpickling runs arbitrary code, so entries are only loaded if the file and the
+    directory belong to the current user and cannot be written by anyone else.
+    The directory is created with permissions 0o700.
+    """
+
+    # Bump when the compiled problems change, so stale entries are not loaded
+    VERSION = 2
+
+    def __init__(self, directory=None, max_bytes=2**30) -> None:
+
+        """
+        args:
+            - directory : Cache directory, defaults to $DEEPC_HUNT_CACHE or ~/.cache/deepc_hunt
+            - max_bytes : Maximum total size of the cached entries
+        """
+
+        if directory is None:
+            directory = os.environ.get('DEEPC_HUNT_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'deepc_hunt'))
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+
+    @staticmethod
+    def key(*parts) -> str:
+
+        """
+        Hash of parts, arrays are hashed by dtype, shape and content, everything else by repr
+        """
+
+        h = hashlib.sha256()
+        for part in (ProblemCache.VERSION, cp.__version__, cvxpylayers.__version__) + parts:
+            if isinstance(part, torch.Tensor):
+                part = part.detach().cpu().numpy()
+            if isinstance(part, np.ndarray):
+                part = np.ascontiguousarray(part)
+                h.update(f'{part.dtype}{part.shape}'.encode())
+                h.update(memoryview(part))
+            else:
+                h.update(repr(part).encode())
+            h.update(b'|')
+        return h.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f'{key}.pkl')
+
+    def load(self, key: str):
+
+        """
+        Returns the entry stored under key, or None if there is none or it cannot be read
+        """
+
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                # The opened file is checked, so it cannot be swapped after the check
+                trusted = self._trusted(os.stat(self.directory)) and self._trusted(os.fstat(f.fileno()))
+                if trusted:
+                    with warnings.catch_warnings():
+                        # Unpickling the sparse tensors of a CvxpyLayer warns that sparse CSR support is in beta
+                        warnings.simplefilter('ignore', UserWarning)
+                        obj = pickle.load(f)
+                    os.utime(path)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except Exception:
+            # Truncated entry or one written by incompatible library versions
+            self.misses += 1
+            self._remove(path)
+            return None
+        if not trusted:
+            warnings.warn(f'Ignoring cache entry {path}, it or its directory is not owned by the current user '
+                          'or is writable by others', RuntimeWarning)
+            self.misses += 1
+            return None
+        self.hits += 1
+        return obj
+
+    def store(self, key: str, obj) -> None:
+
+        """
+        Store obj under key and evict the least recently used entries beyond max_bytes
+        """
+
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, self._path(key))
+        except Exception:
+            self._remove(tmp)
+            raise
+        self.evict()
+
+    def evict(self) -> None:
+
+        """
+        Remove the least recently used entries until the cache holds at most max_bytes
+        """
+
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.pkl'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self._remove(os.path.join(self.directory, name))
+            total -= size
+
+    def clear(self) -> None:
+        for name in os.listdir(self.directory):
+            if name.endswith('.pkl'):
+                self._remove(os.path.join(self.directory, name))
+
+    @staticmethod
+    def _trusted(stat: os.stat_result) -> bool:
+
+        """
+        Whether the file of stat belongs to the current user and is not writable by group or others.
+        Always true where the platform has no user ids
+        """
+
+        if not hasattr(os, 'getuid'):
+            return True
+        return stat.st_uid == os.getuid() and not stat.st_mode & 0o022
+
+    @staticmethod
+    def _remove(path: str) -> None:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def resolve_cache(cache):
+
+    """
+    Map the cache argument of the controllers to a ProblemCache or None:
+    None / False disable caching, True uses the default directory,
+    a string is used as the directory and a ProblemCache is used as is
+    """
+
+    if cache is None or cache is False:
+        return None
+    if cache is True:
+        return ProblemCache()
+    if isinstance(cache, str):
+        return ProblemCache(cache)
+    return cache
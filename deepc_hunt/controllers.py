@@ -1,4 +1,10 @@
-from .utils import block_hankel, block_hankel_torch
+from .utils import block_hankel, block_hankel_torch, reduce_hankel, psd_sqrt, check_excitation, RowSpaceBasis
+from .qp import BatchQP
+from .parallel import LayerPool
+from .solvers import SolverSelector, available_solvers
+from .cache import ProblemCache, resolve_cache
+from .direct import SparseQP
+import scipy.sparse as sp
 import torch
 import torch.nn as nn
 from torch.nn.parameter import Parameter
@@ -8,6 +14,22 @@ import cvxpy as cp
 import time
 from typing import Tuple
 
+def _data_matrices(ud: np.ndarray, yd: np.ndarray, Tini: int, N: int, m: int, p: int) -> tuple:
+    # Blocks Up, Yp, Uf, Yf of the block Hankel matrices of order Tini + N, views of ud and yd
+    T = ud.shape[0]
+    U = block_hankel(w=ud.reshape((m*T,)), L=Tini+N, d=m)
+    Y = block_hankel(w=yd.reshape((p*T,)), L=Tini+N, d=p)
+    return U[0:m*Tini,:], Y[0:p*Tini,:], U[Tini*m:,:], Y[Tini*p:,:]
+
+def _extend_data(w: np.ndarray, new: np.ndarray, d: int, slide: bool) -> tuple:
+    # Data w as shape (T, d) with the samples new appended, and as many of the oldest dropped if slide.
+    # Returns the new data and the number of new samples
+    new = np.reshape(new, (-1, d))
+    w = np.reshape(w, (-1, d))
+    if slide and len(new) >= len(w):
+        raise ValueError(f'Cannot slide {len(new)} samples through data of length {len(w)}')
+    return np.concatenate([w[len(new):] if slide else w, new]), len(new)
+
 class DeePC(nn.Module):
 
     """
@@ -18,7 +40,10 @@ class DeePC(nn.Module):
                  y_constraints: Tuple[np.ndarray, np.ndarray], u_constraints: Tuple[np.ndarray, np.ndarray], 
                  N: int, Tini: int, p: int, m: int, device : str,
                  stochastic_y=False, stochastic_u=False, linear=True, n_batch=1,
-                 q=None, r=None, lam_y=None, lam_g1=None, lam_g2=None, lam_u=None):
+                 q=None, r=None, lam_y=None, lam_g1=None, lam_g2=None, lam_u=None,
+                 backend='cvxpylayers', qp_settings=None, closed_form=None, svd_rank=None,
+                 n_jobs=None, parallel='thread', solvers=None, benchmark_solvers=False, max_failures=3,
+                 cache=None, online=False):
         super().__init__()
 
         """
@@ -32,6 +57,8 @@ class DeePC(nn.Module):
             - Tini : Initial time horizon
             - p : Dimension of output signal
             - m : Dimension of input signal
+            - n_batch : Default batch size, used by Trainer and the solver benchmark.
+                forward takes the batch size from its inputs
 
             - stochastic : Set true if noise if output signals contain noise
             - linear : Set true if input and putput signals are collected from a linear system
@@ -49,6 +76,33 @@ class DeePC(nn.Module):
                     -> if left as none, randomly initialise as torch parameter 
             - lam_g2 : regularization paramter for norm1 regularization on g 
                     -> if left as none, randomly initialise as torch parameter 
+
+            - backend : 'cvxpylayers' solves each batch element with a conic solver through CvxpyLayer,
+                'torch' solves the whole batch at once with the interior point solver in deepc_hunt.qp
+            - qp_settings : dict of keyword arguments for BatchQP when backend='torch'
+            - closed_form : Solve linear problems without slack variables analytically, as an equality
+                constrained least squares problem in torch.
+                None -> used whenever the analytic solution satisfies the box constraints, backend otherwise
+                True -> always used, the box constraints are ignored
+                False -> never used
+            - svd_rank : If given, g = V@z is restricted to the leading svd_rank right singular vectors V
+                of [Up; Yp; Uf; Yf] and the problem is solved for z, with the regularizers rewritten in z
+            - n_jobs : Number of workers solving the batch elements and their derivatives in parallel when
+                backend='cvxpylayers', None leaves it to the solver. The torch backend solves the batch at once.
+            - parallel : 'thread' uses the thread pool of diffcp, 'process' splits the batch over n_jobs
+                worker processes (see deepc_hunt.parallel), which avoids contention on the GIL. The workers
+                are not forked, so a script using it needs an if __name__ == '__main__' guard
+            - solvers : Conic solvers CvxpyLayer may use, in order of preference, defaults to the installed
+                ones of Clarabel, ECOS and SCS. The selected solver is kept until it fails max_failures
+                times in a row, failed solves fall back to the other solvers (see deepc_hunt.solvers.SolverSelector)
+            - benchmark_solvers : Time the solvers on a sample problem at construction and select the fastest
+            - max_failures : Consecutive failures of the selected solver after which the solvers are timed again
+            - cache : Reuse the compiled CvxpyLayer across processes through an on-disk cache keyed by the
+                problem structure and data, or its size with online=True (see deepc_hunt.cache.ProblemCache).
+                True uses the default directory, a string is the cache directory, None disables it
+            - online : With backend='cvxpylayers', the data matrices and the basis of PI enter the CvxpyLayer
+                as parameters, so update can slide new samples through the data without compiling the layer
+                again. Each solve then also passes the data, so training without updates is faster without it
         """
         
         self.T = ud.shape[0]
@@ -71,6 +125,21 @@ class DeePC(nn.Module):
         self.lam_g2 = lam_g2
         self.lam_u = lam_u
         self.lam_y = lam_y
+        if backend not in ('cvxpylayers', 'torch'):
+            raise ValueError(f'Unknown backend {backend}')
+        self.backend = backend
+        if closed_form and (not linear or stochastic_y or stochastic_u):
+            raise ValueError('closed_form requires linear=True without stochastic_y and stochastic_u')
+        self.closed_form = closed_form
+        if parallel not in ('thread', 'process'):
+            raise ValueError(f'Unknown parallel mode {parallel}')
+        self.n_jobs = n_jobs
+        self.parallel = parallel
+        self._pool = None
+        self.cache = resolve_cache(cache)
+        if online and svd_rank is not None:
+            raise ValueError('online does not support svd_rank')
+        self.online = online
 
         # Initialise torch parameters
         if isinstance(q, torch.Tensor):
@@ -106,73 +175,138 @@ class DeePC(nn.Module):
                 self.lam_g2 = Parameter(torch.randn((1,))*0.001 + 200)
 
         # Check for full row rank
-        H = block_hankel(w=ud.reshape((m*self.T,)), L=Tini+N+p, d=m)
-        rank = np.linalg.matrix_rank(H)
-        if rank != H.shape[0]:
-            raise ValueError('Data is not persistently exciting')
+        self.excitation = check_excitation(w=ud.reshape((m*self.T,)), L=Tini+N+p, d=m)
+        if not self.excitation.exciting:
+            raise ValueError(f'Data is not persistently exciting, rank {self.excitation.rank} < {self.excitation.rows}')
         
         # Construct data matrices
-        U = block_hankel(w=ud.reshape((m*self.T,)), L=Tini+N, d=m)
-        Y = block_hankel(w=yd.reshape((p*self.T,)), L=Tini+N, d=p)
-        self.Up = U[0:m*Tini,:]
-        self.Yp = Y[0:p*Tini,:]
-        self.Uf = U[Tini*m:,:]
-        self.Yf = Y[Tini*p:,:]
-
-        # Initialise Optimisation variables
-        g = cp.Variable(self.T-self.Tini-self.N+1)
-        self.y = cp.Variable(N*p)
-        ey = cp.Variable(N*p)
-        eu = cp.Variable(N*m)
-        self.u = cp.Variable(N*m)
+        self.Up, self.Yp, self.Uf, self.Yf = _data_matrices(ud, yd, Tini, N, m, p)
+        self.g_basis = None
+        self._row_space = None
+        self._past_row_space = None
+        if svd_rank is not None:
+            self.Up, self.Yp, self.Uf, self.Yf, self.g_basis = reduce_hankel(self.Up, self.Yp, self.Uf, self.Yf, svd_rank)
+
+        dtype = torch.float64
+        self.register_buffer('Up_t', torch.tensor(self.Up, dtype=dtype), persistent=False)
+        self.register_buffer('Yp_t', torch.tensor(self.Yp, dtype=dtype), persistent=False)
+        self.register_buffer('Uf_t', torch.tensor(self.Uf, dtype=dtype), persistent=False)
+        self.register_buffer('Yf_t', torch.tensor(self.Yf, dtype=dtype), persistent=False)
+        if not linear:
+            self.register_buffer('PI_basis', torch.as_tensor(self._padded_PI(), dtype=dtype), persistent=False)
+        self.register_buffer('u_bounds', torch.as_tensor(np.vstack([
+            np.broadcast_to(self.u_lower, (self.N*self.m,)), np.broadcast_to(self.u_upper, (self.N*self.m,))
+        ]), dtype=dtype), persistent=False)
+        self.register_buffer('y_bounds', torch.as_tensor(np.vstack([
+            np.broadcast_to(self.y_lower, (self.N*self.p,)), np.broadcast_to(self.y_upper, (self.N*self.p,))
+        ]), dtype=dtype), persistent=False)
+
+        if self.closed_form is not False and linear and not stochastic_y and not stochastic_u:
+            self._build_closed_form()
+        else:
+            self.closed_form = False
+        self.qp_settings = qp_settings or {}
+        if self.backend == 'torch':
+            self._build_torch_qp(self.qp_settings)
+        else:
+            self._build_cvxpylayer()
+            self.solver_selector = SolverSelector(
+                available_solvers(solvers or ['Clarabel', 'ECOS', 'SCS']), max_failures=max_failures
+            )
+            if benchmark_solvers:
+                self._benchmark_solvers()
+
+    def _build_cvxpylayer(self, store=True) -> None:
+
+        """
+        Build the DeePC problem in CVXPY and wrap it in a CvxpyLayer.
+        With online=True, Up, Yp, Uf, Yf and the basis of PI are parameters of the layer, so new data of the same
+        size (see update) reuses the compiled problem. store=False leaves a compiled layer out of the cache
+        """
+
+        N, p, m, Tini, linear = self.N, self.p, self.m, self.Tini, self.linear
+        stochastic_y, stochastic_u, online = self.stochastic_y, self.stochastic_u, self.online
+        ng = self.Up.shape[1]
+
+        if self.cache is not None:
+            data = (ng,) if online else (self.Up, self.Yp, self.Uf, self.Yf)
+            key = ProblemCache.key(
+                'DeePC', N, p, m, Tini, linear, stochastic_y, stochastic_u, online, *data, self.g_basis,
+                *(np.asarray(b) for b in (self.u_lower, self.u_upper, self.y_lower, self.y_upper))
+            )
+            entry = self.cache.load(key)
+            if entry is not None:
+                self.QP_layer, self._param_ndims = entry
+                return
+
+        # Initialise Optimisation variables, u = Uf@g and y = Yf@g are recovered after the solve
+        g = cp.Variable(ng)
         sig_y = cp.Variable(self.Tini*self.p) 
         sig_u = cp.Variable(self.Tini*self.m) 
 
-        # Constant for sum_squares regularization on G
-        PI = np.vstack([self.Up, self.Yp, self.Uf])
-        PI = np.linalg.pinv(PI)@PI
-        I = np.eye(PI.shape[0])
-
         # Initalise optimization parameters and cost
         l_g1, l_g2 = cp.Parameter(shape=(1,), nonneg=True), cp.Parameter(shape=(1,), nonneg=True)
         l_y = cp.Parameter(shape=(1,), nonneg=True)
         l_u = cp.Parameter(shape=(1,), nonneg=True)
-        Q_block_sqrt, R_block_sqrt = cp.Parameter((p*N,p*N)), cp.Parameter((m*N,m*N))
-        yref = cp.Parameter((N*p,))
-        uref = cp.Parameter((N*m,))
+        # Square roots of the diagonals of the block cost matrices, q and r tiled N times
+        q_sqrt, r_sqrt = cp.Parameter(N*p, nonneg=True), cp.Parameter(N*m, nonneg=True)
+
+        # Weighted references q_sqrt*yref and r_sqrt*uref, products of parameters are not DPP
+        q_yref = cp.Parameter((N*p,))
+        r_uref = cp.Parameter((N*m,))
         
         u_ini, y_ini = cp.Parameter(Tini*m), cp.Parameter(Tini*p)
-        cost = cp.sum_squares(cp.psd_wrap(Q_block_sqrt) @ ey) + cp.sum_squares(cp.psd_wrap(R_block_sqrt) @ eu)
+        if online:
+            Up, Yp, Uf, Yf = (cp.Parameter(M.shape) for M in (self.Up, self.Yp, self.Uf, self.Yf))
+            # q_sqrt times an expression in the parameter Yf is not DPP, so the predictions are variables
+            u, y = cp.Variable(N*m), cp.Variable(N*p)
+            constraints = [Uf@g == u, Yf@g == y]
+        else:
+            Up, Yp, Uf, Yf = self.Up, self.Yp, self.Uf, self.Yf
+            u, y = Uf@g, Yf@g
+            constraints = []
+        cost = cp.sum_squares(cp.multiply(q_sqrt, y) - q_yref) + cp.sum_squares(cp.multiply(r_sqrt, u) - r_uref)
         assert cost.is_dpp()
 
+        constraints += [
+            u <= self.u_upper, u >= self.u_lower,
+            y <= self.y_upper, y >= self.y_lower
+        ]
+        
+        constraints.append(Up@g == u_ini + sig_u) if self.stochastic_u else constraints.append(Up@g == u_ini)
+        constraints.append(Yp@g == y_ini + sig_y) if self.stochastic_y else constraints.append(Yp@g == y_ini)
+
         # Set constraints and cost function according to system (nonlinear / stochastic)
         if not linear:
-            cost += cp.sum_squares((I - PI)@g)*l_g1 + cp.norm1(g)*l_g2 
+            # Basis of the row space for the sum_squares regularization on g, PI = V@V.T
+            V = cp.Parameter(tuple(self.PI_basis.shape)) if online else self.get_PI()
+            g_proj = cp.Variable(V.shape[1])
+            g_full = g if self.g_basis is None else self.g_basis@g
+            # (I - PI)@g = g - V@g_proj with g_proj = V.T@g, which keeps the dense n x n matrix I - PI out of the problem
+            if online:
+                # l_g1 times an expression in the parameter V is not DPP, so the residual is a variable
+                g_perp = cp.Variable(ng)
+                cost += cp.sum_squares(g_perp)*l_g1
+                constraints.append(g_perp == g - V@g_proj)
+            else:
+                cost += cp.sum_squares(g - V@g_proj)*l_g1
+            cost += cp.norm1(g_full)*l_g2 
+            constraints.append(V.T@g == g_proj)
             assert cost.is_dpp()
 
         cost += cp.norm1(sig_y)*l_y if self.stochastic_y else 0
         cost += cp.norm1(sig_u)*l_u if self.stochastic_u else 0
         assert cost.is_dpp()
-
-        constraints = [
-            ey == self.y - yref,  # necessary for paramaterized programming
-            eu == self.u - uref,  # necessary for paramaterized programming
-            self.Uf@g == self.u,
-            self.Yf@g == self.y,
-            self.u <= self.u_upper, self.u >= self.u_lower,
-            self.y <= self.y_upper, self.y >= self.y_lower
-        ]
-        
-        constraints.append(self.Up@g == u_ini + sig_u) if self.stochastic_u else constraints.append(self.Up@g == u_ini)
-        constraints.append(self.Yp@g == y_ini + sig_y) if self.stochastic_y else constraints.append(self.Yp@g == y_ini)
         
         # Initialise optimization problem
         problem = cp.Problem(cp.Minimize(cost), constraints)
         assert problem.is_dcp()
         assert problem.is_dpp()
 
-        variables = [self.u, self.y, g, ey, eu]
-        params = [Q_block_sqrt, R_block_sqrt, u_ini, y_ini, yref, uref]
+        variables = [g]
+        params = [q_sqrt, r_sqrt, u_ini, y_ini, q_yref, r_uref]
+        if online:
+            params += [Up, Yp, Uf, Yf] + ([V] if not linear else [])
         
         if not linear:
             params.append(l_g1)
@@ -186,8 +320,206 @@ class DeePC(nn.Module):
             variables.append(sig_u)
             params.append(l_u)
 
+        self._param_ndims = [len(param.shape) for param in params]
         self.QP_layer = CvxpyLayer(problem=problem, parameters=params, variables=variables)
+        if self.cache is not None and store:
+            self.cache.store(key, (self.QP_layer, self._param_ndims))
     
+    def _build_torch_qp(self, settings: dict) -> None:
+
+        """
+        Write DeePC as a BatchQP over x = [g, sig_u, sig_y] with constraint rows
+            [Up@g - sig_u, Yp@g - sig_y, Uf@g, Yf@g, V@g, sig_u, sig_y]
+        where the last three blocks only carry the norm1 regularizers and V = I without svd_rank.
+        """
+
+        dtype = torch.float64
+        self.register_buffer('qp_A', torch.as_tensor(self._qp_matrix(), dtype=dtype), persistent=False)
+        self.qp = BatchQP(self.qp_A, **settings)
+
+    def _qp_matrix(self) -> np.ndarray:
+
+        """
+        Constraint matrix of the BatchQP of _build_torch_qp
+        """
+
+        ng = self.Up.shape[1]
+        n_sig_u = self.Tini*self.m if self.stochastic_u else 0
+        n_sig_y = self.Tini*self.p if self.stochastic_y else 0
+        n = ng + n_sig_u + n_sig_y
+        self.n_g = ng
+
+        n_eq = self.Tini*(self.m + self.p)
+        n_box = self.N*(self.m + self.p)
+        V = np.eye(ng) if self.g_basis is None else self.g_basis
+        n_l1g = 0 if self.linear else V.shape[0]
+        A = np.zeros((n_eq + n_box + n_l1g + n_sig_u + n_sig_y, n))
+        A[:n_eq,:ng] = np.vstack([self.Up, self.Yp])
+        A[n_eq:n_eq + n_box,:ng] = np.vstack([self.Uf, self.Yf])
+        A[n_eq + n_box:n_eq + n_box + n_l1g,:ng] = V[:n_l1g]
+        A[n_eq + n_box + n_l1g:,ng:] = np.eye(n_sig_u + n_sig_y)
+        if self.stochastic_u:
+            A[:self.Tini*self.m,ng:ng + n_sig_u] = -np.eye(n_sig_u)
+        if self.stochastic_y:
+            A[self.Tini*self.m:n_eq,n - n_sig_y:] = -np.eye(n_sig_y)
+        return A
+
+    def _build_closed_form(self) -> None:
+
+        """
+        Without box constraints, slack variables and regularization on g the DeePC problem is
+            minimize ||Yf@g - yref||_Q^2 + ||Uf@g - uref||_R^2  s.t.  [Up; Yp]@g = [u_ini; y_ini]
+        Writing g = pinv(Hp)@ini + Z@z with Z a basis of the null space of Hp = [Up; Yp],
+        the future trajectory f = [u; y] = Hf@g is G@ini + V@a for any a, where G = Hf@pinv(Hp)
+        and V is an orthonormal basis of the range of Hf@Z. Only G and V depend on the data,
+        so each call only solves a small weighted least squares problem for a.
+        Both come from the thin SVD Hp = U@diag(s)@Vp.T kept by a RowSpaceBasis, which update modifies
+        instead of factorizing the data again: G = Hf@Vp@diag(1/s)@U.T and Hf@Z has the range of Hf@(I - Vp@Vp.T)
+        """
+
+        Hp, Hf = np.vstack([self.Up, self.Yp]), np.vstack([self.Uf, self.Yf])
+        if self._past_row_space is None:
+            self._past_row_space = RowSpaceBasis(Hp, rcond=max(Hp.shape)*np.finfo(float).eps)
+        past = self._past_row_space
+        # pinv(Hp) from the same SVD and cutoff, so it agrees with the null space Z on rank deficient data
+        HfV = Hf @ past.V
+        G = (HfV/past.s) @ past.U.T
+        F = Hf - HfV @ past.V.T
+        V, s, _ = np.linalg.svd(F, full_matrices=False)
+        V = V[:,s > s.max()*max(F.shape)*np.finfo(float).eps] if s.size else V
+
+        dtype = torch.float64
+        self.register_buffer('cf_G', torch.as_tensor(G, dtype=dtype), persistent=False)
+        self.register_buffer('cf_V', torch.as_tensor(V, dtype=dtype), persistent=False)
+
+    def _batch_inputs(self, yref: torch.Tensor, uref: torch.Tensor, u_ini: torch.Tensor, y_ini: torch.Tensor) -> Tuple[bool, list]:
+
+        """
+        Broadcast the inputs of forward to a common batch size in float64.
+        Returns whether the inputs were batched and the broadcast inputs
+        """
+
+        batched = u_ini.ndim > 1 or y_ini.ndim > 1 or yref.ndim > 1 or uref.ndim > 1
+        inputs = [torch.atleast_2d(v).to(torch.float64) for v in (yref, uref, u_ini, y_ini)]
+        n_batch = max(v.shape[0] for v in inputs)
+        return batched, [v.expand(n_batch, -1) for v in inputs]
+
+    def _closed_form_forward(self, yref: torch.Tensor, uref: torch.Tensor, u_ini: torch.Tensor, y_ini: torch.Tensor) -> list[torch.Tensor]:
+
+        """
+        Solve the DeePC problem analytically for the whole batch (see _build_closed_form).
+        Returns None if closed_form is None and the solution violates the box constraints
+        """
+
+        out_dtype = u_ini.dtype
+        batched, (yref, uref, u_ini, y_ini) = self._batch_inputs(yref, uref, u_ini, y_ini)
+        dtype = yref.dtype
+        wts = torch.cat((self.r.to(dtype).repeat(self.N), self.q.to(dtype).repeat(self.N)))
+        f0 = torch.cat((u_ini, y_ini), 1) @ self.cf_G.T
+        e = torch.cat((uref, yref), 1) - f0
+        M = self.cf_V.T @ (wts[:,None]*self.cf_V)
+        a = torch.linalg.solve(M, ((e*wts) @ self.cf_V).T)
+        f = f0 + (self.cf_V @ a).T
+        u, y = f[:,:self.N*self.m], f[:,self.N*self.m:]
+
+        if self.closed_form is None:
+            with torch.no_grad():
+                feasible = ((u >= self.u_bounds[0]) & (u <= self.u_bounds[1])).all() & \
+                    ((y >= self.y_bounds[0]) & (y <= self.y_bounds[1])).all()
+            if not bool(feasible):
+                return None
+
+        vars = [u.to(out_dtype), y.to(out_dtype)]
+        return vars if batched else [v.squeeze(0) for v in vars]
+
+    def _torch_forward(self, yref: torch.Tensor, uref: torch.Tensor, u_ini: torch.Tensor, y_ini: torch.Tensor) -> list[torch.Tensor]:
+
+        """
+        Solve the DeePC problem for the whole batch with BatchQP
+        """
+
+        dtype, out_dtype = self.qp_A.dtype, u_ini.dtype
+        batched, (yref, uref, u_ini, y_ini) = self._batch_inputs(yref, uref, u_ini, y_ini)
+        n_batch = u_ini.shape[0]
+        ng, n, k = self.n_g, self.qp.n, self.qp.k
+        self.qp.A = self.qp_A # follow the buffer across .to(device)
+
+        # Cost
+        qw = self.q.to(dtype).repeat(self.N)
+        rw = self.r.to(dtype).repeat(self.N)
+        P = self.Yf_t.T @ (qw[:,None]*self.Yf_t) + self.Uf_t.T @ (rw[:,None]*self.Uf_t)
+        if not self.linear:
+            # (I - PI).T@(I - PI) = I - PI = I - V@V.T, the zero columns of the padded basis drop out
+            PI_c = torch.eye(ng, dtype=dtype, device=P.device) - self.PI_basis @ self.PI_basis.T
+            P = P + self.lam_g1.to(dtype)*PI_c
+        P = torch.block_diag(2*P, torch.zeros((n - ng, n - ng), dtype=dtype, device=P.device))
+        q = -2*((yref*qw) @ self.Yf_t + (uref*rw) @ self.Uf_t)
+        q = torch.cat((q, torch.zeros((n_batch, n - ng), dtype=dtype, device=q.device)), 1)
+
+        # Constraints
+        n_l1 = k - self.Tini*(self.m + self.p) - self.N*(self.m + self.p)
+        inf = torch.full((n_batch, n_l1), float('inf'), dtype=dtype, device=q.device)
+        lower = torch.cat((u_ini, y_ini, self.u_bounds[0].expand(n_batch, -1), self.y_bounds[0].expand(n_batch, -1), -inf), 1)
+        upper = torch.cat((u_ini, y_ini, self.u_bounds[1].expand(n_batch, -1), self.y_bounds[1].expand(n_batch, -1), inf), 1)
+        w = [torch.zeros(k - n_l1, dtype=dtype, device=q.device)]
+        if not self.linear:
+            w.append(self.lam_g2.to(dtype).expand(n_l1 - self.Tini*(self.m*self.stochastic_u + self.p*self.stochastic_y)))
+        if self.stochastic_u:
+            w.append(self.lam_u.to(dtype).expand(self.Tini*self.m))
+        if self.stochastic_y:
+            w.append(self.lam_y.to(dtype).expand(self.Tini*self.p))
+
+        x = self.qp(P, q, lower, upper, torch.cat(w))
+        g = x[:,:ng]
+        vars = [g @ self.Uf_t.T, g @ self.Yf_t.T]
+        if self.stochastic_y : vars.append(x[:,n - self.Tini*self.p:])
+        if self.stochastic_u : vars.append(x[:,ng:ng + self.Tini*self.m])
+        vars = [v.to(out_dtype) for v in vars]
+        return vars if batched else [v.squeeze(0) for v in vars]
+
+    def _layer_params(self, yref: torch.Tensor, uref: torch.Tensor, u_ini: torch.Tensor, y_ini: torch.Tensor) -> list[torch.Tensor]:
+
+        """
+        Parameters of the CvxpyLayer in the order of _build_cvxpylayer, in float64 like the data.
+        The cost weights, regularization parameters and data of online=True are left unbatched,
+        CvxpyLayer broadcasts them over the batch of the inputs
+        """
+
+        # Diagonal cost weights, shared by the whole batch
+        dtype = torch.float64
+        q_sqrt = torch.sqrt(self.q).repeat(self.N).to(self.Yf_t)
+        r_sqrt = torch.sqrt(self.r).repeat(self.N).to(self.Uf_t)
+        yref, uref, u_ini, y_ini = (v.to(dtype) for v in (yref, uref, u_ini, y_ini))
+        params = [q_sqrt, r_sqrt, u_ini, y_ini, yref*q_sqrt, uref*r_sqrt]
+        if self.online:
+            params += [self.Up_t, self.Yp_t, self.Uf_t, self.Yf_t] + ([self.PI_basis] if not self.linear else [])
+        
+        # Add paramters and system
+        lams = []
+        if not self.linear:
+            lams += [self.lam_g1, self.lam_g2]
+        if self.stochastic_y:
+            lams.append(self.lam_y)
+        if self.stochastic_u:
+            lams.append(self.lam_u)
+        params += [lam.reshape(1).to(dtype) for lam in lams]
+        return params
+
+    def _benchmark_solvers(self) -> None:
+
+        """
+        Time the solvers on the problem whose initial trajectory is the first column of the data
+        and reference is zero, and select the fastest one
+        """
+
+        u_ini = torch.tensor(self.Up[:,0], dtype=torch.float64).repeat(self.n_batch,1)
+        y_ini = torch.tensor(self.Yp[:,0], dtype=torch.float64).repeat(self.n_batch,1)
+        yref = torch.zeros(self.n_batch, self.N*self.p, dtype=torch.float64)
+        uref = torch.zeros(self.n_batch, self.N*self.m, dtype=torch.float64)
+        with torch.no_grad():
+            params = self._layer_params(yref=yref, uref=uref, u_ini=u_ini, y_ini=y_ini)
+            self.solver_selector.probe(lambda solver: self.QP_layer(*params, solver_args={"solve_method": solver}))
+
     def forward(self, yref: torch.Tensor, uref: torch.Tensor, u_ini: torch.Tensor, y_ini: torch.Tensor) -> list[torch.Tensor]:
 
         """
@@ -201,46 +533,142 @@ class DeePC(nn.Module):
             input : optimal input signal
             output : optimal output signal
             cost : optimal cost
+
+        The batch size is taken from the inputs, which are either unbatched or share a leading
+        batch dimension, and the parameters are broadcast over it. Unbatched references are
+        shared by the whole batch.
+        In eval mode or under torch.no_grad() the problem is solved without any differentiation
+        bookkeeping (CvxpyLayer then only calls the solver, not its derivative) and the returned
+        tensors do not require grad. This inference path reuses the compiled problem.
         """
 
-        # Construct Q and R matrices 
-        if u_ini.ndim > 1 or y_ini.ndim > 1:
-            Q = torch.diag(torch.kron(torch.ones(self.N).to(self.device), torch.sqrt(self.q))).repeat(self.n_batch, 1, 1).to(self.device)
-            R = torch.diag(torch.kron(torch.ones(self.N).to(self.device), torch.sqrt(self.r))).repeat(self.n_batch, 1, 1).to(self.device)
-        else :
-            Q = torch.diag(torch.kron(torch.ones(self.N).to(self.device), torch.sqrt(self.q))).to(self.device)
-            R = torch.diag(torch.kron(torch.ones(self.N).to(self.device), torch.sqrt(self.r))).to(self.device)
+        if self.training and torch.is_grad_enabled():
+            return self._forward(yref=yref, uref=uref, u_ini=u_ini, y_ini=y_ini)
+        with torch.no_grad():
+            return self._forward(yref=yref, uref=uref, u_ini=u_ini, y_ini=y_ini)
 
-        params = [Q, R, u_ini, y_ini, yref, uref]
-        
-        # Add paramters and system
-        if not self.linear:
-            params.append(self.lam_g1.repeat(self.n_batch,1))
-            params.append(self.lam_g2.repeat(self.n_batch,1))
-        if self.stochastic_y:
-            params.append(self.lam_y.repeat(self.n_batch,1))
-        if self.stochastic_u:
-            params.append(self.lam_u.repeat(self.n_batch,1))
+    def _forward(self, yref: torch.Tensor, uref: torch.Tensor, u_ini: torch.Tensor, y_ini: torch.Tensor) -> list[torch.Tensor]:
+        if self.closed_form is not False:
+            vars = self._closed_form_forward(yref=yref, uref=uref, u_ini=u_ini, y_ini=y_ini)
+            if vars is not None:
+                return vars
+        if self.backend == 'torch':
+            return self._torch_forward(yref=yref, uref=uref, u_ini=u_ini, y_ini=y_ini)
 
-        try:
-            out = self.QP_layer(*params, solver_args={"solve_method": "Clarabel"})
-        except:
-            out = self.QP_layer(*params, solver_args={"solve_method": "ECOS"})
-            
-        input, output = out[0], out[1]
-        vars = [input, output]
+        params = self._layer_params(yref=yref, uref=uref, u_ini=u_ini, y_ini=y_ini)
+        layer, solver_args, unbatched = self.QP_layer, {}, False
+        # Without derivatives CvxpyLayer may only solve, which takes neither mode nor n_jobs_backward
+        differentiate = torch.is_grad_enabled() and any(param.requires_grad for param in params)
+        if differentiate:
+            # The equality constraints on Hankel data are rank deficient, on which the default
+            # LSQR solve of the derivative in diffcp stops short of the exact gradient
+            solver_args["mode"] = "dense"
+        if self.n_jobs is not None and self.parallel == 'thread':
+            solver_args["n_jobs_forward"] = self.n_jobs
+            if differentiate:
+                solver_args["n_jobs_backward"] = self.n_jobs
+        elif self.n_jobs is not None:
+            if self._pool is None:
+                self._pool = LayerPool(self.QP_layer, self.n_jobs)
+            layer = self._pool
+            # The pool needs a batch dimension on every parameter, unbatched inputs are solved as a batch of one
+            sizes = [param.shape[0] for param, ndim in zip(params, self._param_ndims) if param.ndim > ndim]
+            unbatched = len(sizes) == 0
+            n_batch = max(sizes, default=1)
+            params = [param if param.ndim > ndim else param.expand(n_batch, *param.shape) for param, ndim in zip(params, self._param_ndims)]
+
+        out = self.solver_selector.run(
+            lambda solver: layer(*params, solver_args={"solve_method": solver, **solver_args})
+        )
+        if unbatched:
+            out = [o.squeeze(0) for o in out]
+        g = out[0]
+        vars = [g @ self.Uf_t.T, g @ self.Yf_t.T]
         
-        if self.stochastic_y : vars.append(out[-2])
+        if self.stochastic_y : vars.append(out[1])
         if self.stochastic_u : vars.append(out[-1])
 
-        return vars
+        return [v.to(u_ini.dtype) for v in vars]
 
-    def get_PI(self):
-        # Constant for sum_squares regularization on g
-        PI = np.vstack([self.Up, self.Yp, self.Uf])
-        PI = np.linalg.pinv(PI)@PI
-        I = np.eye(PI.shape[0])
-        return I, PI
+    def get_PI(self) -> np.ndarray:
+
+        """
+        Compact form of the projector PI = pinv([Up; Yp; Uf])@[Up; Yp; Uf] of the sum_squares regularization on g.
+        Returns the orthonormal basis V of the row space of [Up; Yp; Uf] with PI = V@V.T, kept up to date by update
+        """
+
+        if self._row_space is None:
+            self._row_space = RowSpaceBasis(np.vstack([self.Up, self.Yp, self.Uf]))
+        return self._row_space.basis
+
+    def _padded_PI(self) -> np.ndarray:
+
+        """
+        Basis of get_PI padded with zero columns to the largest possible rank of [Up; Yp; Uf],
+        so the parameter of the CvxpyLayer keeps its shape when the rank changes
+        """
+
+        V = self.get_PI()
+        rows = self.Up.shape[0] + self.Yp.shape[0] + self.Uf.shape[0]
+        padded = np.zeros((V.shape[0], min(rows, V.shape[0])))
+        padded[:,:V.shape[1]] = V
+        return padded
+
+    def update(self, u: np.ndarray, y: np.ndarray, slide=True, check=False) -> None:
+
+        """
+        Add newly measured samples to the data without constructing a new controller.
+        The Hankel blocks become views of the new data and the basis of PI is updated with a low-rank
+        modification of its SVD (see deepc_hunt.utils.RowSpaceBasis) instead of a new pinv.
+        With backend='torch' the constraint matrix of BatchQP is replaced, and if the problem keeps its
+        size the active sets of the last solve still warm start the next one. The closed form matrices
+        are recomputed from the updated SVD of [Up; Yp]. The CvxpyLayer is kept with online=True and slide=True,
+        otherwise it is compiled again for the new data, which is looked up in but not added to the cache
+        args:
+            - u : New input samples with shape (k, m), or (m,) for a single sample
+            - y : New output samples with shape (k, p), or (p,) for a single sample
+            - slide : Drop the k oldest samples, so the size of the problem stays the same,
+                otherwise the samples are appended
+            - check : Check that the new data is still persistently exciting, raises ValueError if not
+        """
+
+        if self.g_basis is not None:
+            raise ValueError('update does not support svd_rank')
+        ud, k = _extend_data(self.ud, u, self.m, slide)
+        yd, _ = _extend_data(self.yd, y, self.p, slide)
+        if check:
+            excitation = check_excitation(w=ud.reshape((-1,)), L=self.Tini+self.N+self.p, d=self.m)
+            if not excitation.exciting:
+                raise ValueError(f'Data is not persistently exciting, rank {excitation.rank} < {excitation.rows}')
+            self.excitation = excitation
+        self.ud, self.yd, self.T = ud, yd, ud.shape[0]
+        self.Up, self.Yp, self.Uf, self.Yf = _data_matrices(ud, yd, self.Tini, self.N, self.m, self.p)
+        if self._row_space is not None:
+            self._row_space.update(np.vstack([M[:,-k:] for M in (self.Up, self.Yp, self.Uf)]), slide=slide)
+        if self._past_row_space is not None:
+            self._past_row_space.update(np.vstack([M[:,-k:] for M in (self.Up, self.Yp)]), slide=slide)
+
+        device, dtype = self.Uf_t.device, torch.float64
+        self.Up_t = torch.tensor(self.Up, dtype=dtype, device=device)
+        self.Yp_t = torch.tensor(self.Yp, dtype=dtype, device=device)
+        self.Uf_t = torch.tensor(self.Uf, dtype=dtype, device=device)
+        self.Yf_t = torch.tensor(self.Yf, dtype=dtype, device=device)
+        if not self.linear:
+            self.PI_basis = torch.as_tensor(self._padded_PI(), dtype=dtype, device=device)
+        if self.closed_form is not False:
+            self._build_closed_form()
+        if self.backend == 'torch':
+            A = torch.as_tensor(self._qp_matrix(), dtype=dtype, device=device)
+            if A.shape != self.qp_A.shape:
+                self.qp = BatchQP(A, **self.qp_settings)
+            # BatchQP sets up its workspace again for the new matrix at the next solve
+            self.qp_A = A
+        elif not (self.online and slide):
+            self._build_cvxpylayer(store=False)
+            if self._pool is not None:
+                self._pool.close()
+                self._pool = None
+        self.to(device)
 
     def initialise(self, lam_y=None, lam_u=None, lam_g1=None, lam_g2=None):
         if self.lam_g1 is not None:
@@ -261,7 +689,9 @@ class npDeePC:
 
     def __init__(self, ud: np.ndarray, yd: np.ndarray, 
                  y_constraints: Tuple[np.ndarray, np.ndarray], u_constraints: Tuple[np.ndarray, np.ndarray], 
-                 N: int, Tini: int, n: int, p: int, m: int) -> None:
+                 N: int, Tini: int, n: int, p: int, m: int, svd_rank=None,
+                 solvers=None, benchmark_solvers=False, max_failures=3, cache=None, backend='cvxpy',
+                 hankel=None, online=False) -> None:
        
         """
         Initialise variables
@@ -273,9 +703,34 @@ class npDeePC:
             n = dimesnion of system
             p = output signla dimension
             m = input signal dimension
+            svd_rank = if given, g = V@z is restricted to the leading svd_rank right singular
+                vectors V of [Up; Yp; Uf; Yf] and the problem is solved for z
+            solvers = cvxpy solvers in order of preference, defaults to the installed ones of
+                CLARABEL, ECOS, OSQP and SCS. The selected solver is kept until it fails
+                max_failures times in a row, failed solves fall back to the other solvers
+            benchmark_solvers = time the solvers on a sample problem in setup() and select the fastest
+            max_failures = consecutive failures of the selected solver after which the solvers are timed again
+            cache = reuse the problem compiled at the first solve across processes through an on-disk
+                cache keyed by the problem structure and data (see deepc_hunt.cache.ProblemCache).
+                True uses the default directory, a string is the cache directory, None disables it.
+                Only used with backend='cvxpy'
+            backend = 'cvxpy' solves the CVXPY problem, 'osqp' or 'clarabel' build the sparse QP matrices once
+                and call the solver with a persistent workspace, only updating the references and initial
+                trajectory at each step (see deepc_hunt.direct.SparseQP)
+            hankel = precomputed data matrices (Up, Yp, Uf, Yf, g_basis), shared instead of built from ud and yd,
+                e.g. those of a DeePC (see from_deepc). The excitation check is then left out and svd_rank is ignored
+            online = with backend='cvxpy', the data matrices and the basis of PI enter the problem as parameters,
+                so update can slide new samples through the data without compiling the problem again.
+                The first compilation takes longer
         """
 
+        if backend not in ('cvxpy', 'osqp', 'clarabel'):
+            raise ValueError(f'Unknown backend {backend}')
+        self.backend = backend
+        self._qp = None
         self.T = ud.shape[0]
+        self.ud = ud
+        self.yd = yd
         self.Tini = Tini
         self.n = n 
         self.N = N
@@ -285,114 +740,494 @@ class npDeePC:
         self.y_upper = y_constraints[1]
         self.u_lower= u_constraints[0]
         self.u_upper = u_constraints[1]
-        self._solver_swtich = False
-        # Check for full row rank
-        H = block_hankel(w=ud.reshape((m*self.T,)), L=Tini+N+n, d=m)
-        rank = np.linalg.matrix_rank(H)
-        if rank != H.shape[0]:
-            raise ValueError('Data is not persistently exciting')
-        
-        # Construct data matrices
-        U = block_hankel(w=ud.reshape((m*self.T,)), L=Tini+N, d=m)
-        Y = block_hankel(w=yd.reshape((p*self.T,)), L=Tini+N, d=p)
-        self.Up = U[0:m*Tini,:]
-        self.Yp = Y[0:p*Tini,:]
-        self.Uf = U[Tini*m:,:]
-        self.Yf = Y[Tini*p:,:]
+        self.solver_selector = SolverSelector(
+            available_solvers(solvers or [cp.CLARABEL, cp.ECOS, cp.OSQP, cp.SCS]), max_failures=max_failures
+        )
+        self.benchmark_solvers = benchmark_solvers
+        self._requested_solver = None
+        self.cache = resolve_cache(cache)
+        self._cache_key = None
+        self.solves = 0
+        self.iterations = 0
+        if hankel is not None:
+            self.excitation = None
+            self.Up, self.Yp, self.Uf, self.Yf, self.g_basis = hankel
+        else:
+            # Check for full row rank
+            self.excitation = check_excitation(w=ud.reshape((m*self.T,)), L=Tini+N+n, d=m)
+            if not self.excitation.exciting:
+                raise ValueError(f'Data is not persistently exciting, rank {self.excitation.rank} < {self.excitation.rows}')
+
+            # Construct data matrices
+            self.Up, self.Yp, self.Uf, self.Yf = _data_matrices(ud, yd, Tini, N, m, p)
+            self.g_basis = None
+            if svd_rank is not None:
+                self.Up, self.Yp, self.Uf, self.Yf, self.g_basis = reduce_hankel(self.Up, self.Yp, self.Uf, self.Yf, svd_rank)
 
         # Initialise Optimisation variables and parameters
         self.u = cp.Variable(self.N*self.m)
-        self.g = cp.Variable(self.T-self.Tini-self.N+1)
+        self.g = cp.Variable(self.Up.shape[1])
         self.y = cp.Variable(self.N*self.p)
         self.sig_y = cp.Variable(self.Tini*self.p)
 
-        self.y_ref = cp.Parameter((self.N*self.p,))
-        self.u_ref = cp.Parameter((self.N*self.m,))
         self.u_ini = cp.Parameter(self.Tini*self.m)
         self.y_ini = cp.Parameter(self.Tini*self.p)
 
-        # Regularization Variables
-        PI = np.vstack([self.Up, self.Yp, self.Uf])
-        PI = np.linalg.pinv(PI)@PI
-        I = np.eye(PI.shape[0])
-        self.PI = I - PI
-        
-    
+        # Cost weights and regularization parameters, so one compiled problem serves any of their values.
+        # Q_sqrt@Q_sqrt = Q and the references enter weighted, q_yref = Yref@Q_sqrt with Yref of shape (N, p),
+        # since products of parameters are not DPP
+        self.Q_sqrt = cp.Parameter((self.p, self.p))
+        self.R_sqrt = cp.Parameter((self.m, self.m))
+        self.q_yref = cp.Parameter((self.N, self.p))
+        self.r_uref = cp.Parameter((self.N, self.m))
+        self.l_g1 = cp.Parameter(nonneg=True)
+        self.l_g2 = cp.Parameter(nonneg=True)
+        self.l_y = cp.Parameter(nonneg=True)
+        self._structure = None
+
+        # Regularization Variables, PI = V@V.T and g_proj = V.T@g
+        self._row_space = RowSpaceBasis(np.vstack([self.Up, self.Yp, self.Uf]))
+        self.PI_basis = self._row_space.basis
+        self.online = online
+        if online and self.g_basis is not None:
+            raise ValueError('online does not support svd_rank')
+        self._data_params = self._make_data_params() if online else None
+        self.g_proj = cp.Variable(self._data_params[-1].shape[1] if online else self.PI_basis.shape[1])
+
+    @classmethod
+    def from_deepc(cls, deepc: DeePC, **kwargs) -> 'npDeePC':
+
+        """
+        npDeePC solving the same problem as a (trained) DeePC module, set up with its current weights.
+        The Hankel blocks of deepc are shared rather than rebuilt and its excitation check is reused.
+        args:
+            deepc = DeePC module, stochastic_u is not supported by npDeePC
+            kwargs = further arguments of npDeePC, e.g. backend or solvers
+        """
+
+        if deepc.stochastic_u:
+            raise ValueError('npDeePC does not support stochastic_u')
+        kwargs.setdefault('n', deepc.p)
+        controller = cls(
+            ud=deepc.ud, yd=deepc.yd, y_constraints=(deepc.y_lower, deepc.y_upper),
+            u_constraints=(deepc.u_lower, deepc.u_upper), N=deepc.N, Tini=deepc.Tini, p=deepc.p, m=deepc.m,
+            hankel=(deepc.Up, deepc.Yp, deepc.Uf, deepc.Yf, deepc.g_basis), **kwargs
+        )
+        controller.excitation = deepc.excitation
+
+        def value(param):
+            return param.detach().cpu().double().numpy()
+
+        lams = {}
+        if not deepc.linear:
+            lams.update(lam_g1=value(deepc.lam_g1).item(), lam_g2=value(deepc.lam_g2).item())
+        if deepc.stochastic_y:
+            lams.update(lam_y=value(deepc.lam_y).item())
+        return controller.setup(Q=np.diag(value(deepc.q)), R=np.diag(value(deepc.r)), **lams)
+
     def setup(self, Q : np.array, R : np.array, lam_g1=None, lam_g2=None, lam_y=None) -> None:
        
         """
         Set up controller constraints and cost function.
-        Also used online during sim to update u_ini, y_ini, reference and regularizers
+        Regularizers passed as None are left out of the problem. The problem is only built again
+        when that changes, other calls just update the weights (see set_params).
         args:
-            ref = reference signal
-            u_ini = initial input trajectory
-            y_ini = initial output trajectory
+            Q, R = output and input cost matrices of a single time step
             lam_g1, lam_g2 = regularization params for nonlinear systems
             lam_y = regularization params for stochastic systems
         """
 
-        self.lam_y = lam_y
-        self.lam_g1 = lam_g1
-        self.lam_g2 = lam_g2
-        self.Q = np.kron(np.eye(self.N), Q)
-        self.R = np.kron(np.eye(self.N), R)
-        
-        self.cost = cp.quad_form(self.y-self.y_ref, cp.psd_wrap(self.Q)) + cp.quad_form(self.u-self.u_ref, cp.psd_wrap(self.R))
+        structure = (lam_g1 is not None, lam_g2 is not None, lam_y is not None)
+        if structure != self._structure:
+            self._build(structure)
+        self.set_params(Q=Q, R=R, lam_g1=lam_g1, lam_g2=lam_g2, lam_y=lam_y)
+        if self.benchmark_solvers and self.backend == 'cvxpy' and self.solver_selector.timings == {}:
+            # Sample problem: initial trajectory from the data, zero reference
+            self.u_ini.value, self.y_ini.value = self.Up[:,0], self.Yp[:,0]
+            self.q_yref.value, self.r_uref.value = np.zeros((self.N, self.p)), np.zeros((self.N, self.m))
+            self.solver_selector.probe(lambda solver: self._solve(solver, verbose=False, warm_start=False))
+        return self
+
+    def set_params(self, Q=None, R=None, lam_g1=None, lam_g2=None, lam_y=None) -> None:
 
+        """
+        Update the cost weights and regularization parameters of the compiled problem.
+        Weights passed as None keep their value, regularizers left out in setup cannot be set.
+        """
 
-        if self.lam_y != None:
-            self.cost += cp.norm(self.sig_y, 1)*self.lam_y
+        for name, lam in (('lam_g1', lam_g1), ('lam_g2', lam_g2), ('lam_y', lam_y)):
+            if lam is None:
+                continue
+            if getattr(self, name) is None:
+                raise ValueError(f'{name} is not part of the problem, pass it to setup() first')
+            setattr(self, name, lam)
+            getattr(self, 'l' + name[3:]).value = lam
+        if Q is not None:
+            self.Q = np.kron(np.eye(self.N), Q)
+            self.Q_sqrt.value = psd_sqrt(Q)
+        if R is not None:
+            self.R = np.kron(np.eye(self.N), R)
+            self.R_sqrt.value = psd_sqrt(R)
+        if self._qp is not None:
+            # The weights are part of the matrices of the direct backend
+            self._update_direct()
+
+    def _build(self, structure: tuple) -> None:
+
+        """
+        Build the problem with the regularizers in structure = (lam_g1, lam_g2, lam_y present)
+        """
+
+        self._structure = structure
+        has_g1, has_g2, has_y = structure
+        # Values are set by set_params, None marks the regularizers left out
+        self.lam_g1, self.lam_g2, self.lam_y = (0 if present else None for present in structure)
+        if self.backend != 'cvxpy':
+            # Other regularizers change the rows of the direct backend, which is written again at the next solve
+            self._qp = None
+            return
+
+        if self.cache is not None:
+            key = ProblemCache.key(
+                'npDeePC', self.N, self.p, self.m, self.Tini, structure, self.online,
+                self.Up, self.Yp, self.Uf, self.Yf, self.g_basis,
+                *(np.asarray(b) for b in (self.u_lower, self.u_upper, self.y_lower, self.y_upper))
+            )
+            entry = self.cache.load(key)
+            if entry is not None:
+                (self.problem, self.u, self.g, self.y, self.sig_y, self.u_ini, self.y_ini,
+                 self.Q_sqrt, self.R_sqrt, self.q_yref, self.r_uref, self.l_g1, self.l_g2, self.l_y, self._data_params) = entry
+                self.cost, self.constraints = self.problem.objective.args[0], self.problem.constraints
+                self._problem_data()
+                return
+            # Stored once the first solve has compiled the problem
+            self._cache_key = key
+
+        Up, Yp, Uf, Yf, V = self._problem_data()
+        # quad_form of a parameter-affine expression is not DPP, which would recompile the problem at every solve
+        Y = cp.reshape(self.y, (self.N, self.p), order='C')
+        U = cp.reshape(self.u, (self.N, self.m), order='C')
+        self.cost = cp.sum_squares(Y@self.Q_sqrt - self.q_yref) + cp.sum_squares(U@self.R_sqrt - self.r_uref)
+
+
+        if has_y:
+            self.cost += cp.norm(self.sig_y, 1)*self.l_y
             self.constraints = [
-                self.Up@self.g == self.u_ini,
-                self.Yp@self.g == self.y_ini + self.sig_y,
-                self.Uf@self.g == self.u,
-                self.Yf@self.g == self.y,
+                Up@self.g == self.u_ini,
+                Yp@self.g == self.y_ini + self.sig_y,
+                Uf@self.g == self.u,
+                Yf@self.g == self.y,
                 self.u <= self.u_upper, self.u >= self.u_lower,
                 self.y <= self.y_upper, self.y >= self.y_lower
             ]
         else:
             self.constraints = [
-                self.Up@self.g == self.u_ini,
-                self.Yp@self.g == self.y_ini,
-                self.Uf@self.g == self.u,
-                self.Yf@self.g == self.y,
+                Up@self.g == self.u_ini,
+                Yp@self.g == self.y_ini,
+                Uf@self.g == self.u,
+                Yf@self.g == self.y,
                 self.u <= self.u_upper, self.u >= self.u_lower,
                 self.y <= self.y_upper, self.y >= self.y_lower
             ]
 
-        if self.lam_g1 != None:
-            self.cost += cp.sum_squares(self.PI@self.g)*lam_g1 
-        if self.lam_g2 != None:
-            self.cost += cp.norm(self.g, 1)*lam_g2
-        assert self.cost.is_dpp
+        if has_g1:
+            # (I - PI)@g without the dense n x n matrix I - PI
+            if self.online:
+                # l_g1 times an expression in the parameter V is not DPP, so the residual is a variable
+                g_perp = cp.Variable(self.g.shape)
+                self.cost += cp.sum_squares(g_perp)*self.l_g1
+                self.constraints.append(g_perp == self.g - V@self.g_proj)
+            else:
+                self.cost += cp.sum_squares(self.g - V@self.g_proj)*self.l_g1
+            self.constraints.append(V.T@self.g == self.g_proj)
+        if has_g2:
+            g = self.g if self.g_basis is None else self.g_basis@self.g
+            self.cost += cp.norm(g, 1)*self.l_g2
+        assert self.cost.is_dpp()
 
         self.problem = cp.Problem(cp.Minimize(self.cost), self.constraints)
-        return self
 
-    def solve(self, y_ref, u_ref, u_ini, y_ini, verbose=False, solver=cp.MOSEK) -> np.ndarray:
+    def _make_data_params(self) -> list:
+
+        """
+        Parameters of Up, Yp, Uf, Yf and of the basis of PI for online=True. The basis has as many columns
+        as the largest possible rank of [Up; Yp; Uf] and is padded with zeros, so its rank may change
+        """
+
+        rows = self.Up.shape[0] + self.Yp.shape[0] + self.Uf.shape[0]
+        shapes = [M.shape for M in (self.Up, self.Yp, self.Uf, self.Yf)] + [(self.Up.shape[1], min(rows, self.Up.shape[1]))]
+        return [cp.Parameter(shape) for shape in shapes]
+
+    def _problem_data(self) -> tuple:
+
+        """
+        Up, Yp, Uf, Yf and the basis of PI as they enter the CVXPY problem, the arrays themselves
+        or, with online=True, their parameters set to the current values
+        """
+
+        if not self.online:
+            return self.Up, self.Yp, self.Uf, self.Yf, self.PI_basis
+        V = np.zeros(self._data_params[-1].shape)
+        V[:,:self.PI_basis.shape[1]] = self.PI_basis
+        for param, value in zip(self._data_params, (self.Up, self.Yp, self.Uf, self.Yf, V)):
+            param.value = value
+        return tuple(self._data_params)
+
+    def update(self, u: np.ndarray, y: np.ndarray, slide=True, check=False) -> None:
+
+        """
+        Add newly measured samples to the data without constructing a new controller.
+        The Hankel blocks become views of the new data and the basis of PI is updated with a low-rank
+        modification of its SVD (see deepc_hunt.utils.RowSpaceBasis) instead of a new pinv.
+        With online=True and slide=True the compiled problem is kept and only its data parameters change,
+        otherwise the problem is built again for the new data and compiled at the next solve.
+        The direct backends copy the new matrices into the solver workspace, as long as the problem keeps its size
+        and sparsity pattern, otherwise the workspace is set up again at the next solve.
+        The weights set by setup are kept.
+        args:
+            u = new input samples with shape (k, m), or (m,) for a single sample
+            y = new output samples with shape (k, p), or (p,) for a single sample
+            slide = drop the k oldest samples, so the size of the problem stays the same,
+                otherwise the samples are appended
+            check = check that the new data is still persistently exciting, raises ValueError if not
+        """
+
+        if self.g_basis is not None:
+            raise ValueError('update does not support svd_rank')
+        ud, k = _extend_data(self.ud, u, self.m, slide)
+        yd, _ = _extend_data(self.yd, y, self.p, slide)
+        if check:
+            excitation = check_excitation(w=ud.reshape((-1,)), L=self.Tini+self.N+self.n, d=self.m)
+            if not excitation.exciting:
+                raise ValueError(f'Data is not persistently exciting, rank {excitation.rank} < {excitation.rows}')
+            self.excitation = excitation
+        self.ud, self.yd, self.T = ud, yd, ud.shape[0]
+        self.Up, self.Yp, self.Uf, self.Yf = _data_matrices(ud, yd, self.Tini, self.N, self.m, self.p)
+        self.PI_basis = self._row_space.update(np.vstack([M[:,-k:] for M in (self.Up, self.Yp, self.Uf)]), slide=slide)
+
+        if self.backend != 'cvxpy':
+            if self._qp is not None:
+                self._update_direct()
+            return
+        if self._structure is None:
+            return
+        if self.online and slide:
+            self._problem_data()
+            return
+        self.g = cp.Variable(self.Up.shape[1])
+        if self.online:
+            self._data_params = self._make_data_params()
+        self.g_proj = cp.Variable(self._data_params[-1].shape[1] if self.online else self.PI_basis.shape[1])
+        Q_sqrt, R_sqrt = self.Q_sqrt.value, self.R_sqrt.value
+        lams = dict(lam_g1=self.lam_g1, lam_g2=self.lam_g2, lam_y=self.lam_y)
+        self._build(self._structure)
+        self.Q_sqrt.value, self.R_sqrt.value = Q_sqrt, R_sqrt
+        self.set_params(**lams)
+
+    def _build_direct(self) -> None:
+
+        """
+        Write the problem of _build as a SparseQP over x = [g, e_u, e_y, sig_y, t_y, g_proj, s_g], where
+        e_u = u - u_ref and e_y = y - y_ref are the tracking errors, t_y >= |sig_y| and s_g >= |g| are the
+        epigraph variables of the norm1 regularizers and g_proj = V.T@g as in _build.
+        The references and the initial trajectory only enter the bounds, so q stays fixed, and
+        writing the cost in the errors keeps the objective at the scale of the tracking cost.
+        """
+
+        has_g1, has_g2, has_y = self._structure
+        N, p, m, Tini = self.N, self.p, self.m, self.Tini
+        V = self.PI_basis
+        B = np.eye(self.Up.shape[1]) if self.g_basis is None else self.g_basis
+        sizes = {'g': self.Up.shape[1], 'e_u': N*m, 'e_y': N*p,
+                 'sig_y': Tini*p*has_y, 't_y': Tini*p*has_y, 'g_proj': V.shape[1]*has_g1, 's_g': B.shape[0]*has_g2}
+        offsets = np.cumsum([0] + list(sizes.values()))
+        self._x = {name: slice(offsets[i], offsets[i + 1]) for i, name in enumerate(sizes)}
+        n_x = offsets[-1]
+
+        def block(rows: int, **cols) -> sp.csr_matrix:
+            # Constraint rows with the given matrices in the columns of the named variables
+            return sp.hstack([sp.csr_matrix(cols[name])
+                              if name in cols else sp.csr_matrix((rows, size)) for name, size in sizes.items()], format='csr')
+
+        # Cost
+        P = sp.lil_matrix((n_x, n_x))
+        P[self._x['e_u'], self._x['e_u']] = 2*self.R
+        P[self._x['e_y'], self._x['e_y']] = 2*self.Q
+        q = np.zeros(n_x)
+        if has_g1:
+            P[self._x['g'], self._x['g']] = 2*self.lam_g1*np.eye(sizes['g'])
+            P[self._x['g'], self._x['g_proj']] = -2*self.lam_g1*V
+            P[self._x['g_proj'], self._x['g']] = -2*self.lam_g1*V.T
+            P[self._x['g_proj'], self._x['g_proj']] = 2*self.lam_g1*np.eye(sizes['g_proj'])
+        if has_y:
+            q[self._x['t_y']] = self.lam_y
+        if has_g2:
+            q[self._x['s_g']] = self.lam_g2
+
+        # Constraints and the rows whose bounds change at every step:
+        # Up@g == u_ini, Yp@g - sig_y == y_ini, Uf@g - e_u == u_ref, Yf@g - e_y == y_ref,
+        # u_lower - u_ref <= e_u <= u_upper - u_ref and y_lower - y_ref <= e_y <= y_upper - y_ref
+        blocks = [
+            ('u_ini', block(Tini*m, g=self.Up), 0, 0),
+            ('y_ini', block(Tini*p, g=self.Yp, sig_y=-sp.eye(Tini*p)) if has_y else block(Tini*p, g=self.Yp), 0, 0),
+            ('u_ref', block(N*m, g=self.Uf, e_u=-sp.eye(N*m)), 0, 0),
+            ('y_ref', block(N*p, g=self.Yf, e_y=-sp.eye(N*p)), 0, 0),
+            ('u_box', block(N*m, e_u=sp.eye(N*m)), self.u_lower, self.u_upper),
+            ('y_box', block(N*p, e_y=sp.eye(N*p)), self.y_lower, self.y_upper),
+        ]
+        if has_g1:
+            blocks.append(('g_proj', block(sizes['g_proj'], g=V.T, g_proj=-sp.eye(sizes['g_proj'])), 0, 0))
+        for name, abs_name, M in (('sig_y', 't_y', sp.eye(Tini*p)), ('g', 's_g', B)):
+            if sizes[abs_name] == 0:
+                continue
+            # -t <= M@x <= t
+            I_t = sp.eye(sizes[abs_name])
+            blocks.append((abs_name + '_upper', block(sizes[abs_name], **{name: M, abs_name: -I_t}), -np.inf, 0))
+            blocks.append((abs_name + '_lower', block(sizes[abs_name], **{name: M, abs_name: I_t}), 0, np.inf))
+
+        offsets = np.cumsum([0] + [M.shape[0] for _, M, _, _ in blocks])
+        self._rows = {name: slice(offsets[i], offsets[i + 1]) for i, (name, _, _, _) in enumerate(blocks)}
+        self._q = q
+        self._l = np.concatenate([np.broadcast_to(lower, (M.shape[0],)) for _, M, lower, _ in blocks]).astype(float)
+        self._u = np.concatenate([np.broadcast_to(upper, (M.shape[0],)) for _, M, _, upper in blocks]).astype(float)
+        self._qp = SparseQP(P, sp.vstack([M for _, M, _, _ in blocks]), self._l, self._u, solver=self.backend)
+
+    def _update_direct(self) -> None:
+
+        """
+        Write the problem of the direct backend again and copy its matrices into the solver workspace, which keeps
+        its warm start and, with an unchanged sparsity pattern, its setup. A problem of another size gets a new one
+        """
+
+        qp = self._qp
+        self._build_direct()
+        if (qp.n, qp.k) == (self._qp.n, self._qp.k):
+            qp.update_matrices(P=self._qp.P, A=self._qp.A)
+            self._qp = qp
+
+    def _solve_direct(self, y_ref, u_ref, u_ini, y_ini, warm_start: bool) -> Tuple[np.ndarray, np.ndarray]:
+        if self._qp is None:
+            self._build_direct()
+        u_ref, y_ref = np.asarray(u_ref, dtype=float), np.asarray(y_ref, dtype=float)
+        l, u, rows = self._l.copy(), self._u.copy(), self._rows
+        l[rows['u_ini']] = u[rows['u_ini']] = u_ini
+        l[rows['y_ini']] = u[rows['y_ini']] = y_ini
+        l[rows['u_ref']] = u[rows['u_ref']] = u_ref
+        l[rows['y_ref']] = u[rows['y_ref']] = y_ref
+        l[rows['u_box']] -= u_ref
+        u[rows['u_box']] -= u_ref
+        l[rows['y_box']] -= y_ref
+        u[rows['y_box']] -= y_ref
+        x0 = None
+        if warm_start == 'shift' and self._qp.x is not None:
+            x0 = self._shifted_solution(y_ref, u_ref, y_ini)
+        iterations = self._qp.iterations
+        x = self._qp.solve(self._q, l, u, warm_start=bool(warm_start), x0=x0)
+        self.solves += 1
+        self.iterations += self._qp.iterations - iterations
+        action = x[self._x['e_u']][:self.m] + u_ref[:self.m]
+        obs = x[self._x['e_y']] + y_ref
+        return action, obs
+
+    def _shifted_solution(self, y_ref: np.ndarray, u_ref: np.ndarray, y_ini: np.ndarray) -> np.ndarray:
+
+        """
+        Previous solution of the SparseQP shifted by one time step. Shifting a trajectory of the Hankel
+        matrix by one step shifts its combination of columns, g_j -> g_(j-1), and the other variables are
+        set to their values at the shifted g, so the equality rows hold for the new u_ini, y_ini and references
+        """
+
+        has_g1, has_g2, has_y = self._structure
+        x = self._qp.x.copy()
+        g = x[self._x['g']] if self.g_basis is None else self.g_basis@x[self._x['g']]
+        g = np.concatenate([[0.0], g[:-1]])
+        if self.g_basis is not None:
+            g = self.g_basis.T@g
+        x[self._x['g']] = g
+        x[self._x['e_u']] = self.Uf@g - u_ref
+        x[self._x['e_y']] = self.Yf@g - y_ref
+        if has_y:
+            x[self._x['sig_y']] = self.Yp@g - y_ini
+            x[self._x['t_y']] = np.abs(x[self._x['sig_y']])
+        if has_g1:
+            x[self._x['g_proj']] = self.PI_basis.T@g
+        if has_g2:
+            x[self._x['s_g']] = np.abs(g if self.g_basis is None else self.g_basis@g)
+        return x
+
+    def _solve(self, solver: str, verbose: bool, warm_start: bool) -> None:
+        self.problem.solve(solver=solver, verbose=verbose, warm_start=warm_start)
+        if self.problem.status not in cp.settings.SOLUTION_PRESENT:
+            raise cp.SolverError(f'{solver} returned status {self.problem.status}')
+        if self._cache_key is not None:
+            # The solver workspaces cannot be pickled
+            solver_cache, self.problem._solver_cache = self.problem._solver_cache, {}
+            self.cache.store(self._cache_key, (self.problem, self.u, self.g, self.y, self.sig_y, self.u_ini, self.y_ini,
+                                               self.Q_sqrt, self.R_sqrt, self.q_yref, self.r_uref, self.l_g1, self.l_g2, self.l_y,
+                                               self._data_params))
+            self.problem._solver_cache = solver_cache
+            self._cache_key = None
+
+    def solve(self, y_ref, u_ref, u_ini, y_ini, verbose=False, solver=None, warm_start=True) -> np.ndarray:
         
         """
         Call once the controller is set up with relevenat parameters.
         Returns the first action of input sequence.
         args:
-            solver = cvxpy solver, best is MOSEK but other good options are cp.ECOS, cp.CLARABEL and cp.OSQP
+            solver = cvxpy solver to select, e.g. cp.CLARABEL, cp.OSQP or cp.MOSEK if installed,
+                None keeps the solver picked by the solver selector
             verbose = bool for printing status of solver
+            warm_start = reuse the solver workspace and start from the previous solution
+                (for solvers that support it, e.g. OSQP and SCS). With backend='osqp', 'shift'
+                starts from the previous solution shifted by one time step (see _shifted_solution)
+        With backend='osqp' or 'clarabel' that solver is always used and solver is ignored.
         """
-        if not self._solver_switch: self._solver = solver
-        self.y_ref.value = y_ref
-        self.u_ref.value = u_ref
+        if self.backend != 'cvxpy':
+            return self._solve_direct(y_ref, u_ref, u_ini, y_ini, warm_start)
+        if solver is not None and solver != self._requested_solver:
+            self.solver_selector.select(solver)
+            self._requested_solver = solver
+        self.q_yref.value = np.reshape(y_ref, (self.N, self.p))@self.Q_sqrt.value
+        self.r_uref.value = np.reshape(u_ref, (self.N, self.m))@self.R_sqrt.value
         self.u_ini.value = u_ini
         self.y_ini.value = y_ini
-        try:
-            self.problem.solve(solver=self._solver, verbose=verbose)
-        except:
-            # MOSEK requires license, switch if error occurs
-            # License is free for academics
-            self._solver_switch = True
-            self._solver = cp.ECOS
-        action = self.problem.variables()[1].value[:self.m]
-        obs = self.problem.variables()[0].value # For imitation loss
+        self.solver_selector.run(lambda solver: self._solve(solver, verbose=verbose, warm_start=warm_start))
+        self.solves += 1
+        self.iterations += self.problem.solver_stats.num_iters or 0
+        action = self.u.value[:self.m]
+        obs = self.y.value # For imitation loss
         return action, obs
+
+    def sweep(self, settings: list, y_ref, u_ref, u_ini, y_ini, solver=None, warm_start=True) -> list:
+
+        """
+        Solve the same step for many hyperparameter settings with the one compiled problem.
+        The direct backends copy the weights into their solver workspace instead of setting it up again.
+        The weights active before the sweep are restored afterwards, also when a setting raises.
+        args:
+            settings = list of dicts with keys among Q, R, lam_g1, lam_g2, lam_y (see set_params),
+                missing keys keep the value from before the sweep
+            y_ref, u_ref, u_ini, y_ini, solver, warm_start = as in solve
+        Returns : list of (action, obs), one per setting
+        """
+
+        weights = (self.Q_sqrt.value, self.R_sqrt.value, self.Q, self.R)
+        lams = dict(lam_g1=self.lam_g1, lam_g2=self.lam_g2, lam_y=self.lam_y)
+
+        def restore():
+            self.Q_sqrt.value, self.R_sqrt.value, self.Q, self.R = weights
+
+        results = []
+        try:
+            for setting in settings:
+                restore()
+                self.set_params(**{**lams, **setting})
+                results.append(self.solve(y_ref=y_ref, u_ref=u_ref, u_ini=u_ini, y_ini=y_ini,
+                                          solver=solver, warm_start=warm_start))
+        finally:
+            restore()
+            self.set_params(**lams)
+        return results
     
 class npMPC:
 
@@ -401,7 +1236,8 @@ class npMPC:
     """
 
     def __init__(self, A: np.ndarray, B: np.ndarray, Q: np.ndarray, R: np.ndarray, N: int, 
-                 u_constraints: Tuple[np.ndarray,np.ndarray], y_constraints: Tuple[np.ndarray,np.ndarray]) -> None:
+                 u_constraints: Tuple[np.ndarray,np.ndarray], y_constraints: Tuple[np.ndarray,np.ndarray],
+                 backend='cvxpy', formulation='sparse') -> None:
         
         """
         (A,B): Linear system Matrices
@@ -413,8 +1249,22 @@ class npMPC:
         y_constraints: have shape (2, dimension of state)
             - y_constraints[0] should contain lower box constraints
             - y_constraints[1] should contain upper box constraints
+        backend: 'cvxpy' solves the CVXPY problem, 'osqp' or 'clarabel' build the sparse QP matrices once
+            and call the solver with a persistent workspace (see deepc_hunt.direct.SparseQP)
+        formulation: 'sparse' keeps the states as variables with the dynamics as equality constraints,
+            'condensed' eliminates them with the prediction matrices y = Phi@y_ini + Gamma@u.
+            The condensed problem only has the N*m inputs as variables, but the bounds on y[:p] = y_ini
+            are constant and are dropped
         """
         
+        if backend not in ('cvxpy', 'osqp', 'clarabel'):
+            raise ValueError(f'Unknown backend {backend}')
+        if formulation not in ('sparse', 'condensed'):
+            raise ValueError(f'Unknown formulation {formulation}')
+        self.backend = backend
+        self.formulation = formulation
+        self._qp = None
+        self._batch_qp = None
         self.N = N
         self.p = B.shape[0] 
         self.N = N
@@ -425,8 +1275,9 @@ class npMPC:
         self.u_upper = u_constraints[1]
         self.A = cp.Parameter(A.shape)
         self.B = cp.Parameter(B.shape)
-        self.Q = Q
-        self.R = R
+        # Block diagonal weights over the horizon, so setup and solve_many can be called in any order
+        self.Q = np.kron(np.eye(N), Q)
+        self.R = np.kron(np.eye(N), R)
         self.A.value = A
         self.B.value = B
         # Initialise Optimisation variables and parameters
@@ -435,41 +1286,223 @@ class npMPC:
         self.y_ref = cp.Parameter((self.N*self.p,))
         self.u_ref = cp.Parameter((self.N*self.m,))
         self.y_ini = cp.Parameter(self.p)
+        self.solves = 0
+        self.iterations = 0
+
+    def prediction_matrices(self) -> Tuple[np.ndarray, np.ndarray]:
+
+        """
+        Prediction matrices of the outputs over the horizon, y = Phi@y_ini + Gamma@u with
+        y_i = A^i y_ini + sum_{j<i} A^(i-1-j) B u_j
+        Returns :
+            Phi : shape (N*p, p)
+            Gamma : Block lower triangular, shape (N*p, N*m)
+        """
+
+        N, p, m = self.N, self.p, self.m
+        A, B = self.A.value, self.B.value
+        Phi = np.zeros((N*p, p))
+        Gamma = np.zeros((N*p, N*m))
+        Phi[:p] = np.eye(p)
+        # AkB[k] = A^k B fills the k-th block subdiagonal of Gamma
+        AkB = B
+        for i in range(1, N):
+            Phi[p*i:p*(i+1)] = A@Phi[p*(i-1):p*i]
+            for j in range(N-i):
+                Gamma[p*(i+j):p*(i+j+1), m*j:m*(j+1)] = AkB
+            AkB = A@AkB
+        return Phi, Gamma
 
     def setup(self):
         """
         Call once to initialise the optimisation problem.
         """
 
-        self.Q = np.kron(np.eye(self.N), self.Q)
-        self.R = np.kron(np.eye(self.N), self.R)
-        self.cost = cp.quad_form(self.y-self.y_ref, cp.psd_wrap(self.Q)) + cp.quad_form(self.u-self.u_ref, cp.psd_wrap(self.R))
-        
-        self.constraints = [
-            self.y[:self.p] == self.y_ini,
-            self.u <= self.u_upper, self.u >= self.u_lower,
-            self.y <= self.y_upper, self.y >= self.y_lower
-        ]
+        N, p, m = self.N, self.p, self.m
+        y_lower = np.broadcast_to(self.y_lower, (N*p,))
+        y_upper = np.broadcast_to(self.y_upper, (N*p,))
 
-        for i in range(1,self.N):
-            self.constraints.append(
-                self.y[self.p*i:self.p*(i+1)] == self.A@self.y[self.p*(i-1):self.p*i] + self.B@self.u[self.m*(i-1):self.m*i]
-            )
+        if self.formulation == 'condensed':
+            self.Phi, self.Gamma = self.prediction_matrices()
+            self.y = self.Phi@self.y_ini + self.Gamma@self.u
+            self.constraints = [self.y[p:] <= y_upper[p:], self.y[p:] >= y_lower[p:]]
+        else:
+            self.constraints = [
+                self.y[:p] == self.y_ini,
+                self.y <= self.y_upper, self.y >= self.y_lower
+            ]
+            if N > 1:
+                # Dynamics of all steps as one matrix constraint on the column-stacked trajectories
+                Y = cp.reshape(self.y, (p, N), order='F')
+                U = cp.reshape(self.u, (m, N), order='F')
+                self.constraints.append(Y[:, 1:] == self.A@Y[:, :-1] + self.B@U[:, :-1])
+        self.constraints += [self.u <= self.u_upper, self.u >= self.u_lower]
 
+        # sum_squares of the square root factors keeps the problem DPP, so it is only compiled once
+        self.cost = cp.sum_squares(psd_sqrt(self.Q)@(self.y - self.y_ref)) + cp.sum_squares(psd_sqrt(self.R)@(self.u - self.u_ref))
         self.problem = cp.Problem(cp.Minimize(self.cost), self.constraints)
         return self
     
     def solve(self, y_ref: np.ndarray, u_ref: np.ndarray, y_ini: np.ndarray, 
-              u_ini=None, verbose=False, solver=cp.OSQP) -> np.ndarray:
+              u_ini=None, verbose=False, solver=cp.OSQP, warm_start=True) -> np.ndarray:
         """
         Call to solve the MPC problem.
         y_ref, u_ref, y_ini are instatiated as parameters of the optimisation problem. 
         They only need to be passed to the solver rather than calling setup() again.
+        With warm_start, the solver workspace is reused and started from the previous solution.
+        With backend='osqp', warm_start='shift' starts from the previous solution shifted by one
+        time step, with the last input and output repeated.
+        With backend='osqp' or 'clarabel' that solver is always used and solver is ignored.
         """
+        if self.backend != 'cvxpy':
+            return self._solve_direct(y_ref, u_ref, y_ini, warm_start)
         self.y_ref.value = y_ref
         self.u_ref.value = u_ref
         self.y_ini.value = y_ini
-        self.problem.solve(solver=solver, verbose=verbose)
-        action = self.problem.variables()[1].value[:self.m]
-        obs = self.problem.variables()[0].value # For imitation loss
-        return action, obs
\ No newline at end of file
+        self.problem.solve(solver=solver, verbose=verbose, warm_start=warm_start)
+        self.solves += 1
+        self.iterations += self.problem.solver_stats.num_iters or 0
+        if self.u.value is None:
+            raise cp.SolverError(f'{solver} returned status {self.problem.status}')
+        action = self.u.value[:self.m]
+        obs = self.y.value # For imitation loss
+        return action, obs
+
+    def solve_many(self, y_ini: np.ndarray, y_ref: np.ndarray, u_ref: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+
+        """
+        Solve the MPC problem for a batch of initial states at once.
+        The condensed problem is solved with the batched interior point solver of deepc_hunt.qp,
+        which shares the cost and constraint matrices and the KKT factorizations between the
+        batch elements and across calls. Independent of backend and formulation, and like the
+        condensed formulation it drops the bounds on y[:p] = y_ini.
+        args:
+            y_ini = Initial states with shape (batch, p)
+            y_ref, u_ref = References with shape (N*p,) and (N*m,), or with a leading batch dimension
+        Returns :
+            action : First inputs with shape (batch, m)
+            obs : Predicted outputs with shape (batch, N*p)
+        """
+
+        if self._batch_qp is None:
+            P, A = self._condensed_matrices()
+            self._batch_qp = BatchQP(torch.tensor(A.toarray()))
+            self._batch_P = torch.tensor(P.toarray())
+        y_ini = np.atleast_2d(y_ini)
+        obs, q, l, u = self._condensed_vectors(y_ini, y_ref, u_ref)
+        iterations = self._batch_qp.iterations
+        with torch.no_grad():
+            e_u = self._batch_qp(self._batch_P, torch.tensor(q), torch.tensor(l), torch.tensor(u)).numpy()
+        self.solves += y_ini.shape[0]
+        self.iterations += self._batch_qp.iterations - iterations
+        u_opt = e_u + np.broadcast_to(u_ref, (y_ini.shape[0], self.N*self.m))
+        obs = obs + u_opt@self.Gamma.T
+        return u_opt[:, :self.m], obs
+
+    def _condensed_matrices(self) -> Tuple[sp.spmatrix, sp.spmatrix]:
+
+        """
+        Cost and constraint matrices of the condensed QP in the input errors e_u = u - u_ref,
+        P = 2(R + Gamma'Q Gamma) and A = [I; Gamma[p:]]
+        """
+
+        if not hasattr(self, 'Gamma'):
+            self.Phi, self.Gamma = self.prediction_matrices()
+        P = 2*(self.R + self.Gamma.T@self.Q@self.Gamma)
+        A = sp.vstack([sp.eye(self.N*self.m), sp.csr_matrix(self.Gamma[self.p:])], format='csc')
+        return sp.csc_matrix(P), A
+
+    def _condensed_vectors(self, y_ini: np.ndarray, y_ref: np.ndarray, u_ref: np.ndarray) -> tuple:
+
+        """
+        Vectors of the condensed QP for a batch of initial states. With e_u = u - u_ref the outputs
+        are y = Gamma@e_u + c + y_ref with c = Phi@y_ini + Gamma@u_ref - y_ref
+        Returns : y_free, the outputs without the inputs Phi@y_ini, and q, l, u with a batch dimension
+        """
+
+        N, p, m = self.N, self.p, self.m
+        n_batch = y_ini.shape[0]
+        y_ref = np.broadcast_to(y_ref, (n_batch, N*p))
+        u_ref = np.broadcast_to(u_ref, (n_batch, N*m))
+        y_free = y_ini@self.Phi.T
+        c = y_free + u_ref@self.Gamma.T - y_ref
+        q = 2*(c@self.Q)@self.Gamma
+        y_lower = np.broadcast_to(self.y_lower, (N*p,))[p:] - (c + y_ref)[:, p:]
+        y_upper = np.broadcast_to(self.y_upper, (N*p,))[p:] - (c + y_ref)[:, p:]
+        l = np.concatenate([np.broadcast_to(self.u_lower, (N*m,)) - u_ref, y_lower], axis=1)
+        u = np.concatenate([np.broadcast_to(self.u_upper, (N*m,)) - u_ref, y_upper], axis=1)
+        return y_free, q, l, u
+
+    def _build_direct(self) -> None:
+
+        """
+        Write the problem of setup as a SparseQP in the tracking errors e_u = u - u_ref, e_y = y - y_ref.
+        Sparse formulation, x = [e_u, e_y]: the equality rows G@[u; y] == h (initial state and dynamics)
+        become G@x == h - G@[u_ref; y_ref], so the references and the initial state only enter the bounds
+        and q stays zero. Condensed formulation, x = e_u: see _condensed_vectors.
+        """
+
+        N, p, m = self.N, self.p, self.m
+        if self.formulation == 'condensed':
+            P, A = self._condensed_matrices()
+            _, q, l, u = self._condensed_vectors(np.zeros((1, p)), np.zeros(N*p), np.zeros(N*m))
+            self._qp = SparseQP(P, A, l[0], u[0], solver=self.backend)
+            return
+
+        A, B = self.A.value, self.B.value
+        n_u = N*m
+
+        # G@[u; y] == [y_ini; 0]
+        G = sp.lil_matrix((N*p, n_u + N*p))
+        G[:p, n_u:n_u + p] = np.eye(p)
+        for i in range(1, N):
+            G[p*i:p*(i+1), n_u + p*i:n_u + p*(i+1)] = np.eye(p)
+            G[p*i:p*(i+1), n_u + p*(i-1):n_u + p*i] = -A
+            G[p*i:p*(i+1), m*(i-1):m*i] = -B
+        self._G = G.tocsr()
+
+        P = sp.block_diag([2*self.R, 2*self.Q], format='csc')
+        self._l = np.concatenate([np.zeros(N*p), np.broadcast_to(self.u_lower, (n_u,)), np.broadcast_to(self.y_lower, (N*p,))]).astype(float)
+        self._u = np.concatenate([np.zeros(N*p), np.broadcast_to(self.u_upper, (n_u,)), np.broadcast_to(self.y_upper, (N*p,))]).astype(float)
+        self._q = np.zeros(n_u + N*p)
+        self._qp = SparseQP(P, sp.vstack([self._G, sp.eye(n_u + N*p)]), self._l, self._u, solver=self.backend)
+
+    def _solve_direct(self, y_ref, u_ref, y_ini, warm_start: bool) -> Tuple[np.ndarray, np.ndarray]:
+        if self._qp is None:
+            self._build_direct()
+        N, p, m = self.N, self.p, self.m
+        iterations = self._qp.iterations
+        shift = warm_start == 'shift' and self._qp.x is not None
+        warm_start = bool(warm_start)
+
+        def shifted(v, d):
+            # Trajectory v of the previous solution shifted by one step, the last step repeated
+            return np.concatenate([v[d:], v[-d:]])
+
+        if self.formulation == 'condensed':
+            u_ref = np.broadcast_to(u_ref, (N*m,)).astype(float)
+            y_free, q, l, u = self._condensed_vectors(np.asarray(y_ini, dtype=float)[None], y_ref, u_ref)
+            x0 = shifted(self._u_opt, m) - u_ref if shift else None
+            x = self._qp.solve(q[0], l[0], u[0], warm_start=warm_start, x0=x0)
+            u_opt = x + u_ref
+            obs = y_free[0] + self.Gamma@u_opt
+        else:
+            ref = np.concatenate([np.broadcast_to(u_ref, (N*m,)), np.broadcast_to(y_ref, (N*p,))]).astype(float)
+            h = -self._G@ref
+            h[:p] += y_ini
+            l, u = self._l.copy(), self._u.copy()
+            l[:N*p] = u[:N*p] = h
+            l[N*p:] -= ref
+            u[N*p:] -= ref
+            x0 = None
+            if shift:
+                x0 = np.concatenate([shifted(self._u_opt, m), np.asarray(y_ini, dtype=float), shifted(self._obs, p)[p:]]) - ref
+            x = self._qp.solve(self._q, l, u, warm_start=warm_start, x0=x0)
+            u_opt = x[:N*m] + ref[:N*m]
+            obs = x[N*m:] + ref[N*m:]
+
+        self.solves += 1
+        self.iterations += self._qp.iterations - iterations
+        self._u_opt, self._obs = u_opt, obs
+        action = u_opt[:m]
+        return action, obs # obs for imitation loss
@@ -0,0 +1,160 @@
+import io
+import time
+import contextlib
+import numpy as np
+import scipy.sparse as sp
+import cvxpy as cp
+
+
+class SparseQP:
+
+    """
+    Sparse quadratic program
+
+        minimize    1/2 x'Px + q'x
+        subject to  l <= Ax <= u
+
+    solved through the low-level API of OSQP or Clarabel with a persistent workspace.
+    P and A are fixed when the workspace is set up (see update_matrices to change their values),
+    every solve only copies the vectors q, l and u into it, so a receding horizon controller skips the CVXPY
+    canonicalization and parameter updates. OSQP starts each solve from the previous
+    solution (kept in x), or from an initial guess such as the previous solution shifted
+    by one time step. Which rows are equalities (l == u) and which bounds are finite must stay
+    the same between solves, it is taken from the l and u passed at construction.
+    """
+
+    def __init__(self, P: sp.spmatrix, A: sp.spmatrix, l: np.ndarray, u: np.ndarray,
+                 solver='OSQP', settings=None) -> None:
+
+        """
+        args:
+            - P : Cost matrix, only the upper triangle is used
+            - A : Constraint matrix
+            - l, u : Bounds defining the row structure, infinite for missing bounds
+            - solver : 'OSQP' or 'CLARABEL'
+            - settings : dict of solver settings
+        """
+
+        self.solver = solver.upper()
+        if self.solver not in ('OSQP', 'CLARABEL'):
+            raise ValueError(f'Unknown solver {solver}')
+        self.P = sp.triu(sp.csc_matrix(P), format='csc')
+        self.A = sp.csc_matrix(A)
+        self.n, self.k = self.A.shape[1], self.A.shape[0]
+        self.settings = settings or {}
+        self.iterations = 0
+        self.solves = 0
+        self.solve_time = 0.0
+        self.x = None
+        self._workspace = None
+
+        # Clarabel form A_c x + s = b with s in the zero cone for equalities and the
+        # nonnegative cone for the finite upper bounds (A x <= u) and lower bounds (-A x <= -l)
+        l, u = np.broadcast_to(l, (self.k,)), np.broadcast_to(u, (self.k,))
+        self.eq = np.flatnonzero(l == u)
+        self.up = np.flatnonzero((l != u) & np.isfinite(u))
+        self.lo = np.flatnonzero((l != u) & np.isfinite(l))
+
+    def _setup(self, q: np.ndarray, l: np.ndarray, u: np.ndarray) -> None:
+        if self.solver == 'OSQP':
+            import osqp
+            # OSQP 1.0 renamed polish to polishing and deprecated the old name
+            self._osqp_v1 = int(osqp.__version__.split('.')[0]) >= 1
+            settings = dict(verbose=False, eps_abs=1e-5, eps_rel=1e-5, max_iter=10000)
+            settings['polishing' if self._osqp_v1 else 'polish'] = True
+            settings.update(self.settings)
+            # OSQP prints "Polishing not needed" to sys.stdout when no constraint is active, even if verbose is False.
+            # Equality rows are always active, so only problems without them need the output silenced
+            polishing = settings.get('polish', settings.get('polishing'))
+            self._silence = polishing and not settings['verbose'] and len(self.eq) == 0
+            self._workspace = osqp.OSQP()
+            self._workspace.setup(P=self.P, q=q, A=self.A, l=l, u=u, **settings)
+        else:
+            import clarabel
+            A = self._clarabel_A(self.A)
+            cones = [clarabel.ZeroConeT(len(self.eq)), clarabel.NonnegativeConeT(len(self.up) + len(self.lo))]
+            settings = clarabel.DefaultSettings()
+            settings.verbose = False
+            # Presolve removes rows with infinite bounds, which would change the structure of b
+            settings.presolve_enable = False
+            for name, value in self.settings.items():
+                setattr(settings, name, value)
+            self._workspace = clarabel.DefaultSolver(self.P, q, A, self._clarabel_b(l, u), cones, settings)
+
+    def _clarabel_A(self, A: sp.csc_matrix) -> sp.csc_matrix:
+        return sp.vstack([A[self.eq], A[self.up], -A[self.lo]], format='csc')
+
+    def update_matrices(self, P=None, A=None) -> None:
+
+        """
+        Replace P and/or A, keeping the row structure. If their sparsity patterns are unchanged, the values
+        are copied into the workspace, which keeps the warm start of OSQP, otherwise the workspace is
+        set up again at the next solve
+        args:
+            - P : New cost matrix, None keeps the current one
+            - A : New constraint matrix, None keeps the current one
+        """
+
+        P = self.P if P is None else sp.triu(sp.csc_matrix(P), format='csc')
+        A = self.A if A is None else sp.csc_matrix(A)
+        if P.shape != self.P.shape or A.shape != self.A.shape:
+            raise ValueError(f'P and A must keep their shapes {self.P.shape} and {self.A.shape}')
+        same = all(np.array_equal(new.indptr, old.indptr) and np.array_equal(new.indices, old.indices)
+                   for new, old in ((P, self.P), (A, self.A)))
+        self.P, self.A = P, A
+        if self._workspace is None:
+            return
+        if not same:
+            self._workspace = None
+        elif self.solver == 'OSQP':
+            self._workspace.update(Px=P.data, Ax=A.data)
+        else:
+            self._workspace.update(P=P, A=self._clarabel_A(A))
+
+    def _clarabel_b(self, l: np.ndarray, u: np.ndarray) -> np.ndarray:
+        return np.concatenate([u[self.eq], u[self.up], -l[self.lo]])
+
+    def solve(self, q: np.ndarray, l: np.ndarray, u: np.ndarray, warm_start=True, x0=None) -> np.ndarray:
+
+        """
+        Solve for the given vectors and return x
+        args:
+            - q, l, u : Cost vector and bounds, with the row structure given at construction
+            - warm_start : Start OSQP from the previous solution
+            - x0 : Primal initial guess for OSQP instead of the previous solution, the dual
+                variables still start from the previous solution. Clarabel ignores it
+        """
+
+        q = np.asarray(q, dtype=float)
+        l = np.broadcast_to(np.asarray(l, dtype=float), (self.k,))
+        u = np.broadcast_to(np.asarray(u, dtype=float), (self.k,))
+        start = time.perf_counter()
+        if self._workspace is None:
+            self._setup(q, l, u)
+        elif self.solver == 'OSQP':
+            self._workspace.update(q=q, l=l, u=u)
+            if not warm_start:
+                self._workspace.warm_start(x=np.zeros(self.n), y=np.zeros(self.k))
+        else:
+            self._workspace.update(q=q, b=self._clarabel_b(l, u))
+        if x0 is not None and self.solver == 'OSQP':
+            self._workspace.warm_start(x=np.asarray(x0, dtype=float))
+
+        if self.solver != 'OSQP':
+            result = self._workspace.solve()
+        else:
+            kwargs = dict(raise_error=False) if self._osqp_v1 else {}
+            with contextlib.redirect_stdout(io.StringIO()) if self._silence else contextlib.nullcontext():
+                result = self._workspace.solve(**kwargs)
+        self.solve_time = time.perf_counter() - start
+        self.solves += 1
+        if self.solver == 'OSQP':
+            self.iterations += result.info.iter
+            if result.info.status not in ('solved', 'solved inaccurate'):
+                raise cp.SolverError(f'OSQP returned status {result.info.status}')
+        else:
+            self.iterations += result.iterations
+            if str(result.status) not in ('Solved', 'AlmostSolved'):
+                raise cp.SolverError(f'Clarabel returned status {result.status}')
+        self.x = np.array(result.x)
+        return self.x
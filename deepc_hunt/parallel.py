@@ -0,0 +1,167 @@
+import itertools
+import weakref
+import multiprocessing as mp
+from collections import OrderedDict, deque
+import torch
+import cvxpy as cp
+from .solvers import SOLVER_ERRORS, is_solver_error
+
+
+class LayerPool:
+
+    """
+    Runs a CvxpyLayer on chunks of the batch in persistent worker processes.
+
+    The batch is split into contiguous chunks, one per worker, and every worker
+    keeps the autograd graph of its chunk until the backward pass, so both the
+    solves and the derivative computations run in parallel. Every batch element
+    is solved on its own, so the result does not depend on the number of workers.
+    A worker drops the graph of a forward pass once its backward pass has run or the
+    graph on the calling side has been freed without one, so it only holds the graphs
+    that are still alive.
+
+    The workers are started with 'forkserver' where available and 'spawn' otherwise,
+    which pickle the layer and import the __main__ module of the calling script, so a
+    script creating the pool needs an if __name__ == '__main__' guard. Forking a process
+    that runs threads, e.g. the intra-op threads of torch, or that has initialised CUDA
+    can deadlock or crash the workers, so 'fork' has to be asked for and is refused once
+    CUDA is initialised.
+    """
+
+    def __init__(self, layer, n_jobs: int, max_graphs=1000, start_method=None) -> None:
+
+        """
+        args:
+            - layer : CvxpyLayer to evaluate
+            - n_jobs : Number of worker processes
+            - max_graphs : Upper bound on the graphs a worker keeps for the backward pass, the oldest
+                are dropped beyond it
+            - start_method : multiprocessing start method of the workers, None picks 'forkserver'
+                where available and 'spawn' otherwise
+        """
+
+        if start_method is None:
+            start_method = 'forkserver' if 'forkserver' in mp.get_all_start_methods() else 'spawn'
+        if start_method == 'fork' and torch.cuda.is_initialized():
+            raise RuntimeError("Cannot fork workers after CUDA has been initialised, use start_method='forkserver' or 'spawn'")
+        ctx = mp.get_context(start_method)
+        self.conns, self.procs = [], []
+        for _ in range(n_jobs):
+            parent, child = ctx.Pipe()
+            proc = ctx.Process(target=_worker, args=(layer, child, max_graphs), daemon=True)
+            proc.start()
+            self.conns.append(parent)
+            self.procs.append(proc)
+        self._keys = itertools.count()
+        # Keys of the graphs freed on the calling side, sent to the workers with the next forward pass.
+        # Finalizers only append here, so they never write to the pipes while a message is being sent
+        self._released = deque()
+
+    def __call__(self, *params: torch.Tensor, solver_args=None) -> tuple:
+
+        """
+        Evaluate the layer, params must all have a leading batch dimension
+        """
+
+        keep = torch.is_grad_enabled() and any(p.requires_grad for p in params)
+        return PoolFunction.apply(self, solver_args or {}, keep, *params)
+
+    def close(self) -> None:
+        for conn in self.conns:
+            conn.send(('close',))
+        for proc in self.procs:
+            proc.join()
+        self.conns, self.procs = [], []
+
+    def __del__(self) -> None:
+        for proc in self.procs:
+            proc.terminate()
+
+
+class PoolFunction(torch.autograd.Function):
+
+    """
+    Autograd function dispatching the forward and backward pass of each chunk to its worker
+    """
+
+    @staticmethod
+    def forward(ctx, pool, solver_args, keep, *params):
+
+        n_batch = params[0].shape[0]
+        chunks = torch.arange(n_batch).tensor_split(min(len(pool.conns), n_batch))
+        key = next(pool._keys)
+        released = []
+        while pool._released:
+            released.append(pool._released.popleft())
+        for conn, idx in zip(pool.conns, chunks):
+            conn.send(('forward', key, keep, released, [p.detach().cpu()[idx] for p in params], solver_args))
+        outs = _receive(pool.conns[:len(chunks)])
+
+        if keep:
+            # ctx lives as long as the graph of the outputs
+            weakref.finalize(ctx, pool._released.append, key)
+        ctx.pool, ctx.key, ctx.chunks = pool, key, chunks
+        ctx.devices = [p.device for p in params]
+        return tuple(torch.cat(out).to(params[0].device) for out in zip(*outs))
+
+    @staticmethod
+    @torch.autograd.function.once_differentiable
+    def backward(ctx, *grad_outputs):
+
+        pool, chunks = ctx.pool, ctx.chunks
+        for conn, idx in zip(pool.conns, chunks):
+            conn.send(('backward', ctx.key, [g.cpu()[idx] for g in grad_outputs]))
+        grads = _receive(pool.conns[:len(chunks)])
+        grads = [torch.cat(g).to(device) for g, device in zip(zip(*grads), ctx.devices)]
+        return (None, None, None, *grads)
+
+
+def _receive(conns: list) -> list:
+
+    """
+    Collect one message from every worker, re-raising the first error only
+    once all workers have answered so the pipes stay in sync
+    """
+
+    msgs = [conn.recv() for conn in conns]
+    for msg in msgs:
+        if isinstance(msg, Exception):
+            raise msg
+    return msgs
+
+
+def _worker(layer, conn, max_graphs: int) -> None:
+
+    """
+    Worker loop, keeps (params, outputs) of the forward passes that still need a backward pass
+    """
+
+    torch.set_num_threads(1)
+    graphs = OrderedDict()
+    while True:
+        msg = conn.recv()
+        try:
+            if msg[0] == 'forward':
+                _, key, keep, released, params, solver_args = msg
+                for old in released:
+                    graphs.pop(old, None)
+                with torch.set_grad_enabled(keep):
+                    params = [p.requires_grad_(keep) for p in params]
+                    # Without derivatives CvxpyLayer may only solve, which takes no n_jobs_backward
+                    jobs = {'n_jobs_forward': 1, 'n_jobs_backward': 1} if keep else {'n_jobs_forward': 1}
+                    out = layer(*params, solver_args={**jobs, **solver_args})
+                if keep:
+                    graphs[key] = (params, out)
+                    while len(graphs) > max_graphs:
+                        graphs.popitem(last=False)
+                conn.send([o.detach() for o in out])
+            elif msg[0] == 'backward':
+                _, key, grads = msg
+                params, out = graphs.pop(key)
+                torch.autograd.backward(out, grads)
+                conn.send([p.grad if p.grad is not None else torch.zeros_like(p) for p in params])
+            else:
+                break
+        except Exception as e:
+            # The traceback is lost in the pipe, so solver failures are sent as such (see deepc_hunt.solvers)
+            conn.send(cp.error.SolverError(repr(e)) if is_solver_error(e) and not isinstance(e, SOLVER_ERRORS) else e)
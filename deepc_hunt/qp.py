@@ -0,0 +1,633 @@
+import torch
+import warnings
+import numpy as np
+from collections import OrderedDict
+from typing import Tuple
+
+
+class BatchQP:
+
+    """
+    Batched quadratic program solver written in pure PyTorch.
+
+    Solves a batch of problems of the form
+
+        minimize    1/2 x'Px + q'x + sum_i w_i |(Ax)_i|
+        subject to  l <= Ax <= u
+
+    with a primal-dual interior point method (Mehrotra predictor-corrector).
+    The constraint matrix A, the cost matrix P and the l1 weights w are shared by
+    every element of the batch, only q, l and u carry a batch dimension, and all
+    batch elements are solved together with batched dense linear algebra.
+
+    Rows with l == u are equality constraints. Rows with w > 0 carry an l1 penalty
+    and must have infinite bounds, which lets regularizers like norm1(g) and
+    norm1(sig_y) be written without extra variables.
+
+    Gradients are obtained by implicit differentiation of the KKT conditions at
+    the active set of the solution (see QPFunction). The active set is confirmed by
+    polishing, the batch elements where this fails raise a warning.
+
+    Everything that only depends on P, A and w is kept in a workspace that is reused
+    while they are unchanged, e.g. for every time step of an episode. This includes
+    the factorizations of the active-set KKT matrices, which are shared by the batch
+    elements with the same active set, by later solves and by the backward pass.
+    Each solve first tries the active sets of the previous solve, which only costs
+    triangular solves with a cached factorization, and only runs the interior point
+    method for the batch elements where that active set is not optimal anymore.
+    Only active sets confirmed by polishing are kept for the next solve.
+    The solver counts the interior point iterations in iterations and the batch
+    elements solved from the previous active set in warm_solves.
+    """
+
+    def __init__(self, A: torch.Tensor, eps=1e-9, max_iter=50, scaling=10,
+                 polish_iter=5, polish_retry=20, delta=1e-9, reuse_active_set=True, cache_size=64) -> None:
+
+        """
+        args:
+            - A : Constraint matrix with shape (k, n), shared by the whole batch
+            - eps : Tolerance on the relative residuals and the duality gap
+            - max_iter : Maximum number of interior point iterations
+            - scaling : Number of Ruiz equilibration passes (0 to disable)
+            - polish_iter : Rounds of active-set refinement after the interior point method (0 to disable)
+            - polish_retry : Further rounds for the batch elements whose active set is not confirmed after polish_iter
+            - delta : Regularization of the KKT systems
+            - reuse_active_set : Try the active sets of the previous solve before running the interior point method
+            - cache_size : Maximum number of KKT factorizations kept per workspace
+        """
+
+        self.A = A
+        self.k, self.n = A.shape
+        self.eps = eps
+        self.max_iter = max_iter
+        self.scaling = scaling
+        self.polish_iter = polish_iter
+        self.polish_retry = polish_retry
+        self.delta = delta
+        self.reuse_active_set = reuse_active_set
+        self.cache_size = cache_size
+        self.iterations = 0
+        self.warm_solves = 0
+        self.clear_cache()
+
+    def clear_cache(self) -> None:
+
+        """
+        Drop the cached workspace, factorizations and active sets
+        """
+
+        self._ws = None
+        self._active = None
+
+    def __call__(self, P: torch.Tensor, q: torch.Tensor, l: torch.Tensor, u: torch.Tensor,
+                 w=None) -> torch.Tensor:
+
+        """
+        Solve the batch of QPs, differentiable w.r.t. P, q, l, u and w
+        args:
+            - P : Cost matrix with shape (n, n)
+            - q : Linear cost with shape (B, n) or (n,)
+            - l, u : Lower and upper constraint bounds with shape (B, k) or (k,)
+            - w : l1 weights on the rows of Ax with shape (k,), defaults to zero
+        Returns :
+            x : Solution with shape (B, n) or (n,)
+        """
+
+        unbatched = q.ndim == 1 and l.ndim == 1 and u.ndim == 1
+        n_batch = max(t.shape[0] if t.ndim > 1 else 1 for t in (q, l, u))
+        q = q.expand(n_batch, self.n) if q.ndim == 1 else q
+        l = l.expand(n_batch, self.k) if l.ndim == 1 else l
+        u = u.expand(n_batch, self.k) if u.ndim == 1 else u
+        if w is None:
+            w = torch.zeros(self.k, dtype=self.A.dtype, device=self.A.device)
+        x = QPFunction.apply(P, q, l, u, w, self)
+        return x.squeeze(0) if unbatched else x
+
+    def setup(self, P: torch.Tensor, w: torch.Tensor, eq: torch.Tensor) -> dict:
+
+        """
+        Equilibrate the parts of the problem shared by the whole batch.
+        Returns a workspace holding the scaled P, A and w, the scaling itself and
+        the cache of KKT factorizations. The workspace of the previous call is
+        returned as long as A, P, w and the equality rows are unchanged.
+        """
+
+        ws = self._ws
+        if (ws is not None and ws['A_src'] is self.A and torch.equal(ws['P_src'], P)
+                and torch.equal(ws['w_src'], w) and torch.equal(ws['eq'], eq)):
+            return ws
+
+        D, E, c = ruiz_equilibrate(P, self.A, self.scaling)
+        self._ws = {
+            'D': D, 'E': E, 'c': c,
+            'P': c*D[:,None]*P*D[None,:],
+            'A': E[:,None]*self.A*D[None,:],
+            'w': c*w/E,
+            'eq': eq, 'l1': w > 0,
+            'A_src': self.A, 'P_src': P, 'w_src': w,
+            'factors': OrderedDict()
+        }
+        return self._ws
+
+    def guess_active_set(self, n_batch: int):
+
+        """
+        Active sets of the previous solve that polishing confirmed. Returns them per batch element
+        together with the mask of the elements that have one if the batch size is unchanged, and
+        the first confirmed one for every element otherwise. None if there is none.
+        """
+
+        if not self.reuse_active_set or self._active is None:
+            return None
+        active, confirmed = self._active
+        if confirmed.shape[0] == n_batch:
+            return active, confirmed
+        first = int(torch.nonzero(confirmed)[0])
+        guess = {key: v[first:first + 1].expand(n_batch, -1) for key, v in active.items()}
+        return guess, torch.ones_like(confirmed[:1]).expand(n_batch)
+
+    def solve(self, ws: dict, q: torch.Tensor, l: torch.Tensor, u: torch.Tensor) -> Tuple[torch.Tensor, dict, tuple]:
+
+        """
+        Interior point iterations on the scaled problem with scaled data q, l, u.
+        The l1 rows are handled through |Ax| <= t with t eliminated from the Newton
+        system, so every iteration factorizes a single (n + n_eq) KKT matrix per batch element.
+        Returns the scaled primal solution, the active set and the barrier weights lam/s of the
+        lower and upper inequalities at the solution, which the derivative falls back to when
+        polishing cannot confirm the active set.
+        """
+
+        P, A, w, eq, l1 = ws['P'], ws['A'], ws['w'], ws['eq'], ws['l1']
+        n_batch, dtype, device = q.shape[0], q.dtype, q.device
+        eq_idx = torch.nonzero(eq).squeeze(1)
+        n_eq = eq_idx.shape[0]
+        A_eq = A[eq_idx]
+        box = ~eq & ~l1
+        eye_n = torch.eye(self.n, dtype=dtype, device=device)
+        eye_eq = torch.eye(n_eq, dtype=dtype, device=device)
+
+        # One-sided inequalities: lower (Ax - l >= 0 or Ax + t >= 0) and upper (u - Ax >= 0 or t - Ax >= 0)
+        ml = ((torch.isfinite(l) & box) | l1).to(dtype)
+        mu = ((torch.isfinite(u) & box) | l1).to(dtype)
+        n_ineq = (ml + mu).sum(1).clamp(min=1)
+        l_, u_ = torch.where(torch.isfinite(l), l, 0), torch.where(torch.isfinite(u), u, 0)
+        b_eq = l[:,eq_idx]
+        scale_q = 1 + q.abs().amax(1)
+        scale_b = 1 + torch.cat((l_.abs(), u_.abs()), 1).amax(1)
+
+        def newton(D_eff):
+            K = torch.zeros((n_batch, self.n + n_eq, self.n + n_eq), dtype=dtype, device=device)
+            K[:,:self.n,:self.n] = P + (A.T*D_eff[:,None,:]) @ A + self.delta*eye_n
+            K[:,self.n:,:self.n] = A_eq
+            K[:,:self.n,self.n:] = A_eq.T
+            K[:,self.n:,self.n:] = -self.delta*eye_eq
+            LU, pivots = torch.linalg.lu_factor(K)
+            return lambda rx, re: torch.linalg.lu_solve(LU, pivots, torch.cat((rx, re), 1).unsqueeze(-1)).squeeze(-1)
+
+        # Initial point from a least squares problem pulling Ax towards the bounds
+        ones = (ml + mu).clamp(max=1)*box
+        sol = newton(ones)(-q + ((ml*l_ + mu*u_)/2*box) @ A, b_eq)
+        x, nu = sol[:,:self.n], sol[:,self.n:]
+        psi = x @ A.T
+        t = torch.where(l1, psi.abs() + 1, 0)
+        s_l = torch.where(ml > 0, (psi - torch.where(l1, -t, l_)).clamp(min=1), 1)
+        s_u = torch.where(mu > 0, (torch.where(l1, t, u_) - psi).clamp(min=1), 1)
+        # Multipliers of the l1 rows start dual feasible, lam_l + lam_u = w
+        lam_l, lam_u = torch.where(l1, w/2, ml), torch.where(l1, w/2, mu)
+
+        def step_length(ds_l, ds_u, dlam_l, dlam_u):
+            v = torch.cat((s_l, s_u, lam_l, lam_u), 1)
+            dv = torch.cat((ds_l, ds_u, dlam_l, dlam_u), 1)
+            ratio = torch.where(dv < 0, -v/dv, float('inf'))
+            return ratio.amin(1, keepdim=True).clamp(max=1)
+
+        # Iterate with the smallest residuals so far, the residuals can stall and then grow once the
+        # Newton systems become ill-conditioned close to a degenerate solution
+        best, best_merit = (x, s_l, s_u, lam_l, lam_u), torch.full((n_batch,), float('inf'), dtype=dtype, device=device)
+        it = -1
+        for it in range(self.max_iter):
+            psi = x @ A.T
+            lo, up = torch.where(l1, -t, l_), torch.where(l1, t, u_)
+            r_x = x @ P + q + torch.where(eq, 0, lam_u - lam_l) @ A + nu @ A_eq
+            r_t = (w - lam_l - lam_u)*l1
+            r_e = psi[:,eq_idx] - b_eq
+            r_l = (s_l - (psi - lo))*ml
+            r_u = (s_u - (up - psi))*mu
+            gap = (s_l*lam_l*ml + s_u*lam_u*mu).sum(1)/n_ineq
+
+            res_d = torch.maximum(r_x.abs().amax(1), r_t.abs().amax(1))/scale_q
+            res_p = torch.cat((r_l.abs(), r_u.abs(), r_e.abs()), 1).amax(1)/scale_b
+            done = (res_d < self.eps) & (res_p < self.eps) & (gap/scale_q < self.eps)
+            merit = torch.maximum(torch.maximum(res_d, res_p), gap/scale_q)
+            better = (merit < best_merit)[:,None]
+            best = tuple(torch.where(better, v, b) for v, b in zip((x, s_l, s_u, lam_l, lam_u), best))
+            best_merit = torch.minimum(merit, best_merit)
+            if bool(done.all()):
+                break
+
+            d_l, d_u = lam_l/s_l*ml, lam_u/s_u*mu
+            d_sum = torch.where(l1, d_l + d_u, 1)
+            solve = newton(torch.where(l1, 4*d_l*d_u/d_sum, d_l + d_u)*~eq)
+
+            def direction(r_cl, r_cu):
+                rho = (r_cl/s_l - d_l*r_l)*ml - (r_cu/s_u - d_u*r_u)*mu
+                kappa = (-r_cl/s_l + d_l*r_l)*ml + (-r_cu/s_u + d_u*r_u)*mu
+                rho = torch.where(l1, rho + (d_l - d_u)*(kappa - r_t)/d_sum, rho)*~eq
+                sol = solve(-r_x - rho @ A, -r_e)
+                dx, dnu = sol[:,:self.n], sol[:,self.n:]
+                dpsi = dx @ A.T
+                dt = torch.where(l1, ((d_u - d_l)*dpsi + kappa - r_t)/d_sum, 0)
+                ds_l = (dpsi + dt - r_l)*ml
+                ds_u = (-dpsi + dt - r_u)*mu
+                dlam_l = (-r_cl - lam_l*ds_l)/s_l*ml
+                dlam_u = (-r_cu - lam_u*ds_u)/s_u*mu
+                return dx, dnu, dt, ds_l, ds_u, dlam_l, dlam_u
+
+            # Predictor
+            _, _, _, ds_l, ds_u, dlam_l, dlam_u = direction(s_l*lam_l*ml, s_u*lam_u*mu)
+            alpha = step_length(ds_l, ds_u, dlam_l, dlam_u)
+            gap_aff = (
+                (s_l + alpha*ds_l)*(lam_l + alpha*dlam_l)*ml + (s_u + alpha*ds_u)*(lam_u + alpha*dlam_u)*mu
+            ).sum(1, keepdim=True)/n_ineq[:,None]
+            target = (gap_aff/gap[:,None].clamp(min=1e-300)).clamp(max=1)**3*gap[:,None]
+
+            # Corrector
+            dx, dnu, dt, ds_l, ds_u, dlam_l, dlam_u = direction(
+                (s_l*lam_l + ds_l*dlam_l - target)*ml,
+                (s_u*lam_u + ds_u*dlam_u - target)*mu
+            )
+            alpha = 0.99*step_length(ds_l, ds_u, dlam_l, dlam_u)*~done[:,None]
+            x, nu, t = x + alpha*dx, nu + alpha*dnu, t + alpha*dt
+            s_l, s_u = torch.where(ml > 0, s_l + alpha*ds_l, 1), torch.where(mu > 0, s_u + alpha*ds_u, 1)
+            lam_l, lam_u = lam_l + alpha*dlam_l, lam_u + alpha*dlam_u
+
+        self.iterations += it + 1
+
+        # Active set from strict complementarity
+        x, s_l, s_u, lam_l, lam_u = best
+        psi = x @ A.T
+        low, upp = (lam_l > s_l) & (ml > 0), (lam_u > s_u) & (mu > 0)
+        kink = l1 & low & upp
+        active = {
+            'lower': (low & box) | eq,
+            'upper': upp & box & ~low,
+            'kink': kink,
+            'sign': torch.sign(psi)*(l1 & ~kink),
+        }
+        return x, active, (lam_l/s_l*ml, lam_u/s_u*mu)
+
+    def barrier_solve(self, ws: dict, weights: Tuple[torch.Tensor, torch.Tensor], rhs: torch.Tensor) -> torch.Tensor:
+
+        """
+        Solve the Newton system of the interior point method at the iterate it returned
+            [P + A'*diag(d)*A + delta*I,    A_eq'    ]
+            [A_eq,                          -delta*I ]
+        with the barrier weights d_l = lam_l/s_l and d_u = lam_u/s_u, combined as in solve. This is the
+        derivative of the barrier solution, used for the batch elements without a confirmed active set.
+        rhs has shape (B, n + n_eq). Everything is scaled.
+        """
+
+        A, eq, l1 = ws['A'], ws['eq'], ws['l1']
+        d_l, d_u = weights
+        d = torch.where(l1, 4*d_l*d_u/torch.where(l1, d_l + d_u, 1), d_l + d_u)*~eq
+        A_eq = A[eq]
+        n_eq = A_eq.shape[0]
+        K = torch.zeros((rhs.shape[0], self.n + n_eq, self.n + n_eq), dtype=rhs.dtype, device=rhs.device)
+        K[:,:self.n,:self.n] = ws['P'] + (A.T*d[:,None,:]) @ A + self.delta*torch.eye(self.n, dtype=rhs.dtype, device=rhs.device)
+        K[:,self.n:,:self.n] = A_eq
+        K[:,:self.n,self.n:] = A_eq.T
+        K[:,self.n:,self.n:] = -self.delta*torch.eye(n_eq, dtype=rhs.dtype, device=rhs.device)
+        return torch.linalg.solve(K, rhs)
+
+    def kkt_factor(self, ws: dict, active: torch.Tensor) -> Tuple[list, torch.Tensor]:
+
+        """
+        LU factorizations of the (regularized) active-set KKT matrix in scaled coordinates
+            [P + delta*I,    A_act'        ]
+            [A_act,          -delta*I | I  ]
+        where inactive rows are replaced by identity rows so the shape is fixed.
+        Only one factorization is computed per distinct active set, and factorizations
+        are looked up in and added to the cache of the workspace.
+        Returns the list of factorizations and the index of the one used by each batch element.
+        """
+
+        sets, index = torch.unique(active, dim=0, return_inverse=True)
+        keys = [row.tobytes() for row in np.packbits(sets.cpu().numpy(), axis=1)]
+        cache = ws['factors']
+        missing = [i for i, key in enumerate(keys) if key not in cache]
+        if missing:
+            act = sets[missing].to(ws['A'].dtype)
+            K = torch.zeros((len(missing), self.n + self.k, self.n + self.k), dtype=act.dtype, device=act.device)
+            K[:,:self.n,:self.n] = ws['P'] + self.delta*torch.eye(self.n, dtype=K.dtype, device=K.device)
+            K[:,self.n:,:self.n] = act[:,:,None]*ws['A']
+            K[:,:self.n,self.n:] = K[:,self.n:,:self.n].transpose(1,2)
+            K[:,self.n:,self.n:] = torch.diag_embed(1 - act*(1 + self.delta))
+            LU, pivots = torch.linalg.lu_factor(K)
+            for j, i in enumerate(missing):
+                cache[keys[i]] = (LU[j], pivots[j])
+        for key in keys:
+            cache.move_to_end(key)
+        factors = [cache[key] for key in keys]
+        while len(cache) > max(self.cache_size, len(keys)):
+            cache.popitem(last=False)
+        return factors, index
+
+    def kkt_solve(self, ws: dict, factor: Tuple[list, torch.Tensor], rhs: torch.Tensor,
+                  active: torch.Tensor, refine=3) -> torch.Tensor:
+
+        """
+        Solve the active-set KKT system with iterative refinement against the
+        unregularized matrix. rhs has shape (B, n + k). The batch elements sharing a
+        factorization are solved together as one system with multiple right hand sides.
+        """
+
+        factors, index = factor
+        groups = [torch.nonzero(index == j).squeeze(1) for j in range(len(factors))]
+
+        def lu_solve(b):
+            if len(factors) == 1:
+                return torch.linalg.lu_solve(*factors[0], b.T).T
+            sol = torch.empty_like(b)
+            for (LU, pivots), idx in zip(factors, groups):
+                sol[idx] = torch.linalg.lu_solve(LU, pivots, b[idx].T).T
+            return sol
+
+        act = active.to(rhs.dtype)
+        A_act = act[:,:,None]*ws['A']
+
+        def apply_K(t):
+            tx, ty = t[:,:self.n], t[:,self.n:]
+            top = tx @ ws['P'] + (A_act.transpose(1,2) @ ty.unsqueeze(-1)).squeeze(-1)
+            bottom = (A_act @ tx.unsqueeze(-1)).squeeze(-1) + (1 - act)*ty
+            return torch.cat((top, bottom), 1)
+
+        sol = lu_solve(rhs)
+        for _ in range(refine):
+            sol = sol + lu_solve(rhs - apply_K(sol))
+        return sol
+
+    def polish_solution(self, ws: dict, x: torch.Tensor, active: dict,
+                        q: torch.Tensor, l: torch.Tensor, u: torch.Tensor,
+                        rounds=None) -> Tuple[torch.Tensor, dict, torch.Tensor]:
+
+        """
+        Solve the equality constrained QP defined by the active set, correcting the
+        active set for up to rounds (default polish_iter) rounds where the polished point
+        is primal infeasible or dual inconsistent. The polished point is kept for the batch
+        elements where a consistent active set was found. The tolerances are relative to the
+        size of Ax and of the multipliers, and not below 100 machine epsilons of the dtype. Everything is scaled.
+        Returns the solution, the active set and which batch elements were accepted.
+        """
+
+        E, w, eq = ws['E'], ws['w'], ws['eq']
+        box = ~eq & ~ws['l1']
+        lower, upper, kink, sign = active['lower'], active['upper'], active['kink'], active['sign']
+        accept = torch.zeros(x.shape[0], dtype=torch.bool, device=x.device)
+        rel_tol = max(1e-7, 100*torch.finfo(x.dtype).eps)
+        for _ in range(self.polish_iter if rounds is None else rounds):
+            act = lower | upper | kink
+            factor = self.kkt_factor(ws, act)
+            b = torch.where(lower, l, torch.where(upper, u, 0))
+            y_fixed = sign*w
+            rhs = torch.cat((-q - y_fixed @ ws['A'], b*act), 1)
+            sol = self.kkt_solve(ws, factor, rhs, act)
+            xp, yp = sol[:,:self.n], torch.where(act, sol[:,self.n:], y_fixed)
+
+            # Primal feasibility and dual consistency, measured in the original coordinates
+            Ax = xp @ ws['A'].T
+            tol = rel_tol*(1 + (Ax/E).abs().amax(1, keepdim=True))
+            dual_tol = rel_tol*(1 + yp.abs().amax(1, keepdim=True))
+            below = box & ~act & ((l - Ax)/E > tol)
+            above = box & ~act & ((Ax - u)/E > tol)
+            release = (lower & box & (yp > dual_tol)) | (upper & box & (yp < -dual_tol))
+            leave_kink = kink & (yp.abs() > w + dual_tol)
+            enter_kink = (sign != 0) & (Ax*sign/E < -tol)
+            wrong = below | above | release | leave_kink | enter_kink
+            ok = ~wrong.any(1)
+            x = torch.where((ok & ~accept).unsqueeze(1), xp, x)
+            accept = accept | ok
+            if bool(accept.all()):
+                break
+
+            # Update the active set of the elements that are not yet consistent
+            fix = wrong & ~accept.unsqueeze(1)
+            lower = torch.where(fix, (lower & ~release) | below, lower)
+            upper = torch.where(fix, (upper & ~release) | above, upper)
+            kink = torch.where(fix, (kink & ~leave_kink) | enter_kink, kink)
+            sign = torch.where(fix & leave_kink, torch.sign(yp), torch.where(fix & enter_kink, 0, sign))
+
+        return x, {'lower': lower, 'upper': upper, 'kink': kink, 'sign': sign}, accept
+
+    def solve_batch(self, ws: dict, q: torch.Tensor, l: torch.Tensor, u: torch.Tensor) -> Tuple[torch.Tensor, dict, torch.Tensor, tuple]:
+
+        """
+        Solve the scaled problems, first by polishing the confirmed active sets of the previous solve
+        and then with the interior point method and polishing for the remaining batch elements.
+        Elements that are not confirmed after polish_iter rounds get polish_retry more, the ones that
+        still are not keep the interior point solution and raise a warning. Their derivative is taken
+        from the Newton system of the interior point method instead of an unconfirmed active set.
+        Only confirmed active sets are kept for the next solve.
+        Returns the solution, the active set, which batch elements were confirmed and the barrier weights.
+        """
+
+        n_batch = q.shape[0]
+        x = torch.zeros_like(q)
+        accept = torch.zeros(n_batch, dtype=torch.bool, device=q.device)
+        weights = (torch.zeros_like(l), torch.zeros_like(l))
+        active = None
+
+        def subset(active, idx):
+            return {key: v[idx] for key, v in active.items()}
+
+        def merge(active, idx, part):
+            return {key: v.index_copy(0, idx, part[key]) for key, v in active.items()}
+
+        guess = self.guess_active_set(n_batch)
+        if guess is not None:
+            active, known = guess
+            idx = torch.nonzero(known).squeeze(1)
+            xw, aw, ok = self.polish_solution(ws, x[idx], subset(active, idx), q[idx], l[idx], u[idx])
+            x, active, accept = x.index_copy(0, idx, xw), merge(active, idx, aw), accept.index_copy(0, idx, ok)
+            self.warm_solves += int(ok.sum())
+
+        cold = torch.nonzero(~accept).squeeze(1)
+        if cold.numel() > 0:
+            xc, ac, wc = self.solve(ws, q[cold], l[cold], u[cold])
+            weights = tuple(v.index_copy(0, cold, vc) for v, vc in zip(weights, wc))
+            okc = torch.zeros_like(cold, dtype=torch.bool)
+            if self.polish_iter > 0:
+                xc, ac, okc = self.polish_solution(ws, xc, ac, q[cold], l[cold], u[cold])
+                retry = torch.nonzero(~okc).squeeze(1)
+                if retry.numel() > 0 and self.polish_retry > 0:
+                    xr, ar, okr = self.polish_solution(ws, xc[retry], subset(ac, retry), q[cold][retry],
+                                                       l[cold][retry], u[cold][retry], rounds=self.polish_retry)
+                    xc, ac, okc = xc.index_copy(0, retry, xr), merge(ac, retry, ar), okc.index_copy(0, retry, okr)
+            if active is None:
+                x, active, accept = xc, ac, okc
+            else:
+                x, active, accept = x.index_copy(0, cold, xc), merge(active, cold, ac), accept.index_copy(0, cold, okc)
+
+        if self.polish_iter > 0 and not bool(accept.all()):
+            warnings.warn(f'BatchQP could not confirm the active set of {int((~accept).sum())} of {n_batch} '
+                          'batch elements, their gradients are those of the interior point solution', RuntimeWarning)
+        self._active = (active, accept) if bool(accept.any()) else None
+        return x, active, accept, weights
+
+
+class QPFunction(torch.autograd.Function):
+
+    """
+    Autograd function for BatchQP. The forward pass runs the interior point method,
+    the backward pass differentiates the KKT conditions at the active set of the solution.
+    jvp does the same in forward mode, with the same cached KKT factorization, and only
+    uses out-of-place operations on the tangents, so torch.func.jvp can push a batch of
+    tangents through one solve under torch.func.vmap. Problems batched by vmap themselves
+    are solved as part of the batch of BatchQP.
+    Batch elements whose active set polishing could not confirm are differentiated through
+    the Newton system of the interior point method instead (see barrier_solve).
+    """
+
+    @staticmethod
+    def forward(P, q, l, u, w, solver):
+
+        P, q, l, u, w = P.detach(), q.detach(), l.detach(), u.detach(), w.detach()
+        ws = solver.setup(P, w, (l == u).all(0))
+        D, E, c = ws['D'], ws['E'], ws['c']
+        qs, ls, us = c*D*q, E*l, E*u
+
+        x, active, accept, weights = solver.solve_batch(ws, qs, ls, us)
+        # Batch elements differentiated at their active set and through the barrier, and the KKT factorization
+        # of the former. Looked up here, usually in the cache filled by polishing, since the lookup goes through
+        # the host, which the derivatives cannot do on the tensors of torch.func transforms
+        conf, unconf = torch.nonzero(accept).squeeze(1), torch.nonzero(~accept).squeeze(1)
+        act = (active['lower'] | active['upper'] | active['kink'])[conf]
+        factor = solver.kkt_factor(ws, act) if conf.numel() > 0 else None
+        # Handed to setup_context, which runs right after forward, once per torch.func transform
+        solver._solution = (ws, x, active, weights, conf, unconf, act, factor)
+        return D*x
+
+    @staticmethod
+    def setup_context(ctx, inputs, output):
+
+        solver = inputs[-1]
+        ws, x, active, weights, conf, unconf, act, factor = solver._solution
+        ctx.solver = solver
+        ctx.ws = ws
+        ctx.active = active
+        ctx.weights = weights
+        ctx.conf, ctx.unconf, ctx.act, ctx.factor = conf, unconf, act, factor
+        ctx.save_for_backward(x)
+        ctx.save_for_forward(x)
+
+    @staticmethod
+    def vmap(info, in_dims, P, q, l, u, w, solver):
+
+        # Problems batched by torch.func.vmap are solved as part of the batch of BatchQP, which shares P and w
+        if in_dims[0] is not None or in_dims[4] is not None:
+            raise NotImplementedError('BatchQP shares P and w across the batch, they cannot be batched with vmap')
+        q, l, u = (t.expand(info.batch_size, *t.shape) if dim is None else t.movedim(dim, 0)
+                   for t, dim in zip((q, l, u), in_dims[1:4]))
+        n_batch = q.shape[1]
+        x = QPFunction.apply(P, q.reshape(-1, q.shape[-1]), l.reshape(-1, l.shape[-1]), u.reshape(-1, u.shape[-1]), w, solver)
+        return x.reshape(info.batch_size, n_batch, -1), 0
+
+    @staticmethod
+    @torch.autograd.function.once_differentiable
+    def backward(ctx, grad_x):
+
+        solver, ws, active = ctx.solver, ctx.ws, ctx.active
+        x, = ctx.saved_tensors
+        D, E, c, n = ws['D'], ws['E'], ws['c'], solver.n
+        eq, box = ws['eq'], ~ws['eq'] & ~ws['l1']
+        conf, unconf, act = ctx.conf, ctx.unconf, ctx.act
+
+        # Adjoint solution and the sensitivities of the scaled bounds and l1 weights to it
+        vx, y_l, y_u, y_w = torch.zeros_like(x), torch.zeros_like(x[:,:1]*eq), torch.zeros_like(x[:,:1]*eq), torch.zeros_like(x[:,:1]*eq)
+        if conf.numel() > 0:
+            at_lower, at_upper = active['lower'][conf], active['upper'][conf]
+            rhs = torch.cat((D*grad_x[conf], torch.zeros_like(act, dtype=x.dtype)), 1)
+            v = solver.kkt_solve(ws, ctx.factor, rhs, act)
+            vy = v[:,n:]*act
+            vx[conf], y_l[conf], y_u[conf], y_w[conf] = v[:,:n], vy*at_lower, vy*at_upper, active['sign'][conf]
+        if unconf.numel() > 0:
+            d_l, d_u = (v[unconf] for v in ctx.weights)
+            rhs = torch.cat((D*grad_x[unconf], torch.zeros((unconf.numel(), int(eq.sum())), dtype=x.dtype, device=x.device)), 1)
+            v = solver.barrier_solve(ws, (d_l, d_u), rhs)
+            Av = v[:,:n] @ ws['A'].T
+            vx[unconf] = v[:,:n]
+            y_l[unconf] = (Av*d_l*box).index_copy(1, torch.nonzero(eq).squeeze(1), v[:,n:])
+            y_u[unconf] = Av*d_u*box
+            y_w[unconf] = torch.where(ws['l1'], (d_u - d_l)/(d_u + d_l), 0)
+
+        grad_P = grad_q = grad_l = grad_u = grad_w = None
+        if ctx.needs_input_grad[0]:
+            grad_P = -0.5*c*D[:,None]*(vx.T @ x + x.T @ vx)*D[None,:]
+        if ctx.needs_input_grad[1]:
+            grad_q = -c*D*vx
+        if ctx.needs_input_grad[2] or ctx.needs_input_grad[3]:
+            grad_l = E*y_l
+            grad_u = E*y_u
+        if ctx.needs_input_grad[4]:
+            grad_w = -(vx @ ws['A'].T*c*y_w/E).sum(0)
+        return grad_P, grad_q, grad_l, grad_u, grad_w, None
+
+    @staticmethod
+    def jvp(ctx, dP, dq, dl, du, dw, _):
+
+        # The KKT system is symmetric, so the right hand side is the transpose of the map in backward
+        solver, ws, active = ctx.solver, ctx.ws, ctx.active
+        x, = ctx.saved_tensors
+        D, E, c, n = ws['D'], ws['E'], ws['c'], solver.n
+        eq, box = ws['eq'], ~ws['eq'] & ~ws['l1']
+        conf, unconf, act = ctx.conf, ctx.unconf, ctx.act
+
+        rx = torch.zeros_like(x)
+        if dP is not None:
+            dPs = 0.5*(dP + dP.T)
+            rx = rx - c*(x @ (D[:,None]*dPs*D[None,:]))
+        if dq is not None:
+            rx = rx - c*D*dq
+        dl = torch.zeros_like(x[:,:1]*eq) if dl is None else dl.expand(x.shape[0], -1)
+        du = torch.zeros_like(x[:,:1]*eq) if du is None else du.expand(x.shape[0], -1)
+        dw = torch.zeros_like(ws['w']) if dw is None else dw
+
+        dx = torch.zeros_like(rx)
+        if conf.numel() > 0:
+            at_lower, at_upper = active['lower'][conf], active['upper'][conf]
+            ry = E*dl[conf]*at_lower + E*du[conf]*at_upper
+            r = rx[conf] - (c*active['sign'][conf]*dw/E) @ ws['A']
+            sol = solver.kkt_solve(ws, ctx.factor, torch.cat((r, ry), 1), act)
+            dx = dx.index_copy(0, conf, sol[:,:n])
+        if unconf.numel() > 0:
+            d_l, d_u = (v[unconf] for v in ctx.weights)
+            sigma = torch.where(ws['l1'], (d_u - d_l)/(d_u + d_l), 0)
+            r = rx[unconf] + ((E*dl[unconf]*d_l + E*du[unconf]*d_u)*box - c*sigma*dw/E) @ ws['A']
+            sol = solver.barrier_solve(ws, (d_l, d_u), torch.cat((r, (E*dl[unconf])[:,eq]), 1))
+            dx = dx.index_copy(0, unconf, sol[:,:n])
+        return D*dx
+
+
+def ruiz_equilibrate(P: torch.Tensor, A: torch.Tensor, iters=10) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+
+    """
+    Modified Ruiz equilibration of the KKT matrix [P A'; A 0] as done in OSQP.
+    Returns the variable scaling D, the constraint scaling E and the cost scaling c,
+    so that the scaled problem has P_s = c*D*P*D and A_s = E*A*D.
+    """
+
+    n, k = P.shape[0], A.shape[0]
+    D = torch.ones(n, dtype=P.dtype, device=P.device)
+    E = torch.ones(k, dtype=P.dtype, device=P.device)
+    c = torch.ones((), dtype=P.dtype, device=P.device)
+    Ps, As = P, A
+    for _ in range(iters):
+        col = torch.maximum(Ps.abs().amax(0), As.abs().amax(0))
+        row = As.abs().amax(1)
+        d = 1/torch.sqrt(torch.where(col > 1e-8, col, torch.ones_like(col)))
+        e = 1/torch.sqrt(torch.where(row > 1e-8, row, torch.ones_like(row)))
+        Ps = d[:,None]*Ps*d[None,:]
+        As = e[:,None]*As*d[None,:]
+        D, E = D*d, E*e
+    if iters > 0:
+        c = 1/Ps.abs().amax(0).mean().clamp(min=1e-4)
+    return D, E, c
@@ -0,0 +1,162 @@
+import time
+import numpy as np
+import cvxpy as cp
+import diffcp
+from typing import Callable, Any
+
+# Failures of a solver, which the other candidates are tried on. Anything else is a bug of the caller and raised
+SOLVER_ERRORS = (cp.error.SolverError, diffcp.SolverError)
+
+# Packages whose ValueErrors are failures of the solve, e.g. a factorization failing in numpy within one of them
+SOLVER_PACKAGES = ('diffcp', 'clarabel', 'ecos', '_ecos', 'scs', '_scs_direct', 'osqp')
+
+
+def is_solver_error(error: Exception) -> bool:
+
+    """
+    Whether error is a failure of the solver rather than of the caller: a SolverError of cvxpy or diffcp,
+    or a ValueError (numpy.linalg.LinAlgError included) raised while diffcp or a solver runs, e.g. a solver
+    that does not support the cones of the problem or a singular derivative. ValueErrors raised outside of
+    them, e.g. by CvxpyLayer on parameters of the wrong shape or dtype, and other exceptions are not
+    """
+
+    if isinstance(error, SOLVER_ERRORS):
+        return True
+    if not isinstance(error, ValueError):
+        return False
+    tb = error.__traceback__
+    while tb is not None:
+        if tb.tb_frame.f_globals.get('__name__', '').split('.')[0] in SOLVER_PACKAGES:
+            return True
+        tb = tb.tb_next
+    return False
+
+
+def available_solvers(candidates: list) -> list:
+
+    """
+    Keep the candidates that are installed, compared case-insensitively with the
+    names in cvxpy.installed_solvers() so both cvxpy ('CLARABEL') and diffcp
+    ('Clarabel') spellings can be used
+    """
+
+    installed = {name.upper() for name in cp.installed_solvers()}
+    return [solver for solver in candidates if solver.upper() in installed]
+
+
+class SolverSelector:
+
+    """
+    Sticky solver selection with fallback.
+
+    The selected solver is used for every solve until it fails. A failed solve is
+    retried with the other candidates in order and recorded in events, but the
+    selection only changes once the selected solver has failed max_failures times
+    in a row: the candidates are then probed again on the failing problem and the
+    fastest working one is selected. A successful solve resets the count, so occasional
+    failures over a long run do not trigger a probe, while a problem that reliably
+    fails with one solver stops paying for the failed attempt after max_failures steps.
+    Only solver failures are handled (see is_solver_error), other errors are raised at once.
+    """
+
+    def __init__(self, candidates: list, max_failures=3, reps=3) -> None:
+
+        """
+        args:
+            - candidates : Solver names in order of preference
+            - max_failures : Consecutive failures of the selected solver after which the candidates are probed again
+            - reps : Number of timed solves per candidate when probing
+        """
+
+        if len(candidates) == 0:
+            raise ValueError('No solver available')
+        self.candidates = list(candidates)
+        self.solver = self.candidates[0]
+        self.max_failures = max_failures
+        self.reps = reps
+        self.failures = 0
+        self.solves = 0
+        self.events = []
+        self.timings = {}
+
+    def probe(self, solve: Callable[[str], Any]) -> str:
+
+        """
+        Time every candidate on the problem solved by solve(solver) and select the fastest working one
+        args:
+            - solve : Function solving the problem with the given solver, raises on failure
+        Returns : the selected solver
+        """
+
+        self.timings = {}
+        for solver in self.candidates:
+            times = []
+            try:
+                for _ in range(self.reps):
+                    start = time.perf_counter()
+                    solve(solver)
+                    times.append(time.perf_counter() - start)
+                self.timings[solver] = float(np.median(times))
+            except Exception as error:
+                if not is_solver_error(error):
+                    raise
+                self.timings[solver] = float('inf')
+        best = min(self.candidates, key=lambda solver: self.timings[solver])
+        if self.timings[best] < float('inf'):
+            self.solver = best
+        self.failures = 0
+        return self.solver
+
+    def select(self, solver: str) -> None:
+
+        """
+        Select solver, e.g. one requested by the user, and make it the first candidate
+        """
+
+        if solver not in self.candidates:
+            self.candidates.insert(0, solver)
+        self.solver = solver
+        self.failures = 0
+
+    def run(self, solve: Callable[[str], Any]) -> Any:
+
+        """
+        Solve with the selected solver, falling back to the other candidates on failure
+        args:
+            - solve : Function solving the problem with the given solver, raises on failure
+        Returns : the return value of solve
+        """
+
+        self.solves += 1
+        try:
+            out = solve(self.solver)
+            self.failures = 0
+            return out
+        except Exception as error:
+            if not is_solver_error(error):
+                raise
+            failed = self.solver
+            self.failures += 1
+            errors = {failed: repr(error)}
+
+        if self.failures >= self.max_failures:
+            self.probe(solve)
+            if self.timings[self.solver] < float('inf'):
+                self.events.append({'solve': self.solves, 'failed': failed, 'used': self.solver,
+                                    'errors': errors, 'reprobe': True})
+                return solve(self.solver)
+
+        for solver in self.candidates:
+            if solver == failed:
+                continue
+            try:
+                out = solve(solver)
+            except Exception as error:
+                if not is_solver_error(error):
+                    raise
+                errors[solver] = repr(error)
+                continue
+            self.events.append({'solve': self.solves, 'failed': failed, 'used': solver,
+                                'errors': errors, 'reprobe': False})
+            return out
+        raise cp.SolverError(f'All solvers failed: {errors}')
@@ -1,85 +1,259 @@
 import torch
 import torch.nn as nn 
 import torch.optim as optim
+from torch.func import functional_call, jvp, vmap
+from collections import deque
 from tqdm import tqdm
-from deepc_hunt.utils import sample_initial_signal, episode_loss, Projection
+from deepc_hunt.utils import TrajectoryDataset, episode_loss, Projection
 from typing import Dict
 
+class ClosedLoopStep(nn.Module):
+
+    """
+    One closed-loop step: solve for the input, apply it to the surrogate model and evaluate its cost
+    as step t of the episode. A module, so the controller parameters can be substituted with
+    torch.func.functional_call
+    """
+
+    def __init__(self, controller : nn.Module, env : nn.Module, loss=episode_loss) -> None:
+        super().__init__()
+        self.controller = controller
+        self.env = env
+        self.loss = loss
+
+    def forward(self, uref: torch.Tensor, yref: torch.Tensor, u_ini: torch.Tensor, y_ini: torch.Tensor,
+                t=0, final=True) -> tuple:
+        m, p = self.controller.m, self.controller.p
+        action = self.controller(uref=uref, yref=yref, u_ini=u_ini, y_ini=y_ini)[0][:,:m]
+        obs = self.env(y_ini[:,-p:], action)
+        loss = self.loss(Y=(obs - yref[:,:p]).unsqueeze(1), U=(action - uref[:,:m]).unsqueeze(1),
+                         controller=self.controller, start=t, final=final)
+        return action, obs, loss
+
+
 class Trainer:
 
-    def __init__(self, controller : nn.Module, env : nn.Module) -> None:
+    def __init__(self, controller : nn.Module, env : nn.Module, loss=episode_loss, dataset=None) -> None:
+
+        """
+        args:
+            - controller : DeePC module to tune
+            - env : Surrogate model, obs = env(y, u)
+            - loss : Closed-loop cost, called as loss(Y=Y, U=U, controller=controller, start=start, final=final)
+                with the errors of a window of the episode (see deepc_hunt.utils.EpisodeLoss)
+            - dataset : TrajectoryDataset the initial conditions are sampled from, defaults to the
+                windows of controller.ud and controller.yd on controller.device, which follow controller.update
+        """
+
         self.controller = controller
         self.env = env
+        self.loss = loss
+        # Data the default dataset was built from, None for a dataset passed by the caller
+        self._dataset_data = None
+        self.dataset = dataset
+        self.step = ClosedLoopStep(controller, env, loss)
         self.opt = optim.Rprop(self.controller.parameters(), lr=0.01, step_sizes=(1e-3,1e2))
         # Box constraints for numerical stability
         self.projection = Projection(lower=1e-5, upper=1e5)
 
-    def run(self, epochs: int, time_steps: int, uref=None, yref=None) -> Dict[str, torch.Tensor]:
+    @property
+    def dataset(self) -> TrajectoryDataset:
+        # controller.update replaces ud and yd, the default dataset is then built again from the new data
+        data = (self.controller.ud, self.controller.yd)
+        if self._dataset_data is not None and any(a is not b for a, b in zip(data, self._dataset_data)):
+            self.dataset = None
+        return self._dataset
+
+    @dataset.setter
+    def dataset(self, dataset) -> None:
+        self._dataset_data = None
+        if dataset is None:
+            controller = self.controller
+            dataset = TrajectoryDataset(
+                ud=controller.ud, yd=controller.yd, Tini=controller.Tini,
+                m=controller.m, p=controller.p, device=controller.device
+            )
+            self._dataset_data = (controller.ud, controller.yd)
+        self._dataset = dataset
+
+    def run(self, epochs: int, time_steps: int, uref=None, yref=None, n_batch=None, tbptt=None,
+            grad='reverse', stratified=False) -> Dict[str, torch.Tensor]:
+
+        """
+        Tune the controller parameters on closed-loop episodes from initial conditions sampled from the data
+        args:
+            - epochs : Number of gradient steps
+            - time_steps : Length of each episode
+            - uref, yref : References with shape (N*m,) and (N*p,), shared by the batch, or with a
+                leading batch dimension of size n_batch. Default to 0
+            - n_batch : Number of episodes per gradient step, defaults to controller.n_batch
+            - tbptt : Truncated backpropagation through time. The loss of every window of tbptt steps is
+                backpropagated at the end of the window and the graph is cut there, so memory is bounded
+                by the window instead of the episode. The gradients of all windows are accumulated into
+                one step per epoch. None backpropagates through the whole episode
+            - grad : 'reverse' backpropagates through the closed-loop graph. 'forward' instead propagates the
+                sensitivities of the trajectory w.r.t. every parameter along the rollout (see forward_mode_episode),
+                which keeps no graph, so memory does not grow with time_steps. Each step solves once and applies
+                the derivative of the solve to one tangent per parameter, and needs a controller with forward-mode
+                derivatives, i.e. DeePC with backend='torch' or closed_form=True
+            - stratified : Sample the initial conditions of an epoch from n_batch equal strata of the
+                data instead of uniformly (see TrajectoryDataset.sample_index)
+        """
+
+        if grad not in ('reverse', 'forward'):
+            raise ValueError(f'Unknown gradient mode {grad}')
+        if grad == 'forward':
+            if tbptt is not None:
+                raise ValueError('tbptt only applies to grad="reverse"')
+            if getattr(self.controller, 'backend', 'torch') != 'torch' and getattr(self.controller, 'closed_form', None) is not True:
+                raise ValueError('grad="forward" needs backend="torch" or closed_form=True, CvxpyLayer has no forward mode')
 
         pbar = tqdm(range(epochs), ncols=100)
+        n_batch = n_batch or self.controller.n_batch
+        device = self.controller.device
+        m, p = self.controller.m, self.controller.p
         
         # If uref and yref haven't beend passed, assume 0
         if uref is None: 
-            uref = torch.zeros(self.controller.m)
-            uref = uref.repeat(self.controller.n_batch, self.controller.N)
+            uref = torch.zeros(m*self.controller.N)
         if yref is None: 
-            yref = torch.zeros(self.controller.p)
-            yref = yref.repeat(self.controller.n_batch, self.controller.N)
+            yref = torch.zeros(p*self.controller.N)
+        uref = torch.atleast_2d(uref).expand(n_batch, -1).to(device)
+        yref = torch.atleast_2d(yref).expand(n_batch, -1).to(device)
 
         for _ in pbar:
             
-            # Get random initial signal from data
-            u_ini, y_ini = sample_initial_signal(
-                Tini=self.controller.Tini, 
-                m=self.controller.m, p=self.controller.p, 
-                batch=self.controller.n_batch, 
-                ud=self.controller.ud, 
-                yd=self.controller.yd
-            )
-            u_ini = u_ini.to(self.controller.device)
-            y_ini = y_ini.to(self.controller.device)
-            uT, yT = u_ini, y_ini
+            # Get random initial signal from data, already on the device
+            u_ini, y_ini = self.dataset.sample(n_batch, stratified=stratified)
 
-            # For collecting closed-loop cost
-            Y = torch.Tensor().to(self.controller.device)
-            U = torch.Tensor().to(self.controller.device)
-
-            # Begin simulation 
-            for _ in range(time_steps):
-                
-                # Solve for input
-                decision_vars = self.controller(uref=uref, yref=yref, u_ini=u_ini, y_ini=y_ini)
-                u_pred = decision_vars[0]
-                action = u_pred[:,:self.controller.m]
-            
-                # Apply input to surrogate model
-                obs = self.env(y_ini[:,-self.controller.p:], action)
-
-                # Collect closed-loop cost
-                real_y = yref[:,:self.controller.p].unsqueeze(1)
-                real_u = uref[:,:self.controller.m].unsqueeze(1)
-                Y = torch.cat((Y, obs.unsqueeze(1) - real_y.to(self.controller.device)), axis=1)
-                U = torch.cat((U, action.unsqueeze(1) - real_u.to(self.controller.device)), axis=1)
-
-                # Update initial condition
-                uT = torch.cat((uT, action), 1)
-                yT = torch.cat((yT, obs), 1)
-                y_ini = yT[:,-self.controller.p*self.controller.Tini:]
-                u_ini = uT[:,-self.controller.m*self.controller.Tini:]
-            
-            # Compute loss and take gradient step
-            loss = episode_loss(Y=Y, U=U, controller=self.controller)
+            # Simulate, compute the gradient and take gradient step
             self.opt.zero_grad()
-            loss.backward(retain_graph=True)
+            if grad == 'forward':
+                _, grads = self.forward_mode_episode(uref=uref, yref=yref, u_ini=u_ini, y_ini=y_ini, time_steps=time_steps)
+                for param, g in zip(self.controller.parameters(), grads):
+                    param.grad = g
+            else:
+                self.reverse_mode_episode(uref=uref, yref=yref, u_ini=u_ini, y_ini=y_ini, time_steps=time_steps, tbptt=tbptt)
             self.opt.step()
             self.controller.apply(self.projection)
             
             description = ''
             for name, param in self.controller.named_parameters():
-                description += f'{name} : {param.data.item():.3f}, '
+                value = f'{param.data.item():.3f}' if param.numel() == 1 else str([round(v, 3) for v in param.data.flatten().tolist()])
+                description += f'{name} : {value}, '
             pbar.set_description(description)
         
         for name, param in self.controller.named_parameters():
             print(f'Name : {name}, Value : {param.data}')
 
-        return {k: param for k, param in self.controller.named_parameters()}
\ No newline at end of file
+        return {k: param for k, param in self.controller.named_parameters()}
+
+    def reverse_mode_episode(self, uref: torch.Tensor, yref: torch.Tensor, u_ini: torch.Tensor, y_ini: torch.Tensor,
+                             time_steps: int, tbptt=None) -> float:
+
+        """
+        Closed-loop cost of an episode, backpropagated into the gradients of the controller parameters
+        every tbptt steps (see run). Returns the loss
+        """
+
+        m, p, Tini = self.controller.m, self.controller.p, self.controller.Tini
+        n_batch = u_ini.shape[0]
+        window = tbptt or time_steps
+        real_u, real_y = uref[:,:m], yref[:,:p]
+        total = 0
+
+        # Sliding windows of the last Tini inputs and outputs, one entry per time step
+        u_window = deque(u_ini.split(m, dim=1), maxlen=Tini)
+        y_window = deque(y_ini.split(p, dim=1), maxlen=Tini)
+        # Closed-loop trajectory of the episode, allocated at the first step with the dtype of the signals.
+        # Every window writes its slice
+        Y, U = None, None
+
+        # Begin simulation 
+        for start in range(0, time_steps, window):
+            steps = min(window, time_steps - start)
+            if Y is not None:
+                # The backward pass of the previous window freed its graph, the buffers are reused without it
+                Y, U = Y.detach(), U.detach()
+
+            for t in range(steps):
+
+                # Solve for input
+                u_ini, y_ini = torch.cat(tuple(u_window), 1), torch.cat(tuple(y_window), 1)
+                decision_vars = self.controller(uref=uref, yref=yref, u_ini=u_ini, y_ini=y_ini)
+                u_pred = decision_vars[0]
+                action = u_pred[:,:m]
+
+                # Apply input to surrogate model
+                obs = self.env(y_window[-1], action)
+
+                # Collect closed-loop cost
+                if Y is None:
+                    Y = obs.new_empty((n_batch, time_steps, p))
+                    U = action.new_empty((n_batch, time_steps, m))
+                Y[:,start + t] = obs - real_y
+                U[:,start + t] = action - real_u
+
+                # Update initial condition
+                u_window.append(action)
+                y_window.append(obs)
+
+            # Compute loss of the window and accumulate its gradient, which frees its graph
+            loss = self.loss(Y=Y[:,start:start + steps], U=U[:,start:start + steps], controller=self.controller,
+                             start=start, final=start + steps == time_steps)
+            loss.backward()
+            total += loss.item()
+            if start + window < time_steps:
+                u_window = deque((u.detach() for u in u_window), maxlen=Tini)
+                y_window = deque((y.detach() for y in y_window), maxlen=Tini)
+        return total
+
+    def forward_mode_episode(self, uref: torch.Tensor, yref: torch.Tensor, u_ini: torch.Tensor, y_ini: torch.Tensor,
+                             time_steps: int) -> tuple:
+
+        """
+        Closed-loop cost of an episode and its gradient w.r.t. the controller parameters in forward mode.
+        Every input and output in the window of the last Tini steps carries its sensitivity w.r.t. all
+        parameters, shape (n_params, n_batch, dim). At each step, torch.func.jvp pushes those sensitivities
+        and the unit tangents of the parameters through the step, batched over the parameters with
+        torch.func.vmap, so the controller solves once and its derivative is applied to all tangents at once.
+        Random draws are shared by the tangents (randomness='same'), so a stochastic env draws the same noise
+        as in reverse mode. Nothing but the window is kept, so memory is independent of time_steps.
+        Returns : the loss and the gradients, in the order of controller.parameters()
+        """
+
+        m, p, Tini = self.controller.m, self.controller.p, self.controller.Tini
+        params = {f'controller.{name}': param.detach() for name, param in self.controller.named_parameters()}
+        sizes = [param.numel() for param in params.values()]
+        k = sum(sizes)
+        n_batch = u_ini.shape[0]
+
+        def window(signal, dim):
+            return deque(((s, s.new_zeros((k, n_batch, dim))) for s in signal.split(dim, dim=1)), maxlen=Tini)
+
+        # Unit tangent of every parameter entry, batched over the leading dimension
+        eye = torch.eye(k, dtype=torch.float64)
+        tangents = {name: tangent.reshape(k, *param.shape).to(param)
+                    for (name, param), tangent in zip(params.items(), eye.split(sizes, dim=1))}
+
+        u_window, y_window = window(u_ini, m), window(y_ini, p)
+        loss, grad = 0, torch.zeros(k, dtype=torch.float64)
+        with torch.no_grad():
+            for t in range(time_steps):
+                u, du = (torch.cat(v, -1) for v in zip(*u_window))
+                y, dy = (torch.cat(v, -1) for v in zip(*y_window))
+
+                def step(params, u, y):
+                    return functional_call(self.step, params, (uref, yref, u, y, t, t == time_steps - 1))
+
+                def tangent_step(d_params, du, dy):
+                    return jvp(step, (params, u, y), (d_params, du, dy))
+
+                (action, obs, step_loss), (d_action, d_obs, d_loss) = vmap(
+                    tangent_step, randomness='same', out_dims=(None, 0)
+                )(tangents, du, dy)
+                loss += step_loss.item()
+                grad += d_loss.to(grad)
+                u_window.append((action, d_action))
+                y_window.append((obs, d_obs))
+        return loss, [g.reshape(param.shape).to(param) for g, param in zip(grad.split(sizes), params.values())]
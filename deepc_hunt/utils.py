@@ -1,30 +1,85 @@
+import os
+import struct
+import hashlib
+import zipfile
+import warnings
+import itertools
 import numpy as np
+import scipy.fft
+import scipy.linalg
+import scipy.sparse.linalg
 import matplotlib.pyplot as plt
 import torch
 from torch import nn
 from torch.autograd import Variable
 from torch.nn import Parameter
+from collections import OrderedDict
+from typing import NamedTuple
 
-def episode_loss(Y : torch.Tensor, U : torch.Tensor, controller) -> torch.Tensor:
+def episode_loss(Y : torch.Tensor, U : torch.Tensor, controller, start=0, final=True) -> torch.Tensor:
     
     """
-    Calculate loss for for batch trajectory - pretty inificient, look into vectorizing
+    Calculate loss for for batch trajectory, the closed-loop cost sum_t y_t'Q y_t + u_t'R u_t
+    averaged over the batch, with Q = diag(controller.q) and R = diag(controller.r)
     Y should be shape(batch, T, p) - T is length of trajectory
     If doing reference tracking, Y and U are expected to be in delta formulation
+    start and final are part of the loss interface of Trainer (see EpisodeLoss) and not used here
     """
     
-    n_batch = Y.shape[0]
-    T = Y.shape[1]
-    phi = torch.Tensor().to(controller.device)
-    Q, R = torch.diag(controller.q).to(controller.device), torch.diag(controller.r).to(controller.device)
-    
-    for i in range(n_batch):
-        Ct = 0
-        for j in range(T):
-            Ct += (Y[i,j,:].T @ Q @ Y[i,j,:] + U[i,j,:].T @ R @ U[i,j,:]).reshape(1)
-        phi = torch.cat((phi, Ct), axis=0)
-    loss = torch.sum(phi)/n_batch
-    return loss
+    return EpisodeLoss()(Y=Y, U=U, controller=controller)
+
+class EpisodeLoss(nn.Module):
+
+    """
+    Closed-loop cost of a batch of trajectories Y with shape (batch, T, p) and U with shape (batch, T, m),
+    averaged over the batch
+
+        sum_t gamma^t (y_t'Q y_t + u_t'R u_t) + gamma^T_end y_T'Q_T y_T
+        + penalty * sum_t gamma^t (|max(y_t - y_upper, 0, y_lower - y_t)|^2 + same for u_t)
+
+    Q, R and Q_T are diagonal and only their diagonals are used. Every term is computed for the whole
+    batch and horizon at once. Trainer calls the loss with the window of the episode Y and U belong to:
+    start is the time step of their first entry and final tells whether they end the episode, which is
+    where the terminal cost is added.
+    """
+
+    def __init__(self, q=None, r=None, q_terminal=None, discount=1.0, y_bounds=None, u_bounds=None, penalty=0.0) -> None:
+
+        """
+        args:
+            - q, r : Diagonals of Q and R, default to controller.q and controller.r at each call, so they
+                follow the parameters being trained
+            - q_terminal : Diagonal of the terminal cost Q_T on the last output, None for no terminal cost
+            - discount : Per-step discount factor gamma
+            - y_bounds, u_bounds : (lower, upper) bounds of the soft constraints in the coordinates of Y and U
+                (in delta formulation when tracking a reference), each of shape (p,) / (m,) or a scalar
+            - penalty : Weight of the squared constraint violations
+        """
+
+        super().__init__()
+        self.q, self.r = q, r
+        self.q_terminal = q_terminal
+        self.discount = discount
+        self.y_bounds, self.u_bounds = y_bounds, u_bounds
+        self.penalty = penalty
+
+    def forward(self, Y: torch.Tensor, U: torch.Tensor, controller, start=0, final=True) -> torch.Tensor:
+        n_batch, T = Y.shape[0], Y.shape[1]
+        q = (controller.q if self.q is None else torch.as_tensor(self.q)).to(Y)
+        r = (controller.r if self.r is None else torch.as_tensor(self.r)).to(U)
+        w = self.discount**torch.arange(start, start + T, dtype=Y.dtype, device=Y.device)
+
+        loss = torch.einsum('btp,p,t->', Y*Y, q, w) + torch.einsum('btm,m,t->', U*U, r, w)
+        if self.penalty:
+            for X, bounds in ((Y, self.y_bounds), (U, self.u_bounds)):
+                if bounds is not None:
+                    lower, upper = (torch.as_tensor(b).to(X) for b in bounds)
+                    violation = torch.relu(X - upper) + torch.relu(lower - X)
+                    loss = loss + self.penalty*torch.einsum('bti,t->', violation*violation, w)
+        if final and self.q_terminal is not None:
+            q_terminal = torch.as_tensor(self.q_terminal).to(Y)
+            loss = loss + w[-1]*torch.einsum('bp,p->', Y[:,-1]*Y[:,-1], q_terminal)
+        return loss/n_batch
 
 def sample_initial_signal(Tini : int, p : int, m : int, batch : int, ud : np.array, yd : np.array) -> torch.Tensor:
     
@@ -37,6 +92,7 @@ def sample_initial_signal(Tini : int, p : int, m : int, batch : int, ud : np.arr
         batch = nunmber of batches
         ud  = System input data
         yd = system output data
+    See TrajectoryDataset for repeated sampling from the same data
     """
     
     if ud.ndim > 1: T = ud.shape[0]
@@ -46,43 +102,435 @@ def sample_initial_signal(Tini : int, p : int, m : int, batch : int, ud : np.arr
     high=T-Tini-1 
     if batch>T:
         raise Exception('Biased estimate of closed loop cost')
-    index = np.random.uniform(size=(batch,), low=0, high=high).astype(np.uint8)
-    if ud.ndim > 1:
-        sampled_uini = np.array([ud[ind:Tini + ind, :].reshape((Tini*m,)) for ind in index])
-    else:
-        sampled_uini = np.array([ud[ind:Tini + ind] for ind in index])
-    if yd.ndim > 1:
-        sampled_yini = np.array([yd[ind:Tini + ind, :].reshape((Tini*p,)) for ind in index])
-    else:
-        sampled_yini = np.array([yd[ind:Tini + ind] for ind in index])
+    index = np.random.uniform(size=(batch,), low=0, high=high).astype(np.int64)
+    windows = lambda w, d: np.lib.stride_tricks.sliding_window_view(np.reshape(w, (T, d)), Tini, axis=0)
+    sampled_uini = windows(ud, m)[index].transpose(0, 2, 1).reshape((batch, Tini*m))
+    sampled_yini = windows(yd, p)[index].transpose(0, 2, 1).reshape((batch, Tini*p))
 
     u_ini, y_ini = torch.Tensor(sampled_uini), torch.Tensor(sampled_yini)
     return u_ini, y_ini
 
+class TrajectoryDataset:
+
+    """
+    Initial trajectories (u_ini, y_ini) of length Tini from the data ud, yd.
+
+    The data is moved to the device once and viewed as its T - Tini + 1 overlapping windows
+    (Tensor.unfold, no copy), so every batch is drawn by indexing on the device and sampling
+    does no NumPy work and no host to device transfer of the data. On the CPU with a matching
+    dtype, the tensors share the memory of ud and yd, e.g. of memory maps from load_data.
+    """
+
+    def __init__(self, ud: np.ndarray, yd: np.ndarray, Tini: int, m: int, p: int,
+                 device='cpu', dtype=None, seed=None) -> None:
+
+        """
+        args:
+            - ud, yd : Input and output data with shape (T, m) and (T, p), or flattened
+            - Tini : Length of the initial trajectories
+            - m, p : Dimension of input and output signal
+            - device : Device of the sampled tensors
+            - dtype : dtype of the sampled tensors, defaults to torch.get_default_dtype()
+            - seed : Seed of the generator used for sampling, None uses the global torch generator
+        """
+
+        dtype = dtype or torch.get_default_dtype()
+        self.Tini, self.m, self.p = Tini, m, p
+        self.ud = as_tensor(np.reshape(ud, (-1, m)), dtype=dtype, device=device)
+        self.yd = as_tensor(np.reshape(yd, (-1, p)), dtype=dtype, device=device)
+        if self.ud.shape[0] != self.yd.shape[0]:
+            raise ValueError(f'ud and yd have different lengths, {self.ud.shape[0]} and {self.yd.shape[0]}')
+        if self.ud.shape[0] < Tini:
+            raise ValueError(f'Data of length {self.ud.shape[0]} is shorter than Tini = {Tini}')
+        # (windows, dim, Tini) views
+        self.u_windows = self.ud.unfold(0, Tini, 1)
+        self.y_windows = self.yd.unfold(0, Tini, 1)
+        self.device = self.ud.device
+        self.generator = None if seed is None else torch.Generator().manual_seed(seed)
+
+    def __len__(self) -> int:
+        return self.u_windows.shape[0]
+
+    def __getitem__(self, index) -> tuple:
+
+        """
+        Initial trajectories starting at the time steps index, with shapes (..., Tini*m) and (..., Tini*p)
+        """
+
+        index = torch.as_tensor(index, device=self.device)
+        u_ini = self.u_windows[index].transpose(-1, -2).reshape(*index.shape, self.Tini*self.m)
+        y_ini = self.y_windows[index].transpose(-1, -2).reshape(*index.shape, self.Tini*self.p)
+        return u_ini, y_ini
+
+    def sample_index(self, batch: int, replace=True, stratified=False) -> torch.Tensor:
+
+        """
+        Start time steps of a batch of initial trajectories
+        args:
+            - batch : Number of trajectories
+            - replace : Sample uniformly with replacement, otherwise without
+            - stratified : Split the windows into batch contiguous strata of (almost) equal size and draw
+                one window from each, which spreads the batch over the whole data
+        """
+
+        n = len(self)
+        if (stratified or not replace) and batch > n:
+            raise ValueError(f'Cannot draw {batch} distinct windows out of {n}')
+        if stratified:
+            edges = torch.linspace(0, n, batch + 1, dtype=torch.float64)
+            offset = torch.rand(batch, generator=self.generator, dtype=torch.float64)
+            index = (edges[:-1] + offset*(edges[1:] - edges[:-1])).long().clamp(max=n - 1)
+        elif replace:
+            index = torch.randint(n, (batch,), generator=self.generator)
+        else:
+            index = torch.randperm(n, generator=self.generator)[:batch]
+        return index.to(self.device)
+
+    def sample(self, batch: int, replace=True, stratified=False) -> tuple:
+
+        """
+        Batch of initial trajectories (u_ini, y_ini) with shapes (batch, Tini*m) and (batch, Tini*p),
+        see sample_index for the arguments
+        """
+
+        return self[self.sample_index(batch, replace=replace, stratified=stratified)]
+
 def block_hankel(w: np.ndarray, L: int, d: int) -> np.ndarray:
     """
     Builds block Hankel matrix for column vector w of order L
+    Column j is w[d*j:d*(L+j)], so H is returned as a read-only strided float64 view of w
+    that shares its memory, and slices of H are views of w as well. w is converted to float64
+    first, which only copies it if it has another dtype, e.g. integer data
     args:
         w = column vector
         p = dimension of each block in w
         L = order of hankel matrix
     """
+    w = np.asarray(w, dtype=float)
     T = int(len(w)/d)
     if L > T:
         raise ValueError('L must be smaller than T')
-    H = np.zeros((L*d, T-L+1))
-    for i in range(0, T-L+1):
-        H[:,i] = w[d*i:d*(L+i)]
-    return H
+    return np.lib.stride_tricks.sliding_window_view(w[:T*d], L*d)[::d].T
 
 def block_hankel_torch(w: torch.Tensor, L: int, d: int) -> torch.Tensor:
+    """
+    Torch version of block_hankel, returns a strided view of w
+    """
+    T = int(len(w)/d)
+    if L > T:
+        raise ValueError('L must be smaller than T')
+    return w[:T*d].unfold(0, L*d, d).T
+
+def page_matrix(w: np.ndarray, L: int, d: int) -> np.ndarray:
+    """
+    Builds the Page matrix of column vector w of order L, the block Hankel matrix
+    with non-overlapping columns w[d*L*j:d*L*(j+1)], as a view of w.
+    Its columns are independent trajectories, which makes noise on the data entries independent too
+    args:
+        w = column vector
+        d = dimension of each block in w
+        L = order of page matrix
+    """
+    T = int(len(w)/d)
+    if L > T:
+        raise ValueError('L must be smaller than T')
+    cols = T//L
+    return w[:cols*L*d].reshape(cols, L*d).T
+
+def page_matrix_torch(w: torch.Tensor, L: int, d: int) -> torch.Tensor:
+    """
+    Torch version of page_matrix, returns a view of w
+    """
     T = int(len(w)/d)
     if L > T:
         raise ValueError('L must be smaller than T')
-    H = torch.zeros((L*d, T-L+1))
-    for i in range(0, T-L+1):
-        H[:,i] = w[d*i:d*(L+i)]
-    return H
+    cols = T//L
+    return w[:cols*L*d].reshape(cols, L*d).T
+
+class Excitation(NamedTuple):
+    """
+    Result of check_excitation
+        exciting = True if the block Hankel matrix has full row rank
+        rank = numerical rank of the block Hankel matrix
+        rows = number of rows, L*d
+        margin = estimate of the smallest singular value, how far the data is from losing excitation
+        sigma_max = largest singular value, margin/sigma_max is the relative margin
+    """
+    exciting: bool
+    rank: int
+    rows: int
+    margin: float
+    sigma_max: float
+
+_excitation_cache = OrderedDict()
+
+def check_excitation(w: np.ndarray, L: int, d: int, tol=None, chunk=2**16) -> Excitation:
+    """
+    Checks whether w is persistently exciting of order L, i.e. block_hankel(w, L, d) has full row rank,
+    without the full SVD of np.linalg.matrix_rank.
+    The Gram matrix H@H.T (L*d x L*d) is accumulated over chunks of columns of the Hankel view, and
+    its eigenvalues confirm full row rank whenever the smallest singular value is resolved by them.
+    Only data that is (close to) rank deficient falls back to a rank revealing QR of H.
+    Results are cached by the hash of w.
+    args:
+        w = column vector
+        L = order of the excitation
+        d = dimension of each block in w
+        tol = singular values below tol count as zero, defaults to the tolerance of np.linalg.matrix_rank
+        chunk = number of columns per block of the Gram matrix, bounds the temporary memory
+    """
+    w = np.ascontiguousarray(w, dtype=float)
+    key = (hashlib.sha1(memoryview(w)).hexdigest(), L, d, tol)
+    if key in _excitation_cache:
+        _excitation_cache.move_to_end(key)
+        return _excitation_cache[key]
+
+    H = block_hankel(w, L, d)
+    rows, cols = H.shape
+    eps = np.finfo(float).eps
+    G = np.zeros((rows, rows))
+    for start in range(0, cols, chunk):
+        block = H[:,start:start + chunk]
+        G += block @ block.T
+    ev = np.linalg.eigvalsh(G)
+    sigma_max = float(np.sqrt(max(ev[-1], 0)))
+    margin = float(np.sqrt(max(ev[0], 0)))
+    if tol is None:
+        tol = sigma_max*max(rows, cols)*eps
+
+    # The eigenvalues of G are accurate to about rows*eps*sigma_max**2,
+    # so they only resolve singular values above sqrt(rows*eps)*sigma_max
+    if rows <= cols and margin > max(tol, 10*np.sqrt(rows*eps)*sigma_max):
+        result = Excitation(True, rows, rows, margin, sigma_max)
+    else:
+        R = scipy.linalg.qr(H.T, mode='r', pivoting=True)[0]
+        diag = np.abs(np.diag(R))
+        rank = int((diag > tol).sum())
+        margin = float(diag[-1]) if rows <= cols else 0.0
+        result = Excitation(rank == rows, rank, rows, margin, sigma_max)
+
+    _excitation_cache[key] = result
+    while len(_excitation_cache) > 32:
+        _excitation_cache.popitem(last=False)
+    return result
+
+class HankelOperator:
+
+    """
+    Matrix-free block Hankel matrix H = block_hankel(w, L, d) for NumPy arrays or torch tensors.
+
+    Entry ((i, k), j) of H is w[d*(i+j)+k], so for every channel k the products
+    H@g and H.T@v are correlations of the data sequence w[k::d] with g and v.
+    With method='fft' they are evaluated with FFTs of length about T, i.e. in
+    O(d*T*log T) per product instead of O(L*d*T), and the FFT of the data is
+    computed once. method='direct' multiplies with the strided view of block_hankel,
+    which is faster for small L. Neither materializes H. The torch products are
+    differentiable, with respect to the data as well.
+    """
+
+    def __init__(self, w, L: int, d: int, method='auto') -> None:
+
+        """
+        args:
+            - w : Data vector, np.ndarray or torch.Tensor
+            - L : Order of the Hankel matrix (number of block rows)
+            - d : Dimension of each block in w
+            - method : 'fft', 'direct' or 'auto' (fft for L >= 32)
+        """
+
+        T = int(len(w)/d)
+        if L > T:
+            raise ValueError('L must be smaller than T')
+        if method == 'auto':
+            method = 'fft' if L >= 32 else 'direct'
+        if method not in ('fft', 'direct'):
+            raise ValueError(f'Unknown method {method}')
+        self.torch = isinstance(w, torch.Tensor)
+        self.w = w[:T*d]
+        self.T, self.L, self.d, self.method = T, L, d, method
+        self.shape = (L*d, T - L + 1)
+        if method == 'fft':
+            self.n_fft = scipy.fft.next_fast_len(T, real=True)
+            x = self.w.reshape(T, d).T
+            self.X = torch.fft.rfft(x, self.n_fft) if self.torch else scipy.fft.rfft(x, self.n_fft)
+
+    def rows(self, start: int, stop: int) -> 'HankelOperator':
+
+        """
+        Operator of the block rows start:stop of H, e.g. Up = U.rows(0, Tini), Uf = U.rows(Tini, Tini + N).
+        These are the Hankel matrix of order stop - start of the data shifted by start blocks
+        """
+
+        if not 0 <= start < stop <= self.L:
+            raise ValueError(f'Block rows must satisfy 0 <= start < stop <= {self.L}')
+        d, cols = self.d, self.shape[1]
+        return HankelOperator(self.w[d*start:d*(stop + cols - 1)], stop - start, d, method=self.method)
+
+    def _correlate(self, v, length: int):
+        # c[..., k, j] = sum_i x_k[j + i] v[..., k, i] for j < length, v has shape (..., d or 1, n)
+        n = v.shape[-1]
+        if self.torch:
+            V = torch.fft.rfft(v.flip(-1), self.n_fft)
+            c = torch.fft.irfft(self.X*V, self.n_fft)
+        else:
+            V = scipy.fft.rfft(v[...,::-1], self.n_fft)
+            c = scipy.fft.irfft(self.X*V, self.n_fft)
+        return c[..., n - 1:n - 1 + length]
+
+    def matvec(self, g):
+
+        """
+        H@g for g with shape (..., T - L + 1), returns shape (..., L*d)
+        """
+
+        if self.method == 'direct':
+            H = block_hankel_torch(self.w, self.L, self.d) if self.torch else block_hankel(self.w, self.L, self.d)
+            return g @ H.T
+        y = self._correlate(g[...,None,:], self.L) # (..., d, L)
+        y = y.transpose(-1, -2) if self.torch else np.swapaxes(y, -1, -2)
+        return y.reshape(*g.shape[:-1], self.L*self.d)
+
+    def rmatvec(self, v):
+
+        """
+        H.T@v for v with shape (..., L*d), returns shape (..., T - L + 1)
+        """
+
+        if self.method == 'direct':
+            H = block_hankel_torch(self.w, self.L, self.d) if self.torch else block_hankel(self.w, self.L, self.d)
+            return v @ H
+        v = v.reshape(*v.shape[:-1], self.L, self.d)
+        v = v.transpose(-1, -2) if self.torch else np.swapaxes(v, -1, -2)
+        c = self._correlate(v, self.shape[1]) # (..., d, T - L + 1)
+        return c.sum(-2) if self.torch else c.sum(axis=-2)
+
+    def to_dense(self):
+        H = block_hankel_torch(self.w, self.L, self.d) if self.torch else block_hankel(self.w, self.L, self.d)
+        return H.clone() if self.torch else np.array(H)
+
+    def aslinearoperator(self) -> scipy.sparse.linalg.LinearOperator:
+
+        """
+        scipy LinearOperator of a NumPy HankelOperator, e.g. for scipy.sparse.linalg.lsqr
+        """
+
+        if self.torch:
+            raise TypeError('aslinearoperator requires NumPy data')
+        return scipy.sparse.linalg.LinearOperator(
+            self.shape, matvec=self.matvec, rmatvec=self.rmatvec,
+            matmat=lambda G: self.matvec(G.T).T, rmatmat=lambda V: self.rmatvec(V.T).T, dtype=self.w.dtype
+        )
+
+def reduce_hankel(Up: np.ndarray, Yp: np.ndarray, Uf: np.ndarray, Yf: np.ndarray, rank: int) -> tuple:
+    """
+    Projects the data matrices onto the leading right singular vectors V of [Up; Yp; Uf; Yf],
+    i.e. g = V@z with z of dimension rank, so the size of the decision variable
+    no longer grows with the length of the data. Exact as long as rank >= rank of [Up; Yp; Uf; Yf].
+    args:
+        Up, Yp, Uf, Yf = data matrices with the same number of columns
+        rank = number of singular vectors to keep
+    Returns the data matrices Up@V, Yp@V, Uf@V, Yf@V and V
+    """
+    H = np.vstack([Up, Yp, Uf, Yf])
+    if not 0 < rank <= min(H.shape):
+        raise ValueError(f'rank must be between 1 and {min(H.shape)}')
+    U, s, Vt = np.linalg.svd(H, full_matrices=False)
+    HV = U[:,:rank]*s[:rank]
+    splits = np.cumsum([Up.shape[0], Yp.shape[0], Uf.shape[0]])
+    return (*np.split(HV, splits), Vt[:rank].T)
+
+def row_space_basis(H: np.ndarray, rcond=1e-15) -> np.ndarray:
+    """
+    Orthonormal basis V of the row space of H from a thin SVD, so pinv(H)@H = V@V.T
+    and the projector onto the null space is I - V@V.T.
+    V has shape (columns of H, rank of H), linear instead of quadratic in the number of columns
+    args:
+        H = matrix
+        rcond = singular values below rcond*largest count as zero, as in np.linalg.pinv
+    """
+    _, s, Vt = np.linalg.svd(H, full_matrices=False)
+    rank = int((s > rcond*s.max()).sum()) if s.size else 0
+    return Vt[:rank].T
+
+class RowSpaceBasis:
+
+    """
+    Orthonormal basis V of the row space of a wide matrix H as in row_space_basis, kept up to date
+    while columns are appended to H or slid through it, e.g. when new samples extend a Hankel matrix.
+    Adding k columns is a rank-k modification of the thin SVD H = U@diag(s)@V.T (Brand, 2006), which
+    only needs the SVD of a (rank + k) x (rank + k) matrix, so an update costs O((rows + cols)*(rank + k)^2)
+    instead of the O(rows^2*cols) of a new SVD, and H itself is not needed.
+    """
+
+    def __init__(self, H: np.ndarray, rcond=1e-15) -> None:
+
+        """
+        args:
+            - H : Initial matrix with shape (rows, cols)
+            - rcond : Singular values below rcond*largest count as zero, as in row_space_basis
+        """
+
+        self.rcond = rcond
+        self.rows = H.shape[0]
+        U, s, Vt = np.linalg.svd(H, full_matrices=False)
+        self._truncate(U, s, Vt.T)
+
+    @property
+    def basis(self) -> np.ndarray:
+        return self.V
+
+    def _truncate(self, U: np.ndarray, s: np.ndarray, V: np.ndarray) -> None:
+        rank = min(int((s > self.rcond*s.max()).sum()) if s.size else 0, self.rows, V.shape[0])
+        self.U, self.s, self.V = U[:,:rank], s[:rank], V[:,:rank]
+
+    @staticmethod
+    def _orthogonalize(Q: np.ndarray, X: np.ndarray) -> tuple:
+        # X = Q@M + J@R with J orthonormal and orthogonal to Q, Gram-Schmidt applied twice for stability
+        M = Q.T@X
+        X = X - Q@M
+        M2 = Q.T@X
+        J, R = np.linalg.qr(X - Q@M2)
+        return M + M2, J, R
+
+    def update(self, columns: np.ndarray, slide=False) -> np.ndarray:
+
+        """
+        Replace H by [H, columns], or by [H[:,k:], columns] with slide=True, for columns of shape (rows, k).
+        Returns the new basis
+        """
+
+        columns = np.asarray(columns, dtype=float).reshape(self.rows, -1)
+        k = columns.shape[1]
+        U, s, V = self.U, self.s, self.V
+        if slide:
+            # [H[:,k:], columns] = H@S + (columns - H[:,:k])@E.T with the cyclic shift S of the columns
+            # by k and E the last k columns of the identity, and the row space basis of H@S is S.T@V
+            X = columns - (U*s)@V[:k].T
+            V = np.roll(V, -k, axis=0)
+        else:
+            X = columns
+            V = np.vstack([V, np.zeros((k, V.shape[1]))])
+        E = np.zeros((V.shape[0], k))
+        E[-k:] = np.eye(k)
+        Mx, Jx, Rx = self._orthogonalize(U, X)
+        My, Jy, Ry = self._orthogonalize(V, E)
+
+        # H + X@E.T = [U, Jx]@K@[V, Jy].T
+        r = s.size
+        K = np.zeros((r + k, r + k))
+        K[:r,:r] = np.diag(s)
+        K += np.vstack([Mx, Rx])@np.vstack([My, Ry]).T
+        Uk, s, Vkt = np.linalg.svd(K)
+        self._truncate(np.hstack([U, Jx])@Uk, s, np.hstack([V, Jy])@Vkt.T)
+        return self.V
+
+def psd_sqrt(M: np.ndarray) -> np.ndarray:
+    """
+    Symmetric square root S of a positive semidefinite matrix M, S@S = M.
+    Lets quadratic costs be written as sum_squares(S@x), which keeps parametrized problems DPP
+    """
+    w, V = np.linalg.eigh((M + M.T)/2)
+    return (V*np.sqrt(np.clip(w, 0, None)))@V.T
 
 class Projection(object):
 
@@ -109,4 +557,110 @@ def tensor2np(tensor : torch.Tensor) -> np.ndarray:
     # Converts a Tensor to NumPy array
     if torch.is_tensor(tensor):
         return tensor.detach().cpu().numpy()
-    else: return tensor
\ No newline at end of file
+    else: return tensor
+
+def as_tensor(a, dtype=None, device=None) -> torch.Tensor:
+    """
+    torch.as_tensor that also shares the memory of read-only arrays, e.g. memory maps opened with
+    mmap_mode='r', instead of warning about them. The tensor must not be written to then.
+    A copy is only made when dtype or device differ from those of a
+    """
+    if isinstance(a, np.ndarray) and not a.flags.writeable:
+        with warnings.catch_warnings():
+            warnings.filterwarnings('ignore', message='The given NumPy array is not writable')
+            return torch.as_tensor(a).to(dtype=dtype, device=device)
+    return torch.as_tensor(a, dtype=dtype, device=device)
+
+def csv_to_npy(path: str, out=None, delimiter=',', chunk=2**16) -> str:
+    """
+    Converts a CSV file of numbers to .npy once, so it can be memory-mapped by load_data.
+    The file is parsed in chunks of rows straight into the memory-mapped output, so memory stays bounded
+    by the chunk, and the output is written under a temporary name and then renamed, so concurrent
+    conversions of the same file do not read half-written data.
+    Like np.genfromtxt, a single column gives an array of shape (T,), otherwise (T, columns)
+    args:
+        path = CSV file
+        out = .npy file, defaults to path with the extension .npy
+        delimiter = column delimiter
+        chunk = number of rows parsed at a time
+    Returns the path of the .npy file
+    """
+    out = out or os.path.splitext(path)[0] + '.npy'
+    rows, cols = 0, None
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                cols = cols or len(line.split(delimiter))
+                rows += 1
+    if rows == 0:
+        raise ValueError(f'{path} contains no data')
+
+    tmp = f'{out}.{os.getpid()}.tmp'
+    data = np.lib.format.open_memmap(tmp, mode='w+', dtype=float, shape=(rows,) if cols == 1 else (rows, cols))
+    with open(path) as f:
+        lines = (line for line in f if line.strip())
+        start = 0
+        while start < rows:
+            block = np.loadtxt(itertools.islice(lines, chunk), delimiter=delimiter, ndmin=2)
+            data[start:start + len(block)] = block.reshape((len(block),) + data.shape[1:])
+            start += len(block)
+    data.flush()
+    del data
+    os.replace(tmp, out)
+    return out
+
+def _npz_memmap(path: str, key=None, mmap_mode='r') -> np.memmap:
+    # Members of an uncompressed .npz (np.savez) are .npy files stored as is, so they can be memory-mapped
+    # at the offset of their data in the archive
+    with zipfile.ZipFile(path) as archive:
+        names = [name[:-4] for name in archive.namelist() if name.endswith('.npy')]
+        if key is None:
+            if len(names) != 1:
+                raise ValueError(f'{path} holds the arrays {names}, pass key')
+            key = names[0]
+        if key not in names:
+            raise ValueError(f'{path} holds no array {key}, only {names}')
+        info = archive.getinfo(key + '.npy')
+    if info.compress_type != zipfile.ZIP_STORED:
+        raise ValueError(f'{key} in {path} is compressed and cannot be memory-mapped, save it with np.savez')
+    with open(path, 'rb') as f:
+        # Local file header: 30 bytes, then the file name and the extra field
+        f.seek(info.header_offset)
+        name_length, extra_length = struct.unpack('<HH', f.read(30)[26:30])
+        f.seek(info.header_offset + 30 + name_length + extra_length)
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+    return np.memmap(path, dtype=dtype, mode=mmap_mode, offset=offset, shape=shape, order='F' if fortran else 'C')
+
+def load_data(path: str, key=None, mmap_mode='r', delimiter=',') -> np.ndarray:
+    """
+    Loads ud or yd from a .npy, .npz or CSV file, memory-mapped by default.
+    Nothing is read until it is used, and processes mapping the same file share its pages, so e.g. the
+    processes of a sweep hold the data once. A CSV file is converted to .npy next to it on the
+    first call (see csv_to_npy), and again whenever the CSV file is newer than the .npy file.
+    Memory maps can be passed to DeePC, npDeePC, sample_initial_signal and TrajectoryDataset as is,
+    they are not copied.
+    args:
+        path = .npy, uncompressed .npz (np.savez) or CSV file
+        key = name of the array in a .npz file, may be left out if it holds only one
+        mmap_mode = mode of np.memmap, 'r' is read-only, None loads the data into memory
+        delimiter = column delimiter of a CSV file
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext not in ('.npy', '.npz'):
+        npy = os.path.splitext(path)[0] + '.npy'
+        if not os.path.exists(npy) or os.path.getmtime(npy) < os.path.getmtime(path):
+            csv_to_npy(path, npy, delimiter=delimiter)
+        path, ext = npy, '.npy'
+    if ext == '.npy':
+        return np.load(path, mmap_mode=mmap_mode)
+    if mmap_mode is None:
+        with np.load(path) as archive:
+            if key is None and len(archive.files) != 1:
+                raise ValueError(f'{path} holds the arrays {archive.files}, pass key')
+            return archive[archive.files[0] if key is None else key]
+    return _npz_memmap(path, key, mmap_mode)
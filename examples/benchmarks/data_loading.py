@@ -0,0 +1,72 @@
+# Startup time and memory of loading a large logged experiment with np.genfromtxt and with
+# deepc_hunt.utils.load_data, which converts the CSV file to .npy once and memory-maps it afterwards.
+# A synthetic log of T samples is written to a temporary directory. Every load is done in a fresh
+# process, so the growth of its peak resident memory can be measured, and is followed by the
+# excitation check and by sampling initial trajectories, which only touch the memory map.
+# Run from the repository root: python examples/benchmarks/data_loading.py
+import os
+import time
+import tempfile
+import resource
+import argparse
+import multiprocessing as mp
+import numpy as np
+import torch
+from deepc_hunt.utils import load_data, check_excitation, sample_initial_signal, TrajectoryDataset
+
+Tini, m, p = 4, 3, 6
+
+
+def write_log(directory: str, T: int) -> tuple:
+    rng = np.random.default_rng(0)
+    paths = []
+    for name, dim in (('ud', m), ('yd', p)):
+        path = os.path.join(directory, f'{name}.csv')
+        np.savetxt(path, rng.standard_normal((T, dim)), delimiter=',')
+        paths.append(path)
+    return tuple(paths)
+
+
+def load(method: str, ud_path: str, yd_path: str) -> tuple:
+
+    """
+    Load the log with 'genfromtxt' or 'load_data', returns the load time, the time of the
+    excitation check and of sampling, and the growth of the peak resident memory in MB
+    """
+
+    base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    if method == 'genfromtxt':
+        ud, yd = np.genfromtxt(ud_path, delimiter=','), np.genfromtxt(yd_path, delimiter=',')
+    else:
+        ud, yd = load_data(ud_path), load_data(yd_path)
+    loaded = time.perf_counter()
+    check_excitation(w=ud.reshape(-1), L=Tini + 10 + p, d=m)
+    checked = time.perf_counter()
+    np.random.seed(0)
+    sample_initial_signal(Tini=Tini, p=p, m=m, batch=256, ud=ud, yd=yd)
+    TrajectoryDataset(ud, yd, Tini, m, p, dtype=torch.float64, seed=0).sample(256)
+    sampled = time.perf_counter()
+    peak = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base)/1024
+    return loaded - start, checked - loaded, sampled - checked, peak
+
+
+def benchmark(T: int) -> None:
+    ctx = mp.get_context('spawn')
+    with tempfile.TemporaryDirectory() as directory:
+        ud_path, yd_path = write_log(directory, T)
+        print(f'T = {T}, {(os.path.getsize(ud_path) + os.path.getsize(yd_path))/2**20:.0f} MB of CSV')
+        print(f'{"load":>22} {"load [s]":>9} {"excitation [s]":>15} {"sampling [s]":>13} {"peak RSS [MB]":>14}')
+        for method, label in (('genfromtxt', 'np.genfromtxt'), ('load_data', 'load_data (convert)'),
+                              ('load_data', 'load_data (mmap)')):
+            with ctx.Pool(1) as pool:
+                elapsed, check, sample, peak = pool.apply(load, (method, ud_path, yd_path))
+            print(f'{label:>22} {elapsed:>9.2f} {check:>15.2f} {sample:>13.3f} {peak:>14.0f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='CSV vs memory-mapped loading of ud/yd')
+    parser.add_argument('--T', type=int, default=10**6)
+    args = parser.parse_args()
+
+    benchmark(args.T)
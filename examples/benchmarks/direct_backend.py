@@ -0,0 +1,91 @@
+# Per-step latency of npDeePC and npMPC on the rocket data with the CVXPY backend
+# and the direct sparse backends (backend='osqp' / 'clarabel', deepc_hunt.direct.SparseQP).
+# npMPC is run with the sparse and the condensed formulation, and npMPC.solve_many
+# solves a batch of initial states at once. The actions are compared with those of CVXPY + Clarabel.
+# Run from the repository root: python examples/benchmarks/direct_backend.py
+import os
+import time
+import argparse
+import numpy as np
+import cvxpy as cp
+from deepc_hunt.controllers import npDeePC, npMPC
+from deepc_hunt.dynamics import RocketDx
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data')
+Tf = 10
+Q, R = np.diag([100,10,5,1,3000,30]), np.eye(3)*0.01
+y_constraints = (np.kron(np.ones(Tf), np.array([0,7,-100,-100,-0.6,-100])),
+                 np.kron(np.ones(Tf), np.array([33,26.6,100,100,0.6,100])))
+u_constraints = (np.kron(np.ones(Tf), np.array([0,-1,-1])), np.kron(np.ones(Tf), np.array([1,1,1])))
+x_eq = np.array([16.6,7.47,0,0,0,0])
+
+
+def run(controller, steps: int, ud: np.ndarray, yd: np.ndarray, **kwargs) -> tuple:
+
+    """
+    Solve steps consecutive steps along the data, returns the actions and the solve times
+    """
+
+    y_ref, u_ref = np.tile(x_eq, Tf), np.zeros(3*Tf)
+    actions, times = [], []
+    for i in range(steps):
+        start = time.perf_counter()
+        if isinstance(controller, npDeePC):
+            action, _ = controller.solve(y_ref=y_ref, u_ref=u_ref, u_ini=ud[i], y_ini=yd[i], **kwargs)
+        else:
+            action, _ = controller.solve(y_ref=y_ref, u_ref=u_ref, y_ini=yd[i], **kwargs)
+        times.append(time.perf_counter() - start)
+        actions.append(action)
+    return np.array(actions), np.array(times)
+
+
+def benchmark(steps: int) -> None:
+    ud = np.genfromtxt(os.path.join(DATA, 'rocket_ud.csv'), delimiter=',')
+    yd = np.genfromtxt(os.path.join(DATA, 'rocket_yd.csv'), delimiter=',')
+    A, B = RocketDx(true_model=True).linearise(x_eq=x_eq, u_eq=np.zeros(3), discrete=True)
+
+    def deepc(backend):
+        return npDeePC(ud=ud, yd=yd, u_constraints=u_constraints, y_constraints=y_constraints,
+                       Tini=1, N=Tf, m=3, p=6, n=6, backend=backend, solvers=[cp.CLARABEL]
+                       ).setup(Q=Q, R=R, lam_g1=50, lam_g2=8, lam_y=1000)
+
+    def mpc(backend, formulation='sparse'):
+        return npMPC(A=A, B=B, Q=Q, R=R, N=Tf, u_constraints=u_constraints, y_constraints=y_constraints,
+                     backend=backend, formulation=formulation).setup()
+
+    def condensed(backend):
+        return mpc(backend, 'condensed')
+
+    print(f'{"controller":>17} {"backend":>9} {"mean [ms]":>10} {"p95 [ms]":>10} {"max diff":>10}')
+    for name, make, kwargs in (('npDeePC', deepc, {}), ('npMPC', mpc, {'solver': cp.CLARABEL}),
+                               ('npMPC condensed', condensed, {'solver': cp.CLARABEL})):
+        reference = None
+        for backend in ('cvxpy', 'osqp', 'clarabel'):
+            controller = make(backend)
+            # The first step compiles the problem or sets up the solver workspace
+            run(controller, 1, ud, yd, **kwargs)
+            actions, times = run(controller, steps, ud, yd, **kwargs)
+            if reference is None:
+                reference = actions
+            diff = np.abs(actions - reference).max()
+            print(f'{name:>17} {backend:>9} {1e3*times.mean():>10.2f} {1e3*np.percentile(times, 95):>10.2f} {diff:>10.2e}')
+
+    # Batches of initial states, the first call sets up the workspace and the active sets
+    controller = mpc('cvxpy')
+    rng = np.random.default_rng(0)
+    y_ref, u_ref = np.tile(x_eq, Tf), np.zeros(3*Tf)
+    controller.solve_many(yd[:steps], y_ref, u_ref)
+    actions, _ = controller.solve_many(yd[:steps], y_ref, u_ref)
+    print(f'solve_many on the same {steps} states: max diff {np.abs(actions - reference).max():.2e}')
+    for n_batch in (100, 1000):
+        start = time.perf_counter()
+        controller.solve_many(yd[rng.integers(0, len(yd), n_batch)], y_ref, u_ref)
+        print(f'solve_many, batch of {n_batch}: {1e3*(time.perf_counter() - start)/n_batch:.2f} ms per state')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Direct sparse QP backends')
+    parser.add_argument('--steps', type=int, default=50)
+    args = parser.parse_args()
+
+    benchmark(args.steps)
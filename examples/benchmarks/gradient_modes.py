@@ -0,0 +1,84 @@
+# Wall-clock time and peak memory of one Trainer epoch on the Recht data with reverse-mode
+# backpropagation (full and truncated) and with forward-mode sensitivities, Trainer.run(grad='forward').
+# Every run is done in a fresh process, so the peak resident memory of the run can be measured.
+# Run from the repository root: python examples/benchmarks/gradient_modes.py
+import os
+import time
+import resource
+import argparse
+import multiprocessing as mp
+import numpy as np
+import torch
+from deepc_hunt import DeePC
+from deepc_hunt.dynamics import AffineDynamics
+from deepc_hunt.trainer import Trainer
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data')
+
+
+def make_trainer(n_batch: int) -> Trainer:
+
+    """
+    Trainer of a nonlinear, stochastic DeePC on the Recht data with learnable q and r,
+    solved with the torch backend, and a noisy, stable linear surrogate model
+    """
+
+    torch.set_default_dtype(torch.float64)
+    ud = np.genfromtxt(os.path.join(DATA, 'recht_ud.csv'), delimiter=',')
+    yd = np.genfromtxt(os.path.join(DATA, 'recht_yd.csv'), delimiter=',')
+    Tini, Tf, p, m = 4, 10, 3, 3
+    controller = DeePC(
+        ud=ud, yd=yd, N=Tf, Tini=Tini, p=p, m=m, n_batch=n_batch, device='cpu',
+        y_constraints=(-np.ones(Tf*p)*10, np.ones(Tf*p)*10), u_constraints=(-np.ones(Tf*m)*5, np.ones(Tf*m)*5),
+        q=torch.nn.Parameter(torch.ones(p)*50), r=torch.nn.Parameter(torch.ones(m)*2),
+        linear=False, stochastic_y=True, backend='torch'
+    )
+    torch.manual_seed(0)
+    controller.initialise(lam_y=50, lam_g1=50, lam_g2=50)
+    A = torch.tensor([[0.9, 0.01, 0], [0.01, 0.9, 0.01], [0, 0.01, 0.9]])
+    return Trainer(controller, AffineDynamics(A=A, B=torch.eye(3)))
+
+
+def epoch(mode: str, time_steps: int, n_batch: int) -> tuple:
+
+    """
+    One epoch in mode 'reverse', 'forward' or 'tbptt=k', returns the time, the growth of the
+    peak resident memory and the gradients
+    """
+
+    trainer = make_trainer(n_batch)
+    kwargs = {'grad': 'forward'} if mode == 'forward' else {}
+    if mode.startswith('tbptt='):
+        kwargs = {'tbptt': int(mode[6:])}
+    trainer.opt = torch.optim.SGD(trainer.controller.parameters(), lr=0.0)
+    base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    np.random.seed(0)
+    torch.manual_seed(0)
+    start = time.perf_counter()
+    trainer.run(epochs=1, time_steps=time_steps, **kwargs)
+    elapsed = time.perf_counter() - start
+    peak = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base)/1024
+    grad = torch.cat([param.grad.reshape(-1) for param in trainer.controller.parameters()])
+    return elapsed, peak, grad
+
+
+def benchmark(horizons: list, modes: list, n_batch: int) -> None:
+    ctx = mp.get_context('spawn')
+    print(f'{"steps":>6} {"mode":>9} {"time [s]":>9} {"peak RSS [MB]":>14} {"rel. grad diff":>15}')
+    for time_steps in horizons:
+        reference = None
+        for mode in modes:
+            with ctx.Pool(1) as pool:
+                elapsed, peak, grad = pool.apply(epoch, (mode, time_steps, n_batch))
+            if reference is None:
+                reference = grad
+            diff = ((grad - reference).abs().max()/reference.abs().max()).item()
+            print(f'{time_steps:>6} {mode:>9} {elapsed:>9.2f} {peak:>14.0f} {diff:>15.2e}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Reverse- vs forward-mode gradients in Trainer')
+    parser.add_argument('--n_batch', type=int, default=16)
+    args = parser.parse_args()
+
+    benchmark([25, 50, 100], ['reverse', 'forward', 'tbptt=10'], args.n_batch)
@@ -0,0 +1,53 @@
+# Time of H@g and H.T@v for a block Hankel matrix H of long data,
+# dense (materialized), strided view and FFT (deepc_hunt.utils.HankelOperator).
+# Run from the repository root: python examples/benchmarks/hankel_operator.py
+import time
+import argparse
+import numpy as np
+from deepc_hunt.utils import HankelOperator, block_hankel
+
+
+def timeit(f, reps: int) -> float:
+    f()
+    start = time.perf_counter()
+    for _ in range(reps):
+        f()
+    return (time.perf_counter() - start)/reps
+
+
+def benchmark(lengths: list, L: int, d: int, n_batch: int, reps: int) -> None:
+
+    """
+    Time a batch of n_batch matrix-vector products with H and H.T for every data length
+    """
+
+    rng = np.random.default_rng(0)
+    print(f'L = {L}, d = {d}, batch of {n_batch} products')
+    print(f'{"T":>9} {"dense [s]":>10} {"view [s]":>10} {"fft [s]":>10} {"max error":>10}')
+    for T in lengths:
+        w = rng.standard_normal(T*d)
+        direct, fft = HankelOperator(w, L, d, method='direct'), HankelOperator(w, L, d, method='fft')
+        g = rng.standard_normal((n_batch, direct.shape[1]))
+        v = rng.standard_normal((n_batch, direct.shape[0]))
+
+        # The dense matrix needs L*d*T floats, skip it when that exceeds ~1 GB
+        if L*d*T*8 < 2**30:
+            H = np.array(block_hankel(w, L, d))
+            t_dense = timeit(lambda: (g @ H.T, v @ H), reps)
+        else:
+            t_dense = float('nan')
+        t_view = timeit(lambda: (direct.matvec(g), direct.rmatvec(v)), reps)
+        t_fft = timeit(lambda: (fft.matvec(g), fft.rmatvec(v)), reps)
+        error = max(np.abs(fft.matvec(g) - direct.matvec(g)).max(), np.abs(fft.rmatvec(v) - direct.rmatvec(v)).max())
+        print(f'{T:>9} {t_dense:>10.4f} {t_view:>10.4f} {t_fft:>10.4f} {error:>10.2e}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Matrix-free Hankel products')
+    parser.add_argument('--L', type=int, default=100)
+    parser.add_argument('--d', type=int, default=3)
+    parser.add_argument('--n_batch', type=int, default=8)
+    parser.add_argument('--reps', type=int, default=3)
+    args = parser.parse_args()
+
+    benchmark([10**3, 10**4, 10**5, 10**6], args.L, args.d, args.n_batch, args.reps)
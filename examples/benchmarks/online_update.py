@@ -0,0 +1,86 @@
+# Per-step cost of adaptive DeePC on the rocket data, where every step slides one new sample into the data:
+# constructing a new controller on the shifted data against controller.update(u, y), which updates the
+# Hankel blocks and the basis of PI in place (deepc_hunt.utils.RowSpaceBasis) and, for npDeePC with
+# online=True, keeps the compiled CVXPY problem. Solving a step without new data is the baseline.
+# The actions of both are compared, they agree up to the tolerance of the solvers.
+# Run from the repository root: python examples/benchmarks/online_update.py
+import os
+import time
+import argparse
+import warnings
+import numpy as np
+import cvxpy as cp
+import torch
+from deepc_hunt import DeePC
+from deepc_hunt.controllers import npDeePC
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data')
+Tf = 10
+Q, R = np.diag([100,10,5,1,3000,30]), np.eye(3)*0.01
+y_constraints = (np.kron(np.ones(Tf), np.array([0,7,-100,-100,-0.6,-100])),
+                 np.kron(np.ones(Tf), np.array([33,26.6,100,100,0.6,100])))
+u_constraints = (np.kron(np.ones(Tf), np.array([0,-1,-1])), np.kron(np.ones(Tf), np.array([1,1,1])))
+y_ref, u_ref = np.tile(np.array([16.6,7.47,0,0,0,0]), Tf), np.zeros(3*Tf)
+
+
+def np_deepc(ud: np.ndarray, yd: np.ndarray, backend: str, online=False) -> npDeePC:
+    return npDeePC(ud=ud, yd=yd, u_constraints=u_constraints, y_constraints=y_constraints, Tini=1, N=Tf,
+                   m=3, p=6, n=6, backend=backend, solvers=[cp.CLARABEL], online=online
+                   ).setup(Q=Q, R=R, lam_g1=50, lam_g2=8, lam_y=1000)
+
+
+def deepc(ud: np.ndarray, yd: np.ndarray) -> DeePC:
+    controller = DeePC(ud=ud, yd=yd, N=Tf, Tini=1, p=6, m=3, device='cpu', y_constraints=y_constraints,
+                       u_constraints=u_constraints, q=torch.tensor(np.diag(Q)), r=torch.tensor(np.diag(R)),
+                       lam_g1=torch.tensor([50.]), lam_g2=torch.tensor([8.]), lam_y=torch.tensor([1000.]),
+                       linear=False, stochastic_y=True, backend='torch').eval()
+    return controller
+
+
+def step(controller, u_ini: np.ndarray, y_ini: np.ndarray) -> np.ndarray:
+    if isinstance(controller, npDeePC):
+        return controller.solve(y_ref=y_ref, u_ref=u_ref, u_ini=u_ini, y_ini=y_ini)[0]
+    u = controller(yref=torch.tensor(y_ref), uref=torch.tensor(u_ref),
+                   u_ini=torch.tensor(u_ini), y_ini=torch.tensor(y_ini))[0]
+    return u[:3].numpy()
+
+
+def benchmark(T: int, steps: int) -> None:
+    torch.set_default_dtype(torch.float64)
+    ud = np.genfromtxt(os.path.join(DATA, 'rocket_ud.csv'), delimiter=',')
+    yd = np.genfromtxt(os.path.join(DATA, 'rocket_yd.csv'), delimiter=',')
+    if T + steps > len(ud):
+        raise ValueError(f'T + steps must be at most {len(ud)}')
+
+    print(f'{"controller":>24} {"solve [ms]":>11} {"rebuild [ms]":>13} {"update [ms]":>12} {"max diff":>10}')
+    for name, make in (('npDeePC cvxpy', lambda u, y: np_deepc(u, y, 'cvxpy')),
+                       ('npDeePC cvxpy online', lambda u, y: np_deepc(u, y, 'cvxpy', online=True)),
+                       ('npDeePC osqp', lambda u, y: np_deepc(u, y, 'osqp')),
+                       ('DeePC torch', deepc)):
+        solve, rebuild, update, diff = [], [], [], 0.0
+        controller = make(ud[:T], yd[:T])
+        step(controller, ud[0], yd[0])
+        for t in range(steps):
+            start = time.perf_counter()
+            step(controller, ud[t], yd[t])
+            solve.append(time.perf_counter() - start)
+        for t in range(T, T + steps):
+            start = time.perf_counter()
+            reference = step(make(ud[t - T + 1:t + 1], yd[t - T + 1:t + 1]), ud[t], yd[t])
+            rebuild.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            controller.update(ud[t], yd[t])
+            action = step(controller, ud[t], yd[t])
+            update.append(time.perf_counter() - start)
+            diff = max(diff, np.abs(action - reference).max())
+        print(f'{name:>24} {1e3*np.mean(solve):>11.1f} {1e3*np.mean(rebuild):>13.1f} {1e3*np.mean(update):>12.1f} {diff:>10.2e}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Online updates of the DeePC data')
+    parser.add_argument('--T', type=int, default=200)
+    parser.add_argument('--steps', type=int, default=20)
+    args = parser.parse_args()
+
+    warnings.simplefilter('ignore')
+    benchmark(args.T, args.steps)
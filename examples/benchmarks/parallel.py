@@ -0,0 +1,80 @@
+# Forward + backward time of DeePC (cvxpylayers backend) vs. batch size and number of workers.
+# Run from the repository root: python examples/benchmarks/parallel.py --parallel process
+# Every batch element is solved on its own, so the outputs and gradients must
+# be identical for every number of workers, which is checked against n_jobs=1.
+import os
+import time
+import argparse
+import numpy as np
+import torch
+from deepc_hunt import DeePC
+from deepc_hunt.utils import sample_initial_signal
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data')
+
+
+def make_controller(n_batch: int, n_jobs: int, parallel: str) -> tuple:
+
+    """
+    DeePC for the Recht data with the settings used in the examples
+    """
+
+    ud = np.genfromtxt(os.path.join(DATA, 'recht_ud.csv'), delimiter=',')
+    yd = np.genfromtxt(os.path.join(DATA, 'recht_yd.csv'), delimiter=',')
+    Tini, Tf, p, m = 4, 10, 3, 3
+    controller = DeePC(
+        ud=ud, yd=yd, N=Tf, Tini=Tini, p=p, m=m, n_batch=n_batch, device='cpu',
+        y_constraints=(-np.ones(Tf*p)*10, np.ones(Tf*p)*10),
+        u_constraints=(-np.ones(Tf*m)*5, np.ones(Tf*m)*5),
+        q=torch.ones(3)*50, r=torch.ones(3)*2, stochastic_y=True, stochastic_u=True,
+        n_jobs=n_jobs, parallel=parallel
+    )
+    torch.manual_seed(0)
+    controller.initialise(lam_y=50, lam_u=50, lam_g1=50, lam_g2=50)
+    return controller, ud, yd
+
+
+def benchmark(batch_sizes: list, jobs: list, parallel: str, reps: int) -> None:
+
+    """
+    Time forward + backward for every (batch size, n_jobs) pair and report the
+    largest deviation of the outputs and gradients from the n_jobs=1 run
+    """
+
+    print(f'parallel = {parallel}, {os.cpu_count()} cpus')
+    print(f'{"n_batch":>8} {"n_jobs":>7} {"time [s]":>10} {"speedup":>8} {"max diff":>10}')
+    for n_batch in batch_sizes:
+        reference, base_time = None, None
+        for n_jobs in jobs:
+            np.random.seed(0)
+            controller, ud, yd = make_controller(n_batch, n_jobs, parallel)
+            samples = [sample_initial_signal(controller.Tini, controller.p, controller.m, n_batch, ud, yd) for _ in range(reps)]
+            yref = torch.zeros(n_batch, controller.N*controller.p)
+            uref = torch.zeros(n_batch, controller.N*controller.m)
+
+            # First call forks the worker processes
+            controller(yref=yref, uref=uref, u_ini=samples[0][0], y_ini=samples[0][1])
+            start, result = time.perf_counter(), []
+            for u_ini, y_ini in samples:
+                out = controller(yref=yref, uref=uref, u_ini=u_ini, y_ini=y_ini)
+                (out[0].pow(2).sum() + out[1].pow(2).sum()).backward()
+                result += [o.detach() for o in out[:2]]
+            elapsed = (time.perf_counter() - start)/reps
+            result += [param.grad.clone().reshape(-1) for param in controller.parameters()]
+
+            if reference is None:
+                reference, base_time = result, elapsed
+            diff = max((a - b).abs().max().item() for a, b in zip(result, reference))
+            print(f'{n_batch:>8} {n_jobs:>7} {elapsed:>10.4f} {base_time/elapsed:>8.2f} {diff:>10.2e}')
+            if controller._pool is not None:
+                controller._pool.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Scaling of DeePC with the number of workers')
+    parser.add_argument('--parallel', default='process', choices=['thread', 'process'])
+    parser.add_argument('--reps', type=int, default=3)
+    args = parser.parse_args()
+
+    jobs = sorted({1, 2, 4, os.cpu_count()})
+    benchmark([8, 16, 32], jobs, args.parallel, args.reps)
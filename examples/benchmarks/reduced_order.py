@@ -0,0 +1,90 @@
+# Solve time vs. accuracy of DeePC(svd_rank=...) on the rocket and Recht data.
+# Run from the repository root: python examples/benchmarks/reduced_order.py
+# With the norm1 regularizer on g, even a full rank basis changes the solution,
+# since the norm1 minimizer generally has components outside the row space of the data.
+import os
+import time
+import argparse
+import numpy as np
+import torch
+from deepc_hunt import DeePC
+from deepc_hunt.utils import sample_initial_signal
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data')
+
+
+def make_controller(dataset: str, backend: str, svd_rank=None, n_batch=8) -> tuple:
+
+    """
+    DeePC for the rocket or Recht data with the settings used in the examples
+    """
+
+    ud = np.genfromtxt(os.path.join(DATA, f'{dataset}_ud.csv'), delimiter=',')
+    yd = np.genfromtxt(os.path.join(DATA, f'{dataset}_yd.csv'), delimiter=',')
+    if dataset == 'rocket':
+        Tini, Tf, p, m = 1, 10, 6, 3
+        y_constraints = (np.kron(np.ones(Tf), np.array([0,7,-100,-100,-0.6,-100])),
+                         np.kron(np.ones(Tf), np.array([33,26.6,100,100,0.6,100])))
+        u_constraints = (np.kron(np.ones(Tf), np.array([0,-1,-1])), np.kron(np.ones(Tf), np.array([1,1,1])))
+        q, r = torch.Tensor([100,10,5,1,3000,30]), torch.Tensor([0.01,0.01,0.01])
+        kwargs = dict(linear=False, stochastic_y=True, stochastic_u=False)
+    else:
+        Tini, Tf, p, m = 4, 10, 3, 3
+        y_constraints = (-np.ones(Tf*p)*10, np.ones(Tf*p)*10)
+        u_constraints = (-np.ones(Tf*m)*5, np.ones(Tf*m)*5)
+        q, r = torch.ones(3)*50, torch.ones(3)*2
+        kwargs = dict(linear=False, stochastic_y=True, stochastic_u=True)
+
+    controller = DeePC(
+        ud=ud, yd=yd, N=Tf, Tini=Tini, p=p, m=m, n_batch=n_batch, device='cpu',
+        y_constraints=y_constraints, u_constraints=u_constraints, q=q, r=r,
+        backend=backend, svd_rank=svd_rank, **kwargs
+    )
+    torch.manual_seed(0)
+    controller.initialise(lam_y=50, lam_u=50, lam_g1=50, lam_g2=50)
+    return controller, ud, yd
+
+
+def benchmark(dataset: str, backend: str, ranks: list, n_batch: int, reps: int) -> None:
+
+    """
+    Time forward + backward of DeePC for several svd ranks and compare the
+    optimal inputs with the ones of the full order problem
+    """
+
+    np.random.seed(0)
+    controller, ud, yd = make_controller(dataset, backend, n_batch=n_batch)
+    samples = [sample_initial_signal(controller.Tini, controller.p, controller.m, n_batch, ud, yd) for _ in range(reps)]
+    yref = torch.zeros(n_batch, controller.N*controller.p)
+    uref = torch.zeros(n_batch, controller.N*controller.m)
+    if dataset == 'rocket':
+        yref[:,0::6], yref[:,1::6] = 16.6, 7.47
+
+    print(f'{dataset} ({backend}), T = {controller.T}, full order g has {controller.Up.shape[1]} entries')
+    print(f'{"rank":>6} {"time [s]":>10} {"rel. error u":>14}')
+    u_full = None
+    for rank in [None] + ranks:
+        if rank is not None:
+            controller, _, _ = make_controller(dataset, backend, svd_rank=rank, n_batch=n_batch)
+        start, u = time.perf_counter(), []
+        for u_ini, y_ini in samples:
+            out = controller(yref=yref, uref=uref, u_ini=u_ini, y_ini=y_ini)
+            out[0].sum().backward()
+            u.append(out[0].detach())
+        elapsed = (time.perf_counter() - start)/reps
+        u = torch.stack(u)
+        if u_full is None:
+            u_full = u
+        error = ((u - u_full).norm()/u_full.norm()).item()
+        print(f'{"full" if rank is None else rank:>6} {elapsed:>10.4f} {error:>14.2e}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Solve time vs. accuracy of reduced order DeePC')
+    parser.add_argument('--backend', default='torch', choices=['torch', 'cvxpylayers'])
+    parser.add_argument('--n_batch', type=int, default=8)
+    parser.add_argument('--reps', type=int, default=5)
+    args = parser.parse_args()
+
+    benchmark('recht', args.backend, [50, 40, 30, 20], args.n_batch, args.reps)
+    benchmark('rocket', args.backend, [99, 75, 50, 25], args.n_batch, args.reps)
@@ -0,0 +1,85 @@
+# OSQP iterations per step of npDeePC and npMPC with the direct OSQP backend in closed loop on the
+# linearised rocket, started cold (warm_start=False), from the previous solution (warm_start=True)
+# and from the previous solution shifted by one time step (warm_start='shift').
+# The closed-loop actions are compared with those of the cold starts.
+# Run from the repository root: python examples/benchmarks/warm_start.py
+import os
+import argparse
+import numpy as np
+import cvxpy as cp
+from deepc_hunt.controllers import npDeePC, npMPC
+from deepc_hunt.dynamics import RocketDx
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data')
+Tf = 10
+Q, R = np.diag([100,10,5,1,3000,30]), np.eye(3)*0.01
+y_constraints = (np.kron(np.ones(Tf), np.array([0,7,-100,-100,-0.6,-100])),
+                 np.kron(np.ones(Tf), np.array([33,26.6,100,100,0.6,100])))
+u_constraints = (np.kron(np.ones(Tf), np.array([0,-1,-1])), np.kron(np.ones(Tf), np.array([1,1,1])))
+x_eq = np.array([16.6,7.47,0,0,0,0])
+
+
+def rollout(controller, A: np.ndarray, B: np.ndarray, x0: np.ndarray, steps: int, warm_start) -> tuple:
+
+    """
+    Closed loop of the controller on the linearised rocket, x_(t+1) - x_eq = A@(x_t - x_eq) + B@u_t,
+    returns the actions and the OSQP iterations per step
+    """
+
+    y_ref, u_ref = np.tile(x_eq, Tf), np.zeros(3*Tf)
+    x, u_prev = x0.copy(), np.zeros(3)
+    actions = []
+    iterations = controller.iterations
+    for _ in range(steps):
+        u, _ = controller.solve(y_ref=y_ref, u_ref=u_ref, u_ini=u_prev, y_ini=x, warm_start=warm_start)
+        x = x_eq + A@(x - x_eq) + B@u
+        u_prev = u
+        actions.append(u)
+    return np.array(actions), (controller.iterations - iterations)/steps
+
+
+def benchmark(steps: int, runs: int) -> None:
+    ud = np.genfromtxt(os.path.join(DATA, 'rocket_ud.csv'), delimiter=',')
+    yd = np.genfromtxt(os.path.join(DATA, 'rocket_yd.csv'), delimiter=',')
+    A, B = RocketDx(true_model=True).linearise(x_eq=x_eq, u_eq=np.zeros(3), discrete=True)
+
+    def deepc():
+        return npDeePC(ud=ud, yd=yd, u_constraints=u_constraints, y_constraints=y_constraints,
+                       Tini=1, N=Tf, m=3, p=6, n=6, backend='osqp').setup(Q=Q, R=R, lam_g1=50, lam_g2=8, lam_y=1000)
+
+    def mpc(formulation):
+        return lambda: npMPC(A=A, B=B, Q=Q, R=R, N=Tf, u_constraints=u_constraints, y_constraints=y_constraints,
+                             backend='osqp', formulation=formulation).setup()
+
+    rng = np.random.default_rng(0)
+    starts = [x_eq + rng.uniform(-1, 1, 6)*np.array([2, 0, 0.5, 0.5, 0.05, 0.05]) + np.array([0, rng.uniform(0, 2), 0, 0, 0, 0])
+              for _ in range(runs)]
+    modes = (False, True, 'shift')
+    print(f'{"controller":>17} {"warm_start":>11} {"iters/step":>11} {"saved":>7} {"max diff":>10}')
+    for name, make in (('npDeePC', deepc), ('npMPC', mpc('sparse')), ('npMPC condensed', mpc('condensed'))):
+        # Runs where OSQP fails in any mode (maximum iterations) are left out of the comparison
+        results, failed = [], 0
+        for x0 in starts:
+            try:
+                results.append([rollout(make(), A, B, x0, steps, warm_start) for warm_start in modes])
+            except cp.SolverError:
+                failed += 1
+        if not results:
+            print(f'{name:>17} OSQP failed in every run')
+            continue
+        base = np.mean([run[0][1] for run in results])
+        for i, warm_start in enumerate(modes):
+            iterations = np.mean([run[i][1] for run in results])
+            diff = max(np.abs(run[i][0] - run[0][0]).max() for run in results)
+            print(f'{name:>17} {str(warm_start):>11} {iterations:>11.1f} {100*(1 - iterations/base):>6.0f}% {diff:>10.2e}')
+        if failed:
+            print(f'{name:>17} {failed} of {runs} runs left out, OSQP reached its maximum number of iterations')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Warm starts of the direct OSQP backend')
+    parser.add_argument('--steps', type=int, default=50)
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    benchmark(args.steps, args.runs)
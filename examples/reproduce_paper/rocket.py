@@ -77,8 +77,10 @@ if __name__ == '__main__':
     
     max_steps = 1000
     samples = 50
+    warm_start = True # Set to False to see how many solver iterations warm starting saves
     costs = {}
     successful = {}
+    iterations = {}
     random.seed(42)
     seeds = random.sample(range(1,99),samples)
 
@@ -138,6 +140,7 @@ if __name__ == '__main__':
                             y_ref=deepc_reference, u_ref=uref,
                             y_ini=y_past_sim[-p:],
                             u_ini=u_past_sim,
+                            warm_start=warm_start
                         )
                     except:
                         broke = True 
@@ -164,10 +167,13 @@ if __name__ == '__main__':
                 plt.title(f'{x_0} - ({0}) - broke: {broke}')
             plt.savefig(f'final_pos/{name}/{i}.png')
 
+            iterations[name] = (policy.iterations, policy.solves)
             with open('success_dict.pkl', 'wb') as f:
                 pickle.dump(successful, f)
             with open('costs_dict.pkl', 'wb') as f:
                 pickle.dump(costs, f)
+            with open('iterations_dict.pkl', 'wb') as f:
+                pickle.dump(iterations, f)
 
     """
     Display results
@@ -177,7 +183,10 @@ if __name__ == '__main__':
         successful = pickle.load(f)
     with open('costs_dict.pkl', 'rb') as f:
         costs = pickle.load(f)
+    with open('iterations_dict.pkl', 'rb') as f:
+        iterations = pickle.load(f)
 
     for name, key in successful.items():
         print(f'Success rates for {name}: {sum(key)/len(key)}')
-        print(f'Average cpst if landed for {name}: {np.dot(np.array(key),np.array(costs[name]))/sum(key)}')
\ No newline at end of file
+        print(f'Average cpst if landed for {name}: {np.dot(np.array(key),np.array(costs[name]))/sum(key)}')
+        print(f'Average solver iterations per step for {name} (warm_start={warm_start}): {iterations[name][0]/max(iterations[name][1],1)}')
\ No newline at end of file
@@ -0,0 +1,75 @@
+import os
+import numpy as np
+import pytest
+import cvxpy as cp
+import torch
+from deepc_hunt import DeePC
+from deepc_hunt.controllers import npDeePC
+from deepc_hunt.cache import ProblemCache
+from deepc_hunt.utils import TrajectoryDataset
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'examples', 'data')
+Tini, N, m, p = 4, 10, 3, 3
+
+
+def recht_data() -> tuple:
+    ud = np.genfromtxt(os.path.join(DATA, 'recht_ud.csv'), delimiter=',')
+    yd = np.genfromtxt(os.path.join(DATA, 'recht_yd.csv'), delimiter=',')
+    return ud, yd
+
+
+def recht_deepc(cache: ProblemCache) -> DeePC:
+    ud, yd = recht_data()
+    torch.manual_seed(0)
+    return DeePC(ud=ud, yd=yd, N=N, Tini=Tini, m=m, p=p, device='cpu', closed_form=False, cache=cache,
+                 y_constraints=(-np.ones(N*p)*100, np.ones(N*p)*100), u_constraints=(-np.ones(N*m)*5, np.ones(N*m)*5))
+
+
+def test_cached_layer_matches_compiled_one(tmp_path):
+    cache = ProblemCache(str(tmp_path))
+    compiled, cached = recht_deepc(cache), recht_deepc(cache)
+    assert (cache.misses, cache.hits) == (1, 1)
+    ud, yd = recht_data()
+    u_ini, y_ini = TrajectoryDataset(ud, yd, Tini, m, p, seed=0).sample(4)
+    ref_y, ref_u = torch.ones(N*p), torch.zeros(N*m)
+    with torch.no_grad():
+        for a, b in zip(compiled(ref_y, ref_u, u_ini, y_ini), cached(ref_y, ref_u, u_ini, y_ini)):
+            torch.testing.assert_close(a, b)
+    # The layers compiled by update are not stored
+    cached.update(ud[:4], yd[:4])
+    assert len(os.listdir(str(tmp_path))) == 1
+
+
+@pytest.mark.skipif(not hasattr(os, 'getuid'), reason='no file owners on this platform')
+def test_entries_writable_by_others_are_not_loaded(tmp_path):
+    cache = ProblemCache(str(tmp_path))
+    cache.store('entry', [1, 2, 3])
+    assert cache.load('entry') == [1, 2, 3]
+    os.chmod(os.path.join(str(tmp_path), 'entry.pkl'), 0o666)
+    with pytest.warns(RuntimeWarning, match='Ignoring cache entry'):
+        assert cache.load('entry') is None
+    os.chmod(os.path.join(str(tmp_path), 'entry.pkl'), 0o600)
+    os.chmod(str(tmp_path), 0o777)
+    with pytest.warns(RuntimeWarning, match='Ignoring cache entry'):
+        assert cache.load('entry') is None
+    assert os.path.exists(os.path.join(str(tmp_path), 'entry.pkl'))
+
+
+def test_cached_npdeepc_matches_compiled_one(tmp_path):
+    cache = ProblemCache(str(tmp_path))
+    ud, yd = recht_data()
+
+    def recht_npdeepc() -> npDeePC:
+        controller = npDeePC(ud=ud, yd=yd, N=N, Tini=Tini, n=3, m=m, p=p, solvers=[cp.CLARABEL], cache=cache,
+                             y_constraints=(-np.ones(N*p)*100, np.ones(N*p)*100), u_constraints=(-np.ones(N*m)*5, np.ones(N*m)*5))
+        return controller.setup(Q=np.eye(p), R=np.eye(m)*0.1, lam_g1=1, lam_y=10)
+
+    args = dict(y_ref=np.ones(N*p), u_ref=np.zeros(N*m), u_ini=ud[:Tini].reshape(-1), y_ini=yd[:Tini].reshape(-1))
+    compiled = recht_npdeepc()
+    action = compiled.solve(**args)[0]
+    cached = recht_npdeepc()
+    assert (cache.misses, cache.hits) == (1, 1)
+    np.testing.assert_allclose(cached.solve(**args)[0], action, atol=1e-6)
+    # Another regularizer structure is another entry
+    cached.setup(Q=np.eye(p), R=np.eye(m)*0.1, lam_g1=1, lam_g2=1, lam_y=10)
+    assert cache.misses == 2
@@ -0,0 +1,236 @@
+import os
+import numpy as np
+import pytest
+import cvxpy as cp
+import torch
+import torch.nn as nn
+from deepc_hunt import DeePC
+from deepc_hunt.controllers import npDeePC
+from deepc_hunt.utils import TrajectoryDataset
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'examples', 'data')
+Tini, N, m, p = 4, 10, 3, 3
+
+
+def recht_data() -> tuple:
+    ud = np.genfromtxt(os.path.join(DATA, 'recht_ud.csv'), delimiter=',')
+    yd = np.genfromtxt(os.path.join(DATA, 'recht_yd.csv'), delimiter=',')
+    return ud, yd
+
+
+def lti_data(T: int, seed=0) -> tuple:
+    # Random stable system of order 3 with m inputs and p outputs, excited by white noise
+    rng = np.random.default_rng(seed)
+    A = np.linalg.qr(rng.standard_normal((3, 3)))[0]*0.9
+    B, C = rng.standard_normal((3, m)), rng.standard_normal((p, 3))
+    ud, yd, x = rng.standard_normal((T, m)), np.zeros((T, p)), np.zeros(3)
+    for t in range(T):
+        yd[t] = C@x
+        x = A@x + B@ud[t]
+    return ud, yd
+
+
+def make_deepc(ud: np.ndarray, yd: np.ndarray, **kwargs) -> DeePC:
+    torch.manual_seed(0)
+    return DeePC(ud=ud, yd=yd, N=N, Tini=Tini, m=m, p=p, device='cpu',
+                 y_constraints=(-np.ones(N*p)*1e3, np.ones(N*p)*1e3), u_constraints=(-np.ones(N*m)*1e3, np.ones(N*m)*1e3),
+                 **kwargs)
+
+
+def test_closed_form_matches_qp():
+    # The Hankel matrix of the noiseless data is rank deficient
+    ud, yd = recht_data()
+    closed = make_deepc(ud, yd, linear=True, closed_form=True)
+    qp = make_deepc(ud, yd, linear=True, closed_form=False, backend='torch')
+    u_ini, y_ini = TrajectoryDataset(ud, yd, Tini, m, p, dtype=torch.float64, seed=0).sample(8)
+    ref_y, ref_u = torch.ones(N*p, dtype=torch.float64), torch.zeros(N*m, dtype=torch.float64)
+    with torch.no_grad():
+        for a, b in zip(closed(ref_y, ref_u, u_ini, y_ini), qp(ref_y, ref_u, u_ini, y_ini)):
+            torch.testing.assert_close(a, b, rtol=1e-5, atol=1e-5)
+
+
+def test_closed_form_ignores_singular_values_below_rank_cutoff():
+    # The noise lifts the zero singular values of [Up; Yp] to about 1e-14 of the largest one, below the rank cutoff
+    # but above the default cutoff of np.linalg.pinv, so the pseudo-inverse has to use the cutoff of the null space
+    ud, yd = recht_data()
+    noisy = yd + 3e-13*np.random.default_rng(0).standard_normal(yd.shape)
+    exact, closed = make_deepc(ud, yd, closed_form=True), make_deepc(ud, noisy, closed_form=True)
+    Hp = np.vstack([closed.Up, closed.Yp])
+    Hf = np.vstack([closed.Uf, closed.Yf])
+    G = Hf @ np.linalg.pinv(Hp, rcond=max(Hp.shape)*np.finfo(float).eps)
+    np.testing.assert_allclose(closed.cf_G.numpy(), G, rtol=1e-8, atol=1e-8)
+    np.testing.assert_allclose(closed.cf_G.numpy(), exact.cf_G.numpy(), rtol=1e-6, atol=1e-6)
+
+
+def make_npdeepc(ud: np.ndarray, yd: np.ndarray, **kwargs) -> npDeePC:
+    controller = npDeePC(ud=ud, yd=yd, N=N, Tini=Tini, n=3, m=m, p=p, solvers=[cp.CLARABEL],
+                         y_constraints=(-np.ones(N*p)*100, np.ones(N*p)*100), u_constraints=(-np.ones(N*m)*5, np.ones(N*m)*5),
+                         **kwargs)
+    return controller.setup(Q=np.eye(p), R=np.eye(m)*0.1, lam_g1=1, lam_y=10)
+
+
+def test_svd_rank_matches_full_problem():
+    # The leading rank(H) right singular vectors span the row space of H = [Up; Yp; Uf; Yf], and the
+    # optimal g with the (I - PI) regularization lies in it, so the reduced problem is exact
+    ud, yd = recht_data()
+    full = make_npdeepc(ud, yd)
+    rank = np.linalg.matrix_rank(np.vstack([full.Up, full.Yp, full.Uf, full.Yf]))
+    reduced = make_npdeepc(ud, yd, svd_rank=rank)
+    assert reduced.g.shape == (rank,)
+    u_ini, y_ini = TrajectoryDataset(ud, yd, Tini, m, p, dtype=torch.float64, seed=0).sample(4)
+    for ui, yi in zip(u_ini.numpy(), y_ini.numpy()):
+        args = dict(y_ref=np.ones(N*p), u_ref=np.zeros(N*m), u_ini=ui, y_ini=yi)
+        np.testing.assert_allclose(reduced.solve(**args)[0], full.solve(**args)[0], atol=1e-5)
+
+    reduced = make_deepc(ud, yd, linear=True, closed_form=False, backend='torch', svd_rank=rank)
+    full = make_deepc(ud, yd, linear=True, closed_form=False, backend='torch')
+    ref_y, ref_u = torch.ones(N*p, dtype=torch.float64), torch.zeros(N*m, dtype=torch.float64)
+    with torch.no_grad():
+        for a, b in zip(reduced(ref_y, ref_u, u_ini, y_ini), full(ref_y, ref_u, u_ini, y_ini)):
+            torch.testing.assert_close(a, b, rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.parametrize('slide', [True, False])
+@pytest.mark.parametrize('backend, online', [('cvxpy', False), ('cvxpy', True), ('clarabel', False)])
+def test_npdeepc_update_matches_new_controller(backend, online, slide):
+    ud, yd = lti_data(120)
+    T0 = ud.shape[0] - 12
+    start = 12 if slide else 0
+    updated = make_npdeepc(ud[:T0], yd[:T0], backend=backend, online=online)
+    expected = make_npdeepc(ud[start:], yd[start:], backend=backend)
+    args = dict(y_ref=np.ones(N*p), u_ref=np.zeros(N*m), u_ini=ud[:Tini].reshape(-1), y_ini=yd[:Tini].reshape(-1))
+    updated.solve(**args)
+    for i in range(T0, ud.shape[0], 4):
+        updated.update(ud[i:i + 4], yd[i:i + 4], slide=slide)
+    np.testing.assert_allclose(updated.PI_basis@updated.PI_basis.T, expected.PI_basis@expected.PI_basis.T, atol=1e-8)
+    np.testing.assert_allclose(updated.solve(**args)[0], expected.solve(**args)[0], atol=1e-5)
+
+
+@pytest.mark.parametrize('slide', [True, False])
+@pytest.mark.parametrize('backend, closed_form, online', [
+    ('torch', False, False), ('cvxpylayers', False, False), ('cvxpylayers', False, True), ('torch', True, False)
+])
+def test_deepc_update_matches_new_controller(backend, closed_form, online, slide):
+    ud, yd = lti_data(120)
+    T0 = ud.shape[0] - 12
+    start = 12 if slide else 0
+    if closed_form:
+        kwargs = dict(linear=True, closed_form=True)
+    else:
+        kwargs = dict(linear=False, closed_form=False, stochastic_y=True, lam_g1=torch.tensor([1.]), lam_g2=torch.tensor([1.]),
+                      lam_y=torch.tensor([10.]))
+    updated = make_deepc(ud[:T0], yd[:T0], backend=backend, online=online, **kwargs)
+    expected = make_deepc(ud[start:], yd[start:], backend=backend, online=online, **kwargs)
+    layer = getattr(updated, 'QP_layer', None)
+    u_ini, y_ini = TrajectoryDataset(ud, yd, Tini, m, p, dtype=torch.float64, seed=0).sample(4)
+    ref_y, ref_u = torch.ones(N*p, dtype=torch.float64), torch.zeros(N*m, dtype=torch.float64)
+    with torch.no_grad():
+        updated(ref_y, ref_u, u_ini, y_ini)
+        for i in range(T0, ud.shape[0], 4):
+            updated.update(ud[i:i + 4], yd[i:i + 4], slide=slide)
+        for a, b in zip(updated(ref_y, ref_u, u_ini, y_ini), expected(ref_y, ref_u, u_ini, y_ini)):
+            torch.testing.assert_close(a, b, rtol=1e-5, atol=1e-5)
+    if backend == 'cvxpylayers':
+        # With online=True the data are parameters of the layer, only appended samples change the size of the problem
+        assert (updated.QP_layer is layer) == (online and slide)
+
+
+def test_process_pool_solves_unbatched_inputs():
+    ud, yd = recht_data()
+    serial = make_deepc(ud, yd, closed_form=False)
+    pooled = make_deepc(ud, yd, closed_form=False, n_jobs=2, parallel='process')
+    u_ini, y_ini = TrajectoryDataset(ud, yd, Tini, m, p, seed=0).sample(1)
+    ref_y, ref_u = torch.ones(N*p), torch.zeros(N*m)
+    try:
+        with torch.no_grad():
+            for a, b in zip(serial(ref_y, ref_u, u_ini[0], y_ini[0]), pooled(ref_y, ref_u, u_ini[0], y_ini[0])):
+                assert b.shape == a.shape == (N*m,)
+                torch.testing.assert_close(a, b, rtol=1e-5, atol=1e-5)
+    finally:
+        pooled._pool.close()
+
+
+def test_layer_weights_are_vectors_with_exact_gradients():
+    # q and r enter the CvxpyLayer as vectors of length N*p and N*m, and their gradients match the torch backend
+    ud, yd = lti_data(120)
+    u_ini, y_ini = TrajectoryDataset(ud, yd, Tini, m, p, dtype=torch.float64, seed=0).sample(4)
+    ref_y, ref_u = torch.ones(N*p, dtype=torch.float64), torch.zeros(N*m, dtype=torch.float64)
+    grads = []
+    for backend in ('cvxpylayers', 'torch'):
+        q, r = nn.Parameter(torch.ones(p, dtype=torch.float64)), nn.Parameter(torch.ones(m, dtype=torch.float64))
+        controller = make_deepc(ud, yd, backend=backend, closed_form=False, linear=False, q=q, r=r,
+                                lam_g1=torch.tensor([1.]), lam_g2=torch.tensor([0.]))
+        if backend == 'cvxpylayers':
+            assert [param.shape for param in controller.QP_layer.param_order[:2]] == [(N*p,), (N*m,)]
+        u, y = controller(ref_y, ref_u, u_ini, y_ini)
+        ((y**3).sum() + (u*torch.arange(N*m)).sum()).backward()
+        grads.append((q.grad, r.grad))
+    for a, b in zip(*grads):
+        torch.testing.assert_close(a, b, rtol=1e-4, atol=1e-4)
+
+
+@pytest.mark.parametrize('backend', ['cvxpy', 'clarabel'])
+def test_sweep_matches_new_controllers_and_restores_weights(backend):
+    ud, yd = lti_data(120)
+    settings = [dict(Q=np.eye(p)*2), dict(R=np.eye(m), lam_g1=5), dict(lam_y=1)]
+    base = dict(Q=np.eye(p), R=np.eye(m)*0.1, lam_g1=1, lam_y=10)
+    args = dict(y_ref=np.ones(N*p), u_ref=np.zeros(N*m), u_ini=ud[:Tini].reshape(-1), y_ini=yd[:Tini].reshape(-1))
+    controller = make_npdeepc(ud, yd, backend=backend)
+    action = controller.solve(**args)[0]
+    workspace = getattr(controller._qp, '_workspace', None)
+    results = controller.sweep(settings, **args)
+    for setting, (result, _) in zip(settings, results):
+        expected = make_npdeepc(ud, yd, backend=backend).setup(**{**base, **setting})
+        np.testing.assert_allclose(result, expected.solve(**args)[0], atol=1e-5)
+    if backend != 'cvxpy':
+        # The weights are copied into the solver workspace instead of setting up a new one
+        assert controller._qp._workspace is workspace
+    np.testing.assert_allclose(controller.solve(**args)[0], action, atol=1e-6)
+
+    with pytest.raises(ValueError):
+        controller.sweep([dict(Q=np.eye(p)*3, lam_g1=7), dict(lam_g2=1)], **args)
+    assert (controller.lam_g1, controller.lam_y, controller.lam_g2) == (1, 10, None)
+    np.testing.assert_allclose(controller.Q_sqrt.value, np.eye(p))
+    np.testing.assert_allclose(controller.solve(**args)[0], action, atol=1e-6)
+
+
+def test_from_deepc_matches_deepc_in_eval_mode():
+    ud, yd = lti_data(120)
+    deepc = make_deepc(ud, yd, linear=False, stochastic_y=True, lam_g1=torch.tensor([1.]), lam_g2=torch.tensor([0.5]),
+                       lam_y=torch.tensor([10.]))
+    controller = npDeePC.from_deepc(deepc, solvers=[cp.CLARABEL])
+    u_ini, y_ini = TrajectoryDataset(ud, yd, Tini, m, p, dtype=torch.float64, seed=0).sample(3)
+    ref_y, ref_u = torch.ones(N*p, dtype=torch.float64), torch.zeros(N*m, dtype=torch.float64)
+    u, y, _ = deepc.eval()(ref_y, ref_u, u_ini, y_ini)
+    for i in range(3):
+        action, obs = controller.solve(y_ref=ref_y.numpy(), u_ref=ref_u.numpy(), u_ini=u_ini[i].numpy(), y_ini=y_ini[i].numpy())
+        np.testing.assert_allclose(action, u[i,:m].numpy(), atol=1e-4)
+        np.testing.assert_allclose(obs, y[i].numpy(), atol=1e-4)
+
+
+def test_eval_mode_does_not_differentiate():
+    ud, yd = lti_data(120)
+    controller = make_deepc(ud, yd, linear=False, lam_g1=torch.tensor([1.]), lam_g2=torch.tensor([0.5]))
+    u_ini, y_ini = TrajectoryDataset(ud, yd, Tini, m, p, dtype=torch.float64, seed=0).sample(2)
+    ref_y, ref_u = torch.ones(N*p, dtype=torch.float64), torch.zeros(N*m, dtype=torch.float64)
+    assert all(v.grad_fn is None for v in controller.eval()(ref_y, ref_u, u_ini, y_ini))
+    u, y = controller.train()(ref_y, ref_u, u_ini, y_ini)
+    assert u.grad_fn is not None and y.grad_fn is not None
+    (y.sum() + u.sum()).backward()
+    assert controller.q.grad is not None and controller.r.grad is not None
+
+
+def test_layer_takes_batch_size_from_inputs():
+    # n_batch=2 at construction, a batch of 5 with a shared u_ini and uref and per-element y_ini and yref
+    ud, yd = lti_data(120)
+    controller = make_deepc(ud, yd, linear=False, lam_g1=torch.tensor([1.]), lam_g2=torch.tensor([0.5]), n_batch=2).eval()
+    u_ini, y_ini = TrajectoryDataset(ud, yd, Tini, m, p, dtype=torch.float64, seed=0).sample(5)
+    ref_y = torch.rand(5, N*p, generator=torch.Generator().manual_seed(0), dtype=torch.float64)
+    ref_u = torch.zeros(N*m, dtype=torch.float64)
+    u, y = controller(ref_y, ref_u, u_ini[0], y_ini)
+    assert u.shape == (5, N*m) and y.shape == (5, N*p)
+    for i in range(5):
+        u_i, y_i = controller(ref_y[i], ref_u, u_ini[0], y_ini[i])
+        assert u_i.shape == (N*m,) and y_i.shape == (N*p,)
+        torch.testing.assert_close(u[i], u_i, rtol=1e-6, atol=1e-6)
+        torch.testing.assert_close(y[i], y_i, rtol=1e-6, atol=1e-6)
@@ -0,0 +1,85 @@
+import os
+import numpy as np
+import pytest
+import cvxpy as cp
+import scipy.sparse as sp
+from deepc_hunt.controllers import npDeePC, npMPC
+from deepc_hunt.direct import SparseQP
+from deepc_hunt.dynamics import RocketDx
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'examples', 'data')
+Tf = 10
+Q, R = np.diag([100,10,5,1,3000,30]), np.eye(3)*0.01
+y_constraints = (np.kron(np.ones(Tf), np.array([0,7,-100,-100,-0.6,-100])),
+                 np.kron(np.ones(Tf), np.array([33,26.6,100,100,0.6,100])))
+u_constraints = (np.kron(np.ones(Tf), np.array([0,-1,-1])), np.kron(np.ones(Tf), np.array([1,1,1])))
+x_eq = np.array([16.6,7.47,0,0,0,0])
+x0 = x_eq + np.array([1.0, 1.0, 0.2, -0.2, 0.02, 0.0])
+
+
+def rocket_data() -> tuple:
+    ud = np.genfromtxt(os.path.join(DATA, 'rocket_ud.csv'), delimiter=',')
+    yd = np.genfromtxt(os.path.join(DATA, 'rocket_yd.csv'), delimiter=',')
+    return ud, yd
+
+
+def make_controller(name: str, backend: str):
+    ud, yd = rocket_data()
+    A, B = RocketDx(true_model=True).linearise(x_eq=x_eq, u_eq=np.zeros(3), discrete=True)
+    if name == 'npDeePC':
+        controller = npDeePC(ud=ud, yd=yd, u_constraints=u_constraints, y_constraints=y_constraints,
+                             Tini=1, N=Tf, m=3, p=6, n=6, backend=backend, solvers=[cp.CLARABEL])
+        return controller.setup(Q=Q, R=R, lam_g1=50, lam_g2=8, lam_y=1000), A, B
+    formulation = 'condensed' if name == 'npMPC condensed' else 'sparse'
+    controller = npMPC(A=A, B=B, Q=Q, R=R, N=Tf, u_constraints=u_constraints, y_constraints=y_constraints,
+                       backend=backend, formulation=formulation)
+    return controller.setup(), A, B
+
+
+def rollout(controller, A: np.ndarray, B: np.ndarray, steps: int, **kwargs) -> np.ndarray:
+    y_ref, u_ref = np.tile(x_eq, Tf), np.zeros(3*Tf)
+    x, u_prev, actions = x0.copy(), np.zeros(3), []
+    for _ in range(steps):
+        if isinstance(controller, npDeePC):
+            u, _ = controller.solve(y_ref=y_ref, u_ref=u_ref, u_ini=u_prev, y_ini=x, **kwargs)
+        else:
+            u, _ = controller.solve(y_ref=y_ref, u_ref=u_ref, y_ini=x, **kwargs)
+        x = x_eq + A@(x - x_eq) + B@u
+        u_prev = u
+        actions.append(u)
+    return np.array(actions)
+
+
+@pytest.mark.parametrize('name', ['npDeePC', 'npMPC', 'npMPC condensed'])
+def test_shifted_warm_start(name):
+    reference, A, B = make_controller(name, 'cvxpy')
+    expected = rollout(reference, A, B, 10, solver=cp.CLARABEL)
+    for warm_start in (False, True, 'shift'):
+        controller, _, _ = make_controller(name, 'osqp')
+        actions = rollout(controller, A, B, 10, warm_start=warm_start)
+        np.testing.assert_allclose(actions, expected, atol=5e-2)
+
+
+def test_solve_many_matches_cvxpy():
+    # The weights are expanded over the horizon once, so solve_many works before setup and after repeated setups
+    A, B = RocketDx(true_model=True).linearise(x_eq=x_eq, u_eq=np.zeros(3), discrete=True)
+    starts = x_eq + np.random.default_rng(0).uniform(-1, 1, (4, 6))*np.array([2, 0, 0.5, 0.5, 0.05, 0.05]) + np.array([0, 1, 0, 0, 0, 0])
+    y_ref, u_ref = np.tile(x_eq, Tf), np.zeros(3*Tf)
+    reference = npMPC(A=A, B=B, Q=Q, R=R, N=Tf, u_constraints=u_constraints, y_constraints=y_constraints,
+                      formulation='condensed').setup()
+    expected = np.array([reference.solve(y_ref=y_ref, u_ref=u_ref, y_ini=x, solver=cp.CLARABEL)[0] for x in starts])
+    controller = npMPC(A=A, B=B, Q=Q, R=R, N=Tf, u_constraints=u_constraints, y_constraints=y_constraints)
+    actions, _ = controller.solve_many(starts, y_ref, u_ref)
+    np.testing.assert_allclose(actions, expected, atol=1e-4)
+    controller.setup().setup()
+    assert controller.Q.shape == (6*Tf, 6*Tf) and controller.R.shape == (3*Tf, 3*Tf)
+    np.testing.assert_allclose(controller.solve(y_ref=y_ref, u_ref=u_ref, y_ini=starts[0], solver=cp.CLARABEL)[0],
+                               expected[0], atol=1e-4)
+
+
+def test_osqp_is_quiet(capfd):
+    # No constraint is active at the solution, OSQP would print that polishing is not needed
+    qp = SparseQP(sp.eye(2), sp.eye(2), -10*np.ones(2), 10*np.ones(2))
+    for _ in range(2):
+        np.testing.assert_allclose(qp.solve(np.ones(2), -10*np.ones(2), 10*np.ones(2)), -np.ones(2), atol=1e-6)
+    assert capfd.readouterr().out == ''
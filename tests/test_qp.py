@@ -0,0 +1,169 @@
+import os
+import itertools
+import warnings
+import numpy as np
+import pytest
+import torch
+import cvxpy as cp
+import torch.autograd.forward_ad as fwAD
+from deepc_hunt import DeePC
+from deepc_hunt.qp import BatchQP
+from deepc_hunt.utils import TrajectoryDataset
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'examples', 'data')
+Tini, N, m, p = 4, 10, 3, 3
+
+# Regularizer combinations (linear, stochastic_u, stochastic_y), the closed form covers the remaining one
+REGULARIZERS = [c for c in itertools.product((True, False), repeat=3) if c != (True, False, False)]
+
+
+def random_qp(n_batch=4, n=6, k=9, seed=0) -> tuple:
+
+    """
+    Batch of QPs with an equality row, box constraints and two l1 rows
+    """
+
+    gen = torch.Generator().manual_seed(seed)
+    A = torch.randn(k, n, generator=gen, dtype=torch.float64)
+    M = torch.randn(n, n, generator=gen, dtype=torch.float64)
+    P = 0.1*M @ M.T
+    q = torch.randn(n_batch, n, generator=gen, dtype=torch.float64)
+    l, u = torch.full((n_batch, k), -0.3, dtype=torch.float64), torch.full((n_batch, k), 0.3, dtype=torch.float64)
+    l[:,0] = u[:,0] = 0.1
+    l[:,-2:], u[:,-2:] = -float('inf'), float('inf')
+    w = torch.zeros(k, dtype=torch.float64)
+    w[-2:] = 0.7
+    return A, P, q, l, u, w
+
+
+def recht_deepc(linear: bool, stochastic_u: bool, stochastic_y: bool) -> DeePC:
+    ud = np.genfromtxt(os.path.join(DATA, 'recht_ud.csv'), delimiter=',')
+    yd = np.genfromtxt(os.path.join(DATA, 'recht_yd.csv'), delimiter=',')
+    torch.manual_seed(0)
+    return DeePC(
+        ud=ud, yd=yd, N=N, Tini=Tini, m=m, p=p, device='cpu',
+        y_constraints=(-np.ones(N*p)*100, np.ones(N*p)*100), u_constraints=(-np.ones(N*m)*5, np.ones(N*m)*5),
+        linear=linear, stochastic_u=stochastic_u, stochastic_y=stochastic_y, backend='torch', closed_form=False
+    )
+
+
+@pytest.mark.parametrize('dtype', [torch.float32, torch.float64])
+@pytest.mark.parametrize('linear, stochastic_u, stochastic_y', REGULARIZERS)
+def test_gradient_matches_finite_differences(linear, stochastic_u, stochastic_y, dtype):
+    controller = recht_deepc(linear, stochastic_u, stochastic_y)
+    ud, yd = controller.ud, controller.yd
+    u_ini, y_ini = TrajectoryDataset(ud, yd, Tini, m, p, dtype=dtype, seed=0).sample(8)
+    ref_y, ref_u = torch.zeros(N*p, dtype=dtype), torch.zeros(N*m, dtype=dtype)
+
+    def loss(u_ini, y_ini):
+        controller.qp.clear_cache()
+        u, y = controller(ref_y.to(u_ini.dtype), ref_u.to(u_ini.dtype), u_ini, y_ini)[:2]
+        return (u.double()**2).sum() + (y.double()**2).sum()
+
+    params = list(controller.parameters())
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        grads = torch.autograd.grad(loss(u_ini, y_ini), params)
+
+        # Central differences on the same (rounded) initial signals, median over the step sizes
+        for param, grad in zip(params, grads):
+            for i in range(param.numel()):
+                value = param.data.view(-1)[i].item()
+                fd = []
+                for step in (1e-3, 1e-4, 1e-5):
+                    h = step*max(1, abs(value))
+                    losses = []
+                    for v in (value + h, value - h):
+                        param.data.view(-1)[i] = v
+                        with torch.no_grad():
+                            losses.append(loss(u_ini.double(), y_ini.double()).item())
+                    fd.append((losses[0] - losses[1])/(2*h))
+                param.data.view(-1)[i] = value
+                assert grad.view(-1)[i].item() == pytest.approx(np.median(fd), rel=1e-2, abs=1e-2)
+
+
+def test_batchqp_matches_cvxpy():
+    A, P, q, l, u, w = random_qp()
+    x = BatchQP(A)(P, q, l, u, w)
+    for b in range(q.shape[0]):
+        z = cp.Variable(A.shape[1])
+        Az = A.numpy() @ z
+        box = torch.isfinite(l[b]).numpy()
+        cost = 0.5*cp.quad_form(z, P.numpy(), assume_PSD=True) + q[b].numpy() @ z + w.numpy() @ cp.abs(Az)
+        constraints = [Az[box] >= l[b].numpy()[box], Az[box] <= u[b].numpy()[box]]
+        cp.Problem(cp.Minimize(cost), constraints).solve(solver='CLARABEL')
+        np.testing.assert_allclose(x[b].numpy(), z.value, atol=1e-6)
+
+
+@pytest.mark.parametrize('polish_iter', [5, 0])
+def test_batchqp_derivatives(polish_iter):
+    # polish_iter=0 leaves every active set unconfirmed, so the derivative is taken through the barrier
+    A, P, q, l, u, w = random_qp()
+    gen = torch.Generator().manual_seed(1)
+    tangents = [torch.randn(t.shape, generator=gen, dtype=torch.float64) for t in (P, q, l, u, w)]
+    tangents[2] = tangents[2]*torch.isfinite(l)
+    tangents[3] = torch.where(l == u, tangents[2], tangents[3]*torch.isfinite(u))
+    tangents[4] = tangents[4]*(w > 0)
+    v = torch.randn(q.shape, generator=gen, dtype=torch.float64)
+    qp = BatchQP(A, polish_iter=polish_iter)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        with fwAD.dual_level():
+            x = qp(*(fwAD.make_dual(t, dt) for t, dt in zip((P, q, l, u, w), tangents)))
+            forward = (v*fwAD.unpack_dual(x).tangent).sum()
+
+        inputs = [t.clone().requires_grad_() for t in (P, q, l, u, w)]
+        qp.clear_cache()
+        grads = torch.autograd.grad((v*qp(*inputs)).sum(), inputs)
+        reverse = sum((g*dt).sum() for g, dt in zip(grads, tangents))
+
+        h = 1e-6
+        with torch.no_grad():
+            qp.clear_cache()
+            x_plus = qp(*(t + h*dt for t, dt in zip((P, q, l, u, w), tangents)))
+            qp.clear_cache()
+            x_minus = qp(*(t - h*dt for t, dt in zip((P, q, l, u, w), tangents)))
+        fd = (v*(x_plus - x_minus)).sum()/(2*h)
+
+    assert forward.item() == pytest.approx(reverse.item(), rel=1e-8)
+    assert reverse.item() == pytest.approx(fd.item(), rel=1e-4)
+
+
+@pytest.mark.parametrize('polish_iter', [5, 0])
+def test_batched_tangents_share_one_solve(polish_iter):
+    A, P, q, l, u, w = random_qp()
+    gen = torch.Generator().manual_seed(1)
+    dq = torch.randn((5, *q.shape), generator=gen, dtype=torch.float64)
+    dP = torch.randn((5, *P.shape), generator=gen, dtype=torch.float64)
+    qp = BatchQP(A, polish_iter=polish_iter)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        qp(P, q, l, u, w)
+        iterations = qp.iterations
+        qp.clear_cache()
+        _, dx = torch.func.vmap(
+            lambda dP, dq: torch.func.jvp(lambda P, q: qp(P, q, l, u, w), (P, q), (dP, dq)), out_dims=(None, 0)
+        )(dP, dq)
+        assert qp.iterations == 2*iterations
+        for i in range(dq.shape[0]):
+            qp.clear_cache()
+            with fwAD.dual_level():
+                x = qp(fwAD.make_dual(P, dP[i]), fwAD.make_dual(q, dq[i]), l, u, w)
+                torch.testing.assert_close(dx[i], fwAD.unpack_dual(x).tangent)
+
+
+def test_batchqp_reuses_confirmed_active_sets():
+    A, P, q, l, u, w = random_qp()
+    qp = BatchQP(A)
+    qp(P, q, l, u, w)
+    assert bool(qp._active[1].all())
+    qp(P, q + 1e-3, l, u, w)
+    assert qp.warm_solves == q.shape[0]
+
+    # Without polishing no active set is confirmed, so none is reused
+    qp = BatchQP(A, polish_iter=0)
+    qp(P, q, l, u, w)
+    qp(P, q, l, u, w)
+    assert qp._active is None and qp.warm_solves == 0
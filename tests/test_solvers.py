@@ -0,0 +1,92 @@
+import pytest
+import numpy as np
+import cvxpy as cp
+from deepc_hunt.solvers import SolverSelector, is_solver_error
+
+
+def flaky(fails: dict):
+
+    """
+    Solve function that raises while fails[solver] is positive, counting it down
+    """
+
+    def solve(solver):
+        if fails.get(solver, 0) > 0:
+            fails[solver] -= 1
+            raise cp.SolverError(f'{solver} failed')
+        return solver
+    return solve
+
+
+def test_occasional_failures_do_not_reprobe():
+    selector = SolverSelector(['A', 'B'], max_failures=2, reps=1)
+    fails = {}
+    solve = flaky(fails)
+    for _ in range(5):
+        fails['A'] = 1
+        assert selector.run(solve) == 'B'
+        assert selector.run(solve) == 'A'
+    assert selector.solver == 'A'
+    assert selector.failures == 0
+    assert not any(event['reprobe'] for event in selector.events)
+
+
+def test_consecutive_failures_reprobe():
+    selector = SolverSelector(['A', 'B'], max_failures=2, reps=1)
+    solve = flaky({'A': 100})
+    assert selector.run(solve) == 'B'
+    assert selector.run(solve) == 'B'
+    assert selector.solver == 'B'
+    assert selector.events[-1]['reprobe']
+
+
+def test_all_solvers_fail():
+    selector = SolverSelector(['A', 'B'], max_failures=5)
+    with pytest.raises(cp.SolverError):
+        selector.run(flaky({'A': 1, 'B': 1}))
+
+
+def test_errors_of_the_caller_are_raised():
+    selector = SolverSelector(['A', 'B'], max_failures=1)
+    calls = []
+
+    def solve(solver):
+        calls.append(solver)
+        raise ValueError('parameter of the wrong shape')
+
+    with pytest.raises(ValueError, match='wrong shape'):
+        selector.run(solve)
+    assert calls == ['A']
+    assert selector.failures == 0
+    assert selector.events == []
+
+
+def in_module(name: str, source: str):
+    # Function solve defined in a module called name, so its frames belong to that package
+    namespace = {'__name__': name, 'np': np}
+    exec(source, namespace)
+    return namespace['solve']
+
+
+def test_numpy_errors_within_diffcp_are_solver_errors():
+    # The last frame is in numpy, one further up in diffcp
+    factorize = in_module('diffcp.cone_program', 'def solve(solver):\n    return np.linalg.cholesky(-np.eye(2))')
+    with pytest.raises(np.linalg.LinAlgError) as error:
+        factorize('A')
+    assert is_solver_error(error.value)
+    selector = SolverSelector(['A', 'B'], max_failures=3)
+    calls = []
+    assert selector.run(lambda solver: calls.append(solver) or (factorize(solver) if solver == 'A' else solver)) == 'B'
+    assert calls == ['A', 'B']
+
+
+def test_bugs_in_diffcp_are_not_solver_errors():
+    bug = in_module('diffcp.cone_program', 'def solve(solver):\n    return None + solver')
+    selector = SolverSelector(['A', 'B'], max_failures=1)
+    with pytest.raises(TypeError):
+        selector.run(bug)
+    assert selector.events == []
+    wrong_shape = in_module('cvxpylayers.torch.cvxpylayer', 'def solve(solver):\n    raise ValueError("wrong shape")')
+    with pytest.raises(ValueError) as error:
+        wrong_shape('A')
+    assert not is_solver_error(error.value)
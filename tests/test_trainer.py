@@ -0,0 +1,121 @@
+import os
+import numpy as np
+import pytest
+import torch
+import torch.nn as nn
+from deepc_hunt import DeePC, Trainer
+from deepc_hunt.utils import TrajectoryDataset, episode_loss
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'examples', 'data')
+Tini, N, m, p = 4, 10, 3, 3
+
+
+class NoisyLinear(nn.Module):
+
+    """
+    Surrogate model y_next = A@y + B@u + noise, the noise is drawn from the default generator
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        rng = np.random.default_rng(1)
+        self.A = torch.as_tensor(0.5*rng.standard_normal((p, p))/np.sqrt(p))
+        self.B = torch.as_tensor(rng.standard_normal((p, m))/np.sqrt(m))
+
+    def forward(self, y: torch.Tensor, u: torch.Tensor) -> torch.Tensor:
+        return y@self.A.T.to(y) + u@self.B.T.to(u) + 0.1*torch.randn_like(y)
+
+
+@pytest.mark.parametrize('backend', ['closed_form', 'torch'])
+def test_forward_mode_matches_reverse_mode(backend):
+    ud = np.genfromtxt(os.path.join(DATA, 'recht_ud.csv'), delimiter=',')
+    yd = np.genfromtxt(os.path.join(DATA, 'recht_yd.csv'), delimiter=',')
+    kwargs = dict(closed_form=True) if backend == 'closed_form' else dict(backend='torch', closed_form=False, stochastic_y=True)
+    torch.manual_seed(0)
+    controller = DeePC(ud=ud, yd=yd, N=N, Tini=Tini, m=m, p=p, device='cpu',
+                       y_constraints=(-np.ones(N*p)*100, np.ones(N*p)*100), u_constraints=(-np.ones(N*m)*5, np.ones(N*m)*5),
+                       **kwargs).double()
+    trainer = Trainer(controller, NoisyLinear())
+    u_ini, y_ini = TrajectoryDataset(ud, yd, Tini, m, p, dtype=torch.float64, seed=0).sample(4)
+    uref, yref = torch.zeros(4, N*m, dtype=torch.float64), torch.ones(4, N*p, dtype=torch.float64)
+
+    torch.manual_seed(0)
+    reverse = trainer.reverse_mode_episode(uref=uref, yref=yref, u_ini=u_ini, y_ini=y_ini, time_steps=5)
+    torch.manual_seed(0)
+    forward, grads = trainer.forward_mode_episode(uref=uref, yref=yref, u_ini=u_ini, y_ini=y_ini, time_steps=5)
+    assert forward == pytest.approx(reverse, rel=1e-8)
+    for param, grad in zip(controller.parameters(), grads):
+        torch.testing.assert_close(grad, param.grad, rtol=1e-5, atol=1e-8)
+
+
+def test_default_dataset_follows_controller_update():
+    ud = np.genfromtxt(os.path.join(DATA, 'recht_ud.csv'), delimiter=',')
+    yd = np.genfromtxt(os.path.join(DATA, 'recht_yd.csv'), delimiter=',')
+    controller = DeePC(ud=ud, yd=yd, N=N, Tini=Tini, m=m, p=p, device='cpu', closed_form=True,
+                       y_constraints=(-np.ones(N*p)*1e3, np.ones(N*p)*1e3), u_constraints=(-np.ones(N*m)*1e3, np.ones(N*m)*1e3))
+    trainer = Trainer(controller=controller, env=NoisyLinear())
+    given = Trainer(controller=controller, env=NoisyLinear(), dataset=TrajectoryDataset(ud, yd, Tini, m, p))
+    dataset = given.dataset
+    controller.update(-ud[:Tini], -yd[:Tini])
+    u_ini, y_ini = trainer.dataset[len(trainer.dataset) - 1]
+    torch.testing.assert_close(u_ini, torch.as_tensor(-ud[:Tini].reshape(-1), dtype=u_ini.dtype))
+    torch.testing.assert_close(y_ini, torch.as_tensor(-yd[:Tini].reshape(-1), dtype=y_ini.dtype))
+    assert given.dataset is dataset
+
+
+def closed_loop_gradients(controller, env, uref, yref, u_ini, y_ini, time_steps, cut=None) -> list:
+    # Gradient of the whole episode with one backward pass, cutting the graph of the initial
+    # conditions every cut steps
+    u_hist, y_hist = list(u_ini.split(m, dim=1)), list(y_ini.split(p, dim=1))
+    Y, U = [], []
+    for t in range(time_steps):
+        if cut and t > 0 and t % cut == 0:
+            u_hist, y_hist = [u.detach() for u in u_hist], [y.detach() for y in y_hist]
+        action = controller(uref=uref, yref=yref, u_ini=torch.cat(u_hist[-Tini:], 1), y_ini=torch.cat(y_hist[-Tini:], 1))[0][:,:m]
+        obs = env(y_hist[-1], action)
+        Y.append(obs - yref[:,:p])
+        U.append(action - uref[:,:m])
+        u_hist.append(action)
+        y_hist.append(obs)
+    controller.zero_grad()
+    episode_loss(torch.stack(Y, 1), torch.stack(U, 1), controller).backward()
+    return [param.grad.clone() for param in controller.parameters()]
+
+
+def tbptt_setup() -> tuple:
+    ud = np.genfromtxt(os.path.join(DATA, 'recht_ud.csv'), delimiter=',')
+    yd = np.genfromtxt(os.path.join(DATA, 'recht_yd.csv'), delimiter=',')
+    torch.manual_seed(0)
+    controller = DeePC(ud=ud, yd=yd, N=N, Tini=Tini, m=m, p=p, device='cpu', closed_form=True,
+                       y_constraints=(-np.ones(N*p)*100, np.ones(N*p)*100), u_constraints=(-np.ones(N*m)*5, np.ones(N*m)*5)).double()
+    u_ini, y_ini = TrajectoryDataset(ud, yd, Tini, m, p, dtype=torch.float64, seed=0).sample(4)
+    uref, yref = torch.zeros(4, N*m, dtype=torch.float64), torch.ones(4, N*p, dtype=torch.float64)
+    return Trainer(controller, NoisyLinear()), dict(uref=uref, yref=yref, u_ini=u_ini, y_ini=y_ini, time_steps=6)
+
+
+def tbptt_gradients(trainer, episode, tbptt) -> list:
+    trainer.controller.zero_grad()
+    torch.manual_seed(1)
+    trainer.reverse_mode_episode(**episode, tbptt=tbptt)
+    return [param.grad.clone() for param in trainer.controller.parameters()]
+
+
+@pytest.mark.parametrize('tbptt', [None, 6, 10])
+def test_tbptt_of_whole_episode_matches_full_backward(tbptt):
+    trainer, episode = tbptt_setup()
+    torch.manual_seed(1)
+    expected = closed_loop_gradients(trainer.controller, trainer.env, **episode)
+    for grad, reference in zip(tbptt_gradients(trainer, episode, tbptt), expected):
+        torch.testing.assert_close(grad, reference)
+
+
+def test_tbptt_cuts_the_graph_between_windows():
+    trainer, episode = tbptt_setup()
+    torch.manual_seed(1)
+    truncated = closed_loop_gradients(trainer.controller, trainer.env, **episode, cut=4)
+    torch.manual_seed(1)
+    full = closed_loop_gradients(trainer.controller, trainer.env, **episode)
+    grads = tbptt_gradients(trainer, episode, 4)
+    for grad, reference in zip(grads, truncated):
+        torch.testing.assert_close(grad, reference)
+    assert any(not torch.allclose(grad, reference) for grad, reference in zip(grads, full))
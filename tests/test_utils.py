@@ -0,0 +1,257 @@
+import os
+from types import SimpleNamespace
+import numpy as np
+import pytest
+import torch
+import scipy.linalg
+import scipy.sparse.linalg
+from deepc_hunt import utils
+from deepc_hunt.utils import block_hankel, row_space_basis, RowSpaceBasis, HankelOperator, block_hankel_torch, load_data, check_excitation
+from deepc_hunt.utils import EpisodeLoss, episode_loss, sample_initial_signal, TrajectoryDataset
+
+
+def projector(V: np.ndarray) -> np.ndarray:
+    return V@V.T
+
+
+def low_rank(rows: int, cols: int, rank: int, seed=0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    return rng.standard_normal((rows, rank))@rng.standard_normal((rank, cols))
+
+
+def test_block_hankel_is_a_float_view():
+    w = np.arange(12)
+    H = block_hankel(w, 3, 2)
+    assert H.dtype == np.float64
+    np.testing.assert_array_equal(H[:, 1], [2, 3, 4, 5, 6, 7])
+    assert not H.flags.writeable
+    w = w.astype(float)
+    assert np.shares_memory(block_hankel(w, 3, 2), w)
+
+
+def periodic(T: int, d: int, period: int, seed=0) -> np.ndarray:
+    # Periodic data, the Hankel matrix has rank period*d at most
+    return np.tile(np.random.default_rng(seed).standard_normal(period*d), T//period + 1)[:T*d]
+
+
+@pytest.mark.parametrize('w, L, d', [
+    (np.random.default_rng(0).standard_normal(400), 5, 2),  # full rank, wide
+    (periodic(200, 2, 3), 5, 2),  # rank deficient, wide
+    (np.random.default_rng(1).standard_normal(24), 5, 2),  # tall
+    (periodic(12, 2, 3), 5, 2),  # rank deficient, tall
+])
+def test_check_excitation_matches_matrix_rank(w, L, d):
+    H = block_hankel(w, L, d)
+    rank = np.linalg.matrix_rank(H)
+    excitation = check_excitation(w, L, d)
+    assert (excitation.rank, excitation.rows, excitation.exciting) == (rank, H.shape[0], rank == H.shape[0])
+
+
+def test_check_excitation_falls_back_to_qr_near_threshold(monkeypatch):
+    # Singular values around 1e-9 of the largest one are lost in the Gram matrix but resolved by the QR
+    w = periodic(300, 2, 3) + 1e-9*np.random.default_rng(0).standard_normal(600)
+    qr = scipy.linalg.qr
+    calls = []
+    monkeypatch.setattr(scipy.linalg, 'qr', lambda *args, **kwargs: calls.append(1) or qr(*args, **kwargs))
+    excitation = check_excitation(w, 5, 2)
+    assert calls
+    assert excitation.rank == np.linalg.matrix_rank(block_hankel(w, 5, 2)) == 10
+    assert excitation.exciting and 0 < excitation.margin < 1e-6*excitation.sigma_max
+
+
+def test_check_excitation_is_cached(monkeypatch):
+    w = np.random.default_rng(2).standard_normal(100)
+    excitation = check_excitation(w, 4, 1)
+    monkeypatch.setattr(utils, 'block_hankel', None)
+    # Equal data hits the cache without building the Hankel matrix, another tolerance does not
+    assert check_excitation(w.copy(), 4, 1) is excitation
+    with pytest.raises(TypeError):
+        check_excitation(w, 4, 1, tol=1e-3)
+
+
+@pytest.mark.parametrize('rank', [5, 12])
+def test_row_space_basis_matches_pinv(rank):
+    H = low_rank(12, 40, rank)
+    V = row_space_basis(H)
+    assert V.shape == (40, rank)
+    np.testing.assert_allclose(projector(V), np.linalg.pinv(H)@H, atol=1e-10)
+
+
+@pytest.mark.parametrize('slide', [False, True])
+def test_row_space_basis_updates_match_new_svd(slide):
+    # Columns of a Hankel matrix of the outputs of a random order 4 system, so the rank stays below the rows
+    rng = np.random.default_rng(0)
+    A = np.linalg.qr(rng.standard_normal((4, 4)))[0]*0.95
+    C, x, w = rng.standard_normal((1, 4)), rng.standard_normal(4), []
+    for _ in range(120):
+        w.append(C@x)
+        x = A@x
+    w = np.concatenate(w)
+    L, cols = 8, 60
+    H = block_hankel(w[:L + cols - 1], L, 1)
+    basis = RowSpaceBasis(H)
+    for start in range(0, 40, 5):
+        # Columns cols + start to cols + start + 4 of the Hankel matrix of the whole sequence
+        columns = block_hankel(w[cols + start:cols + start + L + 4], L, 1)
+        basis.update(columns, slide=slide)
+        H = np.hstack([H[:, 5:] if slide else H, columns])
+        assert basis.basis.shape == (H.shape[1], 4)
+        np.testing.assert_allclose(projector(basis.basis), np.linalg.pinv(H, rcond=1e-10)@H, atol=1e-8)
+
+
+@pytest.mark.parametrize('method', ['fft', 'direct'])
+@pytest.mark.parametrize('framework', ['numpy', 'torch'])
+def test_hankel_operator_matches_dense(method, framework):
+    rng = np.random.default_rng(0)
+    d, L, T = 3, 40, 500
+    w = rng.standard_normal(T*d)
+    dense = block_hankel(w, L, d)
+    g, v = rng.standard_normal((2, T - L + 1)), rng.standard_normal((2, L*d))
+    if framework == 'torch':
+        w, g, v = torch.as_tensor(w), torch.as_tensor(g), torch.as_tensor(v)
+    H = HankelOperator(w, L, d, method=method)
+    assert H.shape == dense.shape
+    np.testing.assert_allclose(np.asarray(H.matvec(g)), np.asarray(g)@dense.T, atol=1e-10)
+    np.testing.assert_allclose(np.asarray(H.rmatvec(v)), np.asarray(v)@dense, atol=1e-10)
+    np.testing.assert_allclose(np.asarray(H.to_dense()), dense)
+    # Block rows of the operator, e.g. Uf
+    Hf = H.rows(10, L)
+    np.testing.assert_allclose(np.asarray(Hf.matvec(g)), np.asarray(g)@dense[10*d:].T, atol=1e-10)
+    np.testing.assert_allclose(np.asarray(Hf.rmatvec(v[:, 10*d:])), np.asarray(v[:, 10*d:])@dense[10*d:], atol=1e-10)
+
+
+def test_hankel_operator_gradient():
+    rng = np.random.default_rng(0)
+    w = torch.tensor(rng.standard_normal(300), requires_grad=True)
+    g = torch.tensor(rng.standard_normal(300//3 - 40 + 1))
+    HankelOperator(w, 40, 3, method='fft').matvec(g).square().sum().backward()
+    expected = torch.autograd.grad((g@block_hankel_torch(w, 40, 3).T).square().sum(), w)[0]
+    torch.testing.assert_close(w.grad, expected)
+
+
+def test_hankel_operator_lsqr():
+    # Least squares through the scipy LinearOperator against the dense solution
+    rng = np.random.default_rng(0)
+    w, b = rng.standard_normal(3*200), rng.standard_normal(3*10)
+    H = HankelOperator(w, 10, 3, method='fft')
+    g = scipy.sparse.linalg.lsqr(H.aslinearoperator(), b, atol=1e-14, btol=1e-14, iter_lim=10000)[0]
+    np.testing.assert_allclose(g, np.linalg.lstsq(block_hankel(w, 10, 3), b, rcond=None)[0], atol=1e-8)
+
+
+@pytest.mark.parametrize('columns', [1, 3])
+def test_load_data_matches_genfromtxt(tmp_path, columns):
+    data = np.random.default_rng(0).standard_normal((1000, columns)).squeeze()
+    path = os.path.join(str(tmp_path), 'yd.csv')
+    np.savetxt(path, data, delimiter=',')
+    expected = np.genfromtxt(path, delimiter=',')
+    loaded = load_data(path)
+    assert isinstance(loaded, np.memmap) and not loaded.flags.writeable
+    np.testing.assert_array_equal(loaded, expected)
+    # The CSV file is converted once, later calls read the .npy file next to it
+    assert os.path.exists(os.path.join(str(tmp_path), 'yd.npy'))
+    np.testing.assert_array_equal(load_data(path, mmap_mode=None), expected)
+
+
+@pytest.mark.parametrize('fortran', [False, True])
+def test_load_data_maps_npz_members(tmp_path, fortran):
+    rng = np.random.default_rng(0)
+    ud, yd = rng.standard_normal((500, 3)), rng.standard_normal((500, 2)).astype(np.float32)
+    if fortran:
+        ud, yd = np.asfortranarray(ud), np.asfortranarray(yd)
+    path = os.path.join(str(tmp_path), 'data.npz')
+    np.savez(path, ud=ud, yd=yd)
+    with np.load(path) as archive:
+        for key in ('ud', 'yd'):
+            loaded = load_data(path, key=key)
+            assert isinstance(loaded, np.memmap)
+            assert loaded.dtype == archive[key].dtype
+            np.testing.assert_array_equal(loaded, archive[key])
+            np.testing.assert_array_equal(load_data(path, key=key, mmap_mode=None), archive[key])
+    with pytest.raises(ValueError, match='pass key'):
+        load_data(path)
+    np.savez_compressed(path, ud=ud)
+    with pytest.raises(ValueError, match='compressed'):
+        load_data(path)
+
+
+def reference_loss(Y, U, q, r, q_terminal=None, discount=1.0, y_bounds=None, u_bounds=None, penalty=0.0):
+    # Per-step loop over the batch and the horizon
+    loss = 0
+    for i in range(Y.shape[0]):
+        for t in range(Y.shape[1]):
+            y, u, w = Y[i,t], U[i,t], discount**t
+            loss += w*(y@torch.diag(q)@y + u@torch.diag(r)@u)
+            for x, bounds in ((y, y_bounds), (u, u_bounds)):
+                if bounds is not None:
+                    violation = torch.clamp(x - torch.as_tensor(bounds[1]).to(x), min=0) + torch.clamp(torch.as_tensor(bounds[0]).to(x) - x, min=0)
+                    loss += penalty*w*(violation@violation)
+        if q_terminal is not None:
+            y = Y[i,-1]
+            loss += discount**(Y.shape[1] - 1)*(y@torch.diag(torch.as_tensor(q_terminal).to(y))@y)
+    return loss/Y.shape[0]
+
+
+def trajectories(batch=3, T=12, p=2, m=3) -> tuple:
+    rng = torch.Generator().manual_seed(0)
+    controller = SimpleNamespace(q=torch.rand(p, generator=rng, dtype=torch.float64) + 0.5,
+                                 r=torch.rand(m, generator=rng, dtype=torch.float64) + 0.5, device='cpu')
+    Y = torch.randn(batch, T, p, generator=rng, dtype=torch.float64)
+    U = torch.randn(batch, T, m, generator=rng, dtype=torch.float64)
+    return Y, U, controller
+
+
+def test_episode_loss_matches_per_step_loop():
+    Y, U, controller = trajectories()
+    torch.testing.assert_close(episode_loss(Y, U, controller), reference_loss(Y, U, controller.q, controller.r))
+
+
+LOSS_TERMS = dict(q_terminal=[3., 4.], discount=0.9, y_bounds=(-0.5, 0.5), u_bounds=([-1., -0.2, -1.], [1., 0.2, 1.]), penalty=7.)
+
+
+def test_episode_loss_terms_match_per_step_loop():
+    Y, U, controller = trajectories()
+    loss = EpisodeLoss(**LOSS_TERMS)(Y, U, controller)
+    torch.testing.assert_close(loss, reference_loss(Y, U, controller.q, controller.r, **LOSS_TERMS))
+
+
+def test_episode_loss_windows_sum_to_episode():
+    # The windows of tbptt, each with its start and the terminal cost only on the last one
+    Y, U, controller = trajectories()
+    loss = EpisodeLoss(**LOSS_TERMS)
+    windows = [(0, 5), (5, 10), (10, 12)]
+    split = sum(loss(Y[:,a:b], U[:,a:b], controller, start=a, final=b == Y.shape[1]) for a, b in windows)
+    torch.testing.assert_close(split, loss(Y, U, controller))
+
+
+def test_sample_initial_signal_reaches_end_of_long_data():
+    # The data is its own time index, so the first entry of u_ini is the start of the window
+    T, Tini = 400, 4
+    ud, yd = np.arange(T, dtype=float), np.zeros((T, 2))
+    np.random.seed(0)
+    u_ini, y_ini = sample_initial_signal(Tini, 2, 1, T, ud, yd)
+    assert u_ini.shape == (T, Tini) and y_ini.shape == (T, 2*Tini)
+    torch.testing.assert_close(u_ini, u_ini[:,:1] + torch.arange(Tini, dtype=u_ini.dtype))
+    assert u_ini[:,0].max() > T - 20
+
+
+def time_index_dataset(T=100, Tini=4) -> TrajectoryDataset:
+    # u_ini[..., 0] of a window is its start
+    return TrajectoryDataset(np.arange(T, dtype=float), np.zeros(T), Tini, 1, 1, dtype=torch.float64, seed=0)
+
+
+def test_stratified_sample_draws_one_window_per_stratum():
+    dataset = time_index_dataset()
+    n, batch = len(dataset), 7
+    u_ini, _ = dataset.sample(batch, stratified=True)
+    edges = np.linspace(0, n, batch + 1)
+    start = u_ini[:,0].numpy()
+    assert np.all((edges[:-1] <= start) & (start < edges[1:]))
+
+
+def test_sample_without_replacement_is_distinct():
+    dataset = time_index_dataset()
+    n = len(dataset)
+    u_ini, _ = dataset.sample(n, replace=False)
+    assert sorted(u_ini[:,0].tolist()) == list(range(n))
+    with pytest.raises(ValueError):
+        dataset.sample(n + 1, replace=False)